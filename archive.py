@@ -0,0 +1,324 @@
+# archive.py — архив завершённых и отменённых сделок вне горячего набора
+#
+# Сделки в терминальных статусах больше не меняются, но раньше лежали в Store
+# вечно: загрузка снапшота, его сжатие и переборы росли вместе с историей.
+# DealArchiver переносит их сюда пачками, в хранилище остаются только
+# открытые и активные сделки, балансы и т.п. Раскладка на диске:
+#   archive/deals-2026-10.0.jsonl.gz — сегмент месяца архивации, поколение 0;
+#       каждая пачка — отдельный gzip-member (JSON-строка на сделку),
+#       файл только дописывается;
+#   archive/index.sqlite3 — номер сделки -> (сегмент, смещение и длина member'а).
+# Поиск по номеру читает и распаковывает один member. Порядок «member на диск
+# и fsync → индекс → удаление из Store» делает перенос идемпотентным: после
+# обрыва пачка архивируется повторно, индекс указывает на последнюю копию.
+# Сегменты закрытых месяцев фоновое сжатие переписывает крупными member'ами
+# без повторов в следующее поколение файла.
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, Optional, List, Tuple
+
+from journal import _fsync_dir
+from sqlite_store import connect
+from storage import Store
+
+log = logging.getLogger(__name__)
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    name TEXT PRIMARY KEY,
+    month TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    compacted INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS deals (
+    id TEXT PRIMARY KEY,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    archived_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deals_segment ON deals (segment, offset);
+"""
+
+SEGMENT_RE = re.compile(r"deals-(\d{4}-\d{2})\.(\d+)\.jsonl\.gz")
+COMPACT_MEMBER_DEALS = 256  # сделок в member'е после сжатия: больше — лучше сжатие, дороже поиск
+
+
+def segment_name(month: str, generation: int) -> str:
+    return f"deals-{month}.{generation}.jsonl.gz"
+
+
+def archive_month(ts: float) -> str:
+    return time.strftime("%Y-%m", time.gmtime(ts))
+
+
+def _member(deals: List[Dict[str, Any]], level: int) -> bytes:
+    lines = "".join(json.dumps(d, ensure_ascii=False, separators=(",", ":")) + "\n" for d in deals)
+    return gzip.compress(lines.encode("utf-8"), compresslevel=level)
+
+
+class DealArchive:
+    def __init__(self, path: Path, cache_size: int = 32, workers: int = 2):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.cache_size = cache_size
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="archive")
+        self._local = threading.local()
+        # дописывание и сжатие меняют сегменты и индекс по очереди; чтение не блокируется
+        self._write_lock = threading.Lock()
+        # распакованные member'ы: (сегмент, смещение) -> {номер: сделка}
+        self._cache: "OrderedDict[Tuple[str, int], Dict[str, Dict[str, Any]]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._compactor: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self.stats = {"archived": 0, "batches": 0, "bytes": 0, "lookups": 0, "found": 0, "cache_hits": 0,
+                      "compactions": 0, "compacted_bytes_saved": 0, "compact_seconds": 0.0}
+        self._conn().executescript(INDEX_SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect(self.path / "index.sqlite3")
+        return conn
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for k, v in deltas.items():
+                self.stats[k] += v
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+
+    async def close(self):
+        if self._compactor is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._compactor.join)
+        await asyncio.get_running_loop().run_in_executor(None, self._pool.shutdown)
+
+    # ----- дописывание -----
+    def _current_segment(self, conn, month: str) -> str:
+        row = conn.execute("SELECT name FROM segments WHERE month = ? ORDER BY generation DESC LIMIT 1",
+                           (month,)).fetchone()
+        if row is not None:
+            return row[0]
+        name = segment_name(month, 0)
+        conn.execute("INSERT INTO segments (name, month, generation) VALUES (?, ?, 0)", (name, month))
+        return name
+
+    def _append(self, deals: List[Dict[str, Any]]):
+        member = _member(deals, level=6)
+        now = time.time()
+        with self._write_lock:
+            conn = self._conn()
+            name = self._current_segment(conn, archive_month(now))
+            with open(self.path / name, "ab") as fh:
+                offset = fh.seek(0, os.SEEK_END)
+                fh.write(member)
+                fh.flush()
+                os.fsync(fh.fileno())
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO deals (id, segment, offset, length, archived_at) VALUES (?, ?, ?, ?, ?)",
+                    ((d["id"], name, offset, len(member), now) for d in deals),
+                )
+                # месяц ещё дописывается (или снова — часы сдвинулись): сжатие нужно заново
+                conn.execute("UPDATE segments SET compacted = 0 WHERE name = ?", (name,))
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        self._count(archived=len(deals), batches=1, bytes=len(member))
+
+    async def append(self, deals: List[Dict[str, Any]]):
+        # возвращается, когда пачка на диске и в индексе — после этого её можно удалять из Store
+        if deals:
+            await self._run(self._append, [dict(d) for d in deals])
+
+    # ----- поиск -----
+    def _read_member(self, segment: str, offset: int, length: int) -> Dict[str, Dict[str, Any]]:
+        key = (segment, offset)
+        with self._cache_lock:
+            deals = self._cache.get(key)
+            if deals is not None:
+                self._cache.move_to_end(key)
+        if deals is not None:
+            self._count(cache_hits=1)
+            return deals
+        with open(self.path / segment, "rb") as fh:
+            fh.seek(offset)
+            raw = gzip.decompress(fh.read(length))
+        deals = {}
+        for line in raw.splitlines():
+            deal = json.loads(line)
+            deals[deal["id"]] = deal
+        with self._cache_lock:
+            self._cache[key] = deals
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return deals
+
+    def _find(self, deal_id: str) -> Optional[Dict[str, Any]]:
+        self._count(lookups=1)
+        conn = self._conn()
+        for attempt in range(2):
+            row = conn.execute("SELECT segment, offset, length FROM deals WHERE id = ?", (deal_id,)).fetchone()
+            if row is None:
+                return None
+            try:
+                deal = self._read_member(*row).get(deal_id)
+            except FileNotFoundError:
+                # сегмент только что заменило сжатие — индекс уже указывает на новое поколение
+                if attempt:
+                    raise
+                continue
+            if deal is not None:
+                self._count(found=1)
+                return dict(deal)
+            return None
+        return None
+
+    async def find(self, deal_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(self._find, deal_id)
+
+    def count(self) -> int:
+        (n,) = self._conn().execute("SELECT COUNT(*) FROM deals").fetchone()
+        return n
+
+    # ----- обслуживание -----
+    def remove_orphans(self):
+        # файлы, которых нет в индексе: обрыв посреди сжатия (новое поколение
+        # не успело попасть в индекс или старое — удалиться)
+        known = {r[0] for r in self._conn().execute("SELECT name FROM segments")}
+        for p in self.path.glob("deals-*.jsonl.gz"):
+            if SEGMENT_RE.fullmatch(p.name) and p.name not in known:
+                log.warning("archive: удалён сегмент вне индекса %s", p.name)
+                p.unlink(missing_ok=True)
+
+    def compact(self) -> bool:
+        # сжатие сегментов закрытых месяцев в фоновом потоке
+        if self._compactor is not None and self._compactor.is_alive():
+            return False
+        self._compactor = threading.Thread(target=self._compact_closed, name="archive-compact", daemon=True)
+        self._compactor.start()
+        return True
+
+    def _compact_closed(self):
+        conn = self._conn()
+        names = [r[0] for r in conn.execute("SELECT name FROM segments WHERE month < ? AND compacted = 0",
+                                             (archive_month(time.time()),))]
+        for name in names:
+            try:
+                self._compact_segment(name)
+            except Exception:
+                log.exception("archive: ошибка сжатия %s, сегмент сохранён", name)
+
+    def _compact_segment(self, name: str):
+        started = time.perf_counter()
+        with self._write_lock:
+            conn = self._conn()
+            month, generation = conn.execute("SELECT month, generation FROM segments WHERE name = ?",
+                                             (name,)).fetchone()
+            # живые копии: только те, на которые указывает индекс
+            members: Dict[Tuple[int, int], set] = {}
+            for did, offset, length in conn.execute(
+                    "SELECT id, offset, length FROM deals WHERE segment = ? ORDER BY offset", (name,)):
+                members.setdefault((offset, length), set()).add(did)
+            old = self.path / name
+            deals: List[Dict[str, Any]] = []
+            with open(old, "rb") as fh:
+                for (offset, length), ids in members.items():
+                    fh.seek(offset)
+                    for line in gzip.decompress(fh.read(length)).splitlines():
+                        deal = json.loads(line)
+                        if deal["id"] in ids:
+                            ids.discard(deal["id"])
+                            deals.append(deal)
+            new_name = segment_name(month, generation + 1)
+            rows = []
+            with open(self.path / new_name, "wb") as fh:
+                for i in range(0, len(deals), COMPACT_MEMBER_DEALS):
+                    chunk = deals[i:i + COMPACT_MEMBER_DEALS]
+                    member = _member(chunk, level=9)
+                    offset = fh.tell()
+                    fh.write(member)
+                    rows.extend((new_name, offset, len(member), d["id"]) for d in chunk)
+                fh.flush()
+                os.fsync(fh.fileno())
+            _fsync_dir(self.path)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT INTO segments (name, month, generation, compacted) VALUES (?, ?, ?, 1)",
+                             (new_name, month, generation + 1))
+                conn.executemany("UPDATE deals SET segment = ?, offset = ?, length = ? WHERE id = ?", rows)
+                conn.execute("DELETE FROM segments WHERE name = ?", (name,))
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            saved = old.stat().st_size - (self.path / new_name).stat().st_size
+            old.unlink(missing_ok=True)
+        with self._cache_lock:
+            for key in [k for k in self._cache if k[0] == name]:
+                del self._cache[key]
+        self._count(compactions=1, compacted_bytes_saved=saved, compact_seconds=time.perf_counter() - started)
+        log.info("archive: %s сжат в %s (%d сделок, -%d байт)", name, new_name, len(deals), saved)
+
+
+class DealArchiver:
+    # фоновый перенос сделок в терминальных статусах из Store в DealArchive;
+    # в кластере работает только в одном воркере
+    def __init__(self, store: Store, archive: DealArchive, interval: float = 600.0, batch_size: int = 500):
+        self.store = store
+        self.archive = archive
+        self.interval = interval
+        self.batch_size = batch_size
+        self._runner: Optional[asyncio.Task] = None
+        self.stats = {"runs": 0, "evicted": 0}
+
+    async def start(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.archive.remove_orphans)
+        self._runner = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                log.exception("archive: ошибка переноса сделок")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> int:
+        moved = 0
+        while True:
+            deals = await self.store.terminal_deals(self.batch_size)
+            if not deals:
+                break
+            await self.archive.append(deals)
+            evicted = await self.store.evict_deals([d["id"] for d in deals])
+            moved += evicted
+            if evicted == 0 or len(deals) < self.batch_size:
+                break
+        self.stats["runs"] += 1
+        self.stats["evicted"] += moved
+        if moved:
+            log.info("archive: перенесено сделок: %d", moved)
+        self.archive.compact()
+        return moved
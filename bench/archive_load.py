@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# bench/archive_load.py — время старта JsonStore в зависимости от длины истории
+#
+# Для каждого размера истории строим снапшот с открытыми, активными
+# и завершёнными сделками (открытых и активных — всегда одинаково) и меряем
+# загрузку JsonStore дважды: всё в снапшоте, как до архива, и после переноса
+# завершённых сделок в archive/ и сжатия журнала. Заодно — размер архива и время
+# поиска заархивированной сделки по номеру.
+#
+#   python bench/archive_load.py [размеры истории через запятую] [живых сделок]
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from archive import DealArchive, DealArchiver  # noqa: E402
+from snapshot import write_snapshot  # noqa: E402
+from storage import JsonStore  # noqa: E402
+
+USERS = 5000
+
+
+def make_deal(n: int, status: str):
+    seller = 1 + n % USERS
+    return {"id": f"#D{n}", "seller_id": seller, "seller_username": f"user{seller}", "type": "NFT",
+            "name": f"Подарок {n}", "description": "Коллекционный подарок", "price_minor": (10 + n % 90) * 10**6,
+            "buyer_id": None if status == "open" else seller + 1, "buyer_username": None,
+            "status": status, "escrow_minor": 0}
+
+
+def write_history(path: Path, history: int, live: int):
+    deals = {}
+    for n in range(history):
+        status = "completed" if n >= live else random.choice(("open", "in_process", "transferred"))
+        deals[f"#D{n}"] = make_deal(n, status)
+    users = {str(uid): {"balance_minor": 0, "username": f"user{uid}"} for uid in range(1, USERS + 2)}
+    write_snapshot(path.with_suffix(".snap"), {"users": users, "deals": deals, "chats": {}, "outbox": {},
+                                               "meta": {"ledger_version": 1}}, 0)
+
+
+def timed_load(path: Path, archive=None):
+    started = time.perf_counter()
+    store = JsonStore(path, archive=archive)
+    return store, time.perf_counter() - started
+
+
+def dir_bytes(path: Path, pattern: str) -> int:
+    return sum(p.stat().st_size for p in path.glob(pattern))
+
+
+async def run_one(history: int, live: int):
+    tmp = Path(tempfile.mkdtemp(prefix="gc-archive-"))
+    path = tmp / "data.json"
+    write_history(path, history, live)
+    snapshot_before = path.with_suffix(".snap").stat().st_size
+    store, before = timed_load(path)
+    await store.close()
+
+    archive = DealArchive(tmp / "archive")
+    store = JsonStore(path, archive=archive)
+    await store.start()
+    moved = await DealArchiver(store, archive).run_once()
+    # сжатие журнала в снапшот — как после обычной работы сервиса
+    store.journal.rotate_and_compact()
+    await store.close()
+
+    archive = DealArchive(tmp / "archive")
+    store, after = timed_load(path, archive)
+    probes = [f"#D{random.randrange(live, history)}" for _ in range(200)] if history > live else []
+    started = time.perf_counter()
+    for did in probes:
+        assert (await store.find_deal(did)) is not None
+    lookup = (time.perf_counter() - started) / max(1, len(probes))
+    await store.close()
+    await archive.close()
+    return (history, moved, before, snapshot_before, after, path.with_suffix(".snap").stat().st_size,
+            dir_bytes(tmp / "archive", "deals-*"), lookup)
+
+
+async def run(sizes, live: int):
+    print(f"живых сделок: {live}, пользователей: {USERS}")
+    print(f"{'история':>9}{'в архив':>9}{'старт до, с':>13}{'снапшот, КиБ':>14}"
+          f"{'старт после, с':>16}{'снапшот, КиБ':>14}{'архив, КиБ':>12}{'поиск, мс':>11}")
+    for history in sizes:
+        history, moved, before, snap_before, after, snap_after, archived, lookup = await run_one(history, live)
+        print(f"{history:>9}{moved:>9}{before:>13.3f}{snap_before / 1024:>14.0f}"
+              f"{after:>16.3f}{snap_after / 1024:>14.0f}{archived / 1024:>12.0f}{lookup * 1000:>11.2f}")
+
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in (sys.argv[1] if len(sys.argv) > 1 else "10000,50000,200000").split(",")]
+    live = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    asyncio.run(run(sizes, live))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# bench/deal_ids.py — старый случайный gen_deal_id против DealIdAllocator
+#
+# В хранилище заранее лежит много сделок; меряем время выдачи номера и число
+# коллизий. Старый генератор коллизии не проверял — здесь считаем, сколько
+# существующих сделок он бы молча перезаписал.
+#
+#   python bench/deal_ids.py [существующих сделок] [новых номеров]
+import asyncio
+import random
+import string
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from deal_ids import DealIdAllocator, KEYSPACE  # noqa: E402
+from storage import JsonStore  # noqa: E402
+
+
+def legacy_gen_deal_id() -> str:
+    # исходная реализация из main.py (без проверки занятости)
+    letter = random.choice(string.ascii_uppercase)
+    number = random.randint(1, 999999)
+    return f"#{letter}{number}"
+
+
+async def run(existing: int, fresh: int):
+    tmp = Path(tempfile.mkdtemp(prefix="gc-ids-"))
+    store = JsonStore(tmp / "data.json")
+    deals = store.data["deals"]
+    # история из случайных номеров, как их выдавал старый генератор
+    while len(deals) < existing:
+        did = f"#{random.choice(string.ascii_uppercase)}{random.randint(1, 999999)}"
+        deals[did] = {"id": did, "seller_id": 1, "buyer_id": None, "status": "completed"}
+    await store.start()
+
+    started = time.perf_counter()
+    collisions = 0
+    for _ in range(fresh):
+        if legacy_gen_deal_id() in deals:
+            collisions += 1
+    legacy = time.perf_counter() - started
+    print(f"старый генератор: {legacy / fresh * 1e6:.2f} мкс/номер, "
+          f"перезаписал бы {collisions} из {fresh} ({100 * collisions / fresh:.2f}%)")
+
+    allocator = DealIdAllocator(store, block=1000)
+    started = time.perf_counter()
+    issued = set()
+    for _ in range(fresh):
+        did = await allocator.allocate()
+        assert did not in deals and did not in issued, did
+        issued.add(did)
+    elapsed = time.perf_counter() - started
+    print(f"DealIdAllocator: {elapsed / fresh * 1e6:.2f} мкс/номер, коллизий 0, "
+          f"заполнено {100 * (existing + fresh) / KEYSPACE:.1f}% пространства номеров")
+    await store.close()
+
+
+if __name__ == "__main__":
+    existing = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    fresh = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    asyncio.run(run(existing, fresh))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# bench/fake_bot_api.py — локальная подделка Telegram Bot API для нагрузочных тестов
+#
+# aiohttp-сервер в формате https://api.telegram.org/bot<token>/<method>:
+# sendPhoto, sendMessage, editMessageCaption, answerCallbackQuery, answerInlineQuery,
+# getUpdates и служебные методы. Задержка и доля ошибок настраиваются
+# отдельно для каждого метода; ошибки — как у настоящего API (400 «message is
+# not modified», 429 с retry_after, 5xx). Всё отправленное запоминается по чатам,
+# чтобы сценарий мог прочитать, например, номер созданной сделки.
+#
+# Отдельный запуск — для ручной проверки бота в режиме polling:
+#   python bench/fake_bot_api.py [порт]
+#   BOT_TOKEN=1:x BOT_API_BASE=http://127.0.0.1:8081 python main.py
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Tuple
+
+from aiohttp import web
+
+MESSAGE_METHODS = ("sendPhoto", "sendMessage", "editMessageCaption")
+
+
+class MethodProfile:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+
+class FakeBotApi:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 profiles: Optional[Dict[str, MethodProfile]] = None, retry_after: int = 1):
+        self.default = MethodProfile(latency, jitter, error_rate)
+        self.profiles = profiles or {}
+        self.retry_after = retry_after
+        self._message_ids: Dict[int, int] = defaultdict(int)
+        self.sent: Dict[int, List[Tuple[str, Dict[str, Any]]]] = defaultdict(list)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self._updates: List[Dict[str, Any]] = []
+        self._update_id = 0
+        self._new_updates = asyncio.Event()
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner: Optional[web.AppRunner] = None
+
+    # ----- управление -----
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def push_update(self, update: Dict[str, Any]):
+        # для getUpdates: апдейт получает следующий update_id
+        self._update_id += 1
+        self._updates.append(dict(update, update_id=self._update_id))
+        self._new_updates.set()
+
+    def last_message_id(self, chat_id: int) -> int:
+        return self._message_ids[chat_id]
+
+    def last(self, chat_id: int, method: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        for sent_method, params in reversed(self.sent[chat_id]):
+            if method is None or sent_method == method:
+                return params
+        return None
+
+    # ----- ответы -----
+    @staticmethod
+    def _ok(result: Any) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    def _error(self, method: str) -> web.Response:
+        self.errors[method] += 1
+        roll = random.random()
+        if method == "editMessageCaption" and roll < 0.6:
+            return web.json_response({"ok": False, "error_code": 400,
+                                      "description": "Bad Request: message is not modified"}, status=400)
+        if roll < 0.8:
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                      "parameters": {"retry_after": self.retry_after}}, status=429)
+        return web.json_response({"ok": False, "error_code": 502, "description": "Bad Gateway"}, status=502)
+
+    def _message(self, chat_id: int, params: Dict[str, Any], message_id: Optional[int] = None) -> Dict[str, Any]:
+        if message_id is None:
+            self._message_ids[chat_id] += 1
+            message_id = self._message_ids[chat_id]
+        msg = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        if "caption" in params:
+            msg["caption"] = params["caption"]
+        if "text" in params:
+            msg["text"] = params["text"]
+        if "photo" in params:
+            msg["photo"] = [{"file_id": params["photo"], "file_unique_id": "u", "width": 1, "height": 1}]
+        return msg
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        profile = self.profiles.get(method, self.default)
+        if profile.latency or profile.jitter:
+            await asyncio.sleep(max(0.0, profile.latency + random.uniform(-profile.jitter, profile.jitter)))
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        if profile.error_rate and random.random() < profile.error_rate:
+            return self._error(method)
+        if method in MESSAGE_METHODS:
+            self.sent[chat_id].append((method, params))
+            message_id = int(params["message_id"]) if method == "editMessageCaption" else None
+            return self._ok(self._message(chat_id, params, message_id))
+        if method == "getMe":
+            return self._ok({"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"})
+        # answerCallbackQuery, answerInlineQuery, setWebhook, deleteWebhook, ...
+        return self._ok(True)
+
+    async def _get_updates(self, params: Dict[str, Any]) -> web.Response:
+        offset = int(params.get("offset") or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout=float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self._ok(self._updates[:limit])
+
+
+async def _serve(port: int):
+    api = FakeBotApi()
+    url = await api.start(port=port)
+    print(f"fake Bot API: {url}  (BOT_API_BASE={url})")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps({"calls": api.calls, "errors": api.errors}, ensure_ascii=False))
+        await api.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8081))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# bench/ledger_reconcile.py — сверка журнала проводок на миллионах записей
+#
+# Строит историю из сделок «пополнение /gb → резерв в эскроу → выплата продавцу»
+# (три проводки на сделку) с согласованными балансами и меряет для каждого
+# бэкенда старт хранилища и reconcile_ledger(): полный проход (json — по
+# колонкам сводки data.snap в потоке, sqlite — GROUP BY по покрывающим
+# индексам) и досчёт от checkpoint после ещё NEW_POSTINGS пополнений /gb.
+#
+#   python bench/ledger_reconcile.py [проводок] [пользователей]
+import asyncio
+import resource
+import sys
+import tempfile
+import time
+from collections.abc import Mapping
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ledger import (KIND_ADJUSTMENT, KIND_HOLD, KIND_RELEASE, OWNER_ACCOUNT, SCALE, user_account,  # noqa: E402
+                    escrow_account)
+from snapshot import write_snapshot  # noqa: E402
+from sqlite_store import SqliteStore, connect, init_schema  # noqa: E402
+from storage import JsonStore  # noqa: E402
+
+TS = 1700000000.0
+NEW_POSTINGS = 10_000
+
+
+def postings(n: int, users: int):
+    # (id, kind, debit, credit, amount, deal_id)
+    for i in range(n):
+        deal, step = divmod(i, 3)
+        deal_id = f"#D{deal}"
+        buyer = 1 + deal % users
+        seller = 1 + (deal * 7 + 3) % users
+        amount = (1 + deal % 90) * SCALE
+        if step == 0:
+            yield i + 1, KIND_ADJUSTMENT, OWNER_ACCOUNT, user_account(buyer), amount, None
+        elif step == 1:
+            yield i + 1, KIND_HOLD, user_account(buyer), escrow_account(deal_id), amount, deal_id
+        else:
+            yield i + 1, KIND_RELEASE, escrow_account(deal_id), user_account(seller), amount, deal_id
+
+
+def balances(n: int, users: int):
+    out = {uid: 0 for uid in range(1, users + 1)}
+    for _id, _kind, debit, credit, amount, _deal in postings(n, users):
+        for account, delta in ((debit, -amount), (credit, amount)):
+            if account.startswith("user:"):
+                out[int(account[5:])] += delta
+    return out
+
+
+class Ledger(Mapping):
+    # раздел ledger, проводки создаются на лету при записи снапшота
+    def __init__(self, n: int, users: int):
+        self.n = n
+        self.users = users
+
+    def __iter__(self):
+        return (f"{i:012d}" for i in range(1, self.n + 1))
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, key):
+        raise KeyError(key)
+
+    def items(self):
+        for entry_id, kind, debit, credit, amount, deal_id in postings(self.n, self.users):
+            yield f"{entry_id:012d}", {"kind": kind, "debit": debit, "credit": credit, "amount": amount,
+                                       "deal_id": deal_id, "id": entry_id, "ts": TS}
+
+
+def peak_mib() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def bench_json(tmp: Path, n: int, users: int, cached):
+    path = tmp / "data.json"
+    write_snapshot(path.with_suffix(".snap"), {
+        "users": {str(uid): {"balance_minor": b, "username": None} for uid, b in cached.items()},
+        "deals": {}, "chats": {}, "outbox": {}, "meta": {"ledger_version": 1, "ledger_seq": n},
+        "ledger": Ledger(n, users),
+    }, 0)
+    started = time.perf_counter()
+    store = JsonStore(path)
+    loaded = time.perf_counter() - started
+    await store.start()
+    timings = await reconcile_twice(store, users)
+    await store.close()
+    return (loaded,) + timings + (path.with_suffix(".snap").stat().st_size,)
+
+
+async def bench_sqlite(tmp: Path, n: int, users: int, cached):
+    path = tmp / "data.sqlite3"
+    conn = connect(path)
+    init_schema(conn)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO ledger (id, ts, kind, debit, credit, amount, deal_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     ((i, TS, kind, d, c, a, deal) for i, kind, d, c, a, deal in postings(n, users)))
+    conn.executemany("INSERT INTO users (id, balance_minor) VALUES (?, ?)", cached.items())
+    conn.execute("INSERT INTO meta (name, value) VALUES ('ledger_version', 1)")
+    conn.execute("COMMIT")
+    conn.close()
+    started = time.perf_counter()
+    store = SqliteStore(path)
+    loaded = time.perf_counter() - started
+    timings = await reconcile_twice(store, users)
+    await store.close()
+    return (loaded,) + timings + (path.stat().st_size,)
+
+
+async def reconcile_twice(store, users: int):
+    # полная сверка, NEW_POSTINGS новых проводок, досчёт от checkpoint
+    started = time.perf_counter()
+    report = await store.reconcile_ledger()
+    full = time.perf_counter() - started
+    assert report["ok"], report
+    # одновременно — журнал JsonStore сбрасывает их общими пачками
+    await asyncio.gather(*(store.adjust_balance(1 + i % users, SCALE) for i in range(NEW_POSTINGS)))
+    started = time.perf_counter()
+    incremental = await store.reconcile_ledger(checkpoint=report["checkpoint"])
+    tail = time.perf_counter() - started
+    assert incremental["ok"] and incremental["entries"] == report["entries"] + NEW_POSTINGS, incremental
+    return full, tail
+
+
+async def run(n: int, users: int):
+    tmp = Path(tempfile.mkdtemp(prefix="gc-ledger-"))
+    started = time.perf_counter()
+    cached = balances(n, users)
+    print(f"проводок: {n}, пользователей: {users}; каталог {tmp}")
+    print(f"{'бэкенд':<8}{'файл, МиБ':>11}{'старт, с':>10}{'полная, с':>11}{'проводок/с':>12}"
+          f"{'досчёт, мс':>12}{'пик RSS, МиБ':>14}")
+    for name, fn in (("json", bench_json), ("sqlite", bench_sqlite)):
+        loaded, full, tail, size = await fn(tmp, n, users, cached)
+        print(f"{name:<8}{size / 2**20:>11.1f}{loaded:>10.2f}{full:>11.2f}{n / full:>12.0f}"
+              f"{tail * 1000:>12.1f}{peak_mib():>14.0f}")
+    print(f"всего {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 3_000_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 50_000
+    asyncio.run(run(n, users))
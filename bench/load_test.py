@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# bench/load_test.py — нагрузочный прогон настоящих хендлеров main.py
+#
+# Бот работает против bench/fake_bot_api.py, апдейты подаются в dp так же,
+# как их подаёт webhook (feed_raw_update). Каждая пара пользователей проходит
+# полный цикл: мастер продавца → пополнение баланса (/gb от владельца) →
+# вход покупателя → «Товар передан» → подтверждение получения.
+# С --taps N каждое нажатие кнопки приходит N раз подряд (двойные тапы) —
+# лишние копии должен отсечь ThrottleMiddleware (throttle.py).
+# Отчёт: апдейтов в секунду, p50/p99 времени обработки по шагам, прирост RSS,
+# размер файлов хранилища по ходу прогона.
+#
+#   python bench/load_test.py [--pairs 1000] [--concurrency 200] [--backend json|sqlite]
+#                             [--latency 0.02] [--jitter 0.01] [--error-rate 0.01] [--taps 1]
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+# корень репозитория — раньше bench/: там свои deal_ids.py и т.п.
+sys.path.insert(0, str(ROOT))
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+DEAL_CREATED_RE = re.compile(r"Сделка (#[A-Z]\d+) успешно создана")
+SELLER_BASE = 10_000_000
+BUYER_BASE = 20_000_000
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def storage_bytes(workdir: Path) -> int:
+    # снапшот + сегменты журнала или файлы SQLite (с -wal), плюс FSM
+    return sum(p.stat().st_size for p in workdir.iterdir()
+               if p.name.startswith(("data.snap", "data.wal", "gift_castle.sqlite3", "fsm.sqlite3")))
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Scenario:
+    def __init__(self, main, api: FakeBotApi, workdir: Path, taps: int = 1):
+        self.main = main
+        self.taps = taps
+        self.api = api
+        self.workdir = workdir
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.updates = 0
+        self.completed = 0
+        self.failed = 0
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    # ----- апдейты -----
+    @staticmethod
+    def _user(uid: int) -> Dict[str, Any]:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+
+    def _message(self, uid: int, text: str) -> Dict[str, Any]:
+        msg = {"message_id": next(self._message_ids), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": self._user(uid), "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": msg}
+
+    def _callback(self, uid: int, data: str) -> Dict[str, Any]:
+        # кнопка — под последним сообщением бота в этом чате
+        message_id = self.api.last_message_id(uid) or next(self._message_ids)
+        return {"update_id": next(self._update_ids), "callback_query": {
+            "id": str(next(self._update_ids)), "from": self._user(uid), "chat_instance": str(uid), "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"}},
+        }}
+
+    async def _feed(self, step: str, update: Dict[str, Any]):
+        started = time.perf_counter()
+        await self.main.dp.feed_raw_update(self.main.bot, update)
+        self.latency[step].append(time.perf_counter() - started)
+        self.updates += 1
+
+    async def text(self, step: str, uid: int, text: str):
+        await self._feed(step, self._message(uid, text))
+
+    async def tap(self, step: str, uid: int, data: str):
+        await asyncio.gather(*(self._feed(step, self._callback(uid, data)) for _ in range(self.taps)))
+
+    # ----- полный цикл сделки -----
+    async def pair(self, n: int):
+        seller, buyer = SELLER_BASE + n, BUYER_BASE + n
+        for uid in (seller, buyer):
+            await self.text("cmd_start", uid, "/start")
+            await self.tap("start_continue", uid, "start_continue")
+            await self.tap("create_deal", uid, "create_deal")
+        await self.tap("role_seller", seller, "role_seller")
+        await self.tap("seller_start", seller, "seller_start")
+        await self.text("seller_type", seller, "NFT")
+        await self.text("seller_name", seller, f"Подарок {n}")
+        await self.text("seller_description", seller, "Коллекционный подарок")
+        await self.text("seller_price", seller, str(10 + n % 90))
+        created = self.api.last(seller, "sendPhoto")
+        match = DEAL_CREATED_RE.search(created["caption"]) if created else None
+        if match is None:
+            self.failed += 1
+            return
+        deal_id = match.group(1)
+        await self.text("cmd_gb", self.main.OWNER_ID, f"/gb {buyer} 100")
+        await self.tap("role_buyer", buyer, "role_buyer")
+        await self.text("buyer_deal_id", buyer, deal_id)
+        await self.tap("buyer_continue", buyer, "deal_continue")
+        await self.tap("seller_transferred", seller, f"item_transferred:{deal_id}")
+        await self.tap("buyer_confirm", buyer, f"buyer_confirm_receive:{deal_id}")
+        deal = await self.main.STORE.find_deal(deal_id)
+        if deal is not None and deal["status"] == "completed":
+            self.completed += 1
+        else:
+            self.failed += 1
+
+
+async def sample(scenario: Scenario, samples: List[Any], started: float, interval: float = 1.0):
+    while True:
+        samples.append((time.perf_counter() - started, scenario.updates, rss_bytes(), storage_bytes(scenario.workdir)))
+        await asyncio.sleep(interval)
+
+
+async def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix="gc-load-"))
+    api = FakeBotApi(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    base = await api.start()
+    # main.py читает настройки из окружения и пишет файлы в текущий каталог
+    os.environ.update(BOT_TOKEN="123456:LOADTEST", BOT_API_BASE=base, STORAGE_BACKEND=args.backend)
+    # сценарий жмёт кнопки быстрее человека — общий лимит действий пользователя не мешает прогону
+    os.environ.setdefault("THROTTLE_RATE", "1000")
+    os.environ.setdefault("THROTTLE_BURST", "1000")
+    os.chdir(workdir)
+    import main
+    # по строке лога на каждый запрос и апдейт — это уже отдельная нагрузка
+    for name in ("aiohttp.access", "aiogram.event"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    await main.on_startup()
+    scenario = Scenario(main, api, workdir, taps=args.taps)
+    rss_before = rss_bytes()
+    samples: List[Any] = []
+    started = time.perf_counter()
+    sampler = asyncio.create_task(sample(scenario, samples, started))
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def one(n: int):
+        async with slots:
+            try:
+                await scenario.pair(n)
+            except Exception as e:
+                # ошибка API, которую хендлер не обработал, обрывает цикл этой пары
+                scenario.failed += 1
+                scenario.errors[type(e).__name__] += 1
+
+    await asyncio.gather(*(one(n) for n in range(args.pairs)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    samples.append((elapsed, scenario.updates, rss_bytes(), storage_bytes(workdir)))
+    outbox_depth = main.OUTBOX.depth
+    ledger = await main.STORE.reconcile_ledger()
+    await main.SCHEDULER.stop()
+    await main.OUTBOX.stop()
+    await main.ARCHIVER.stop()
+    await main.RECONCILER.stop()
+    await main.STORE.close()
+    await main.ARCHIVE.close()
+    await main.FSM_STORAGE.close()
+    await main.bot.session.close()
+    await api.stop()
+
+    all_latency = [v for values in scenario.latency.values() for v in values]
+    print(f"backend={args.backend} pairs={args.pairs} concurrency={args.concurrency} "
+          f"api_latency={args.latency}s error_rate={args.error_rate} taps={args.taps}")
+    print(f"сделок завершено: {scenario.completed}, сбоев: {scenario.failed} {dict(scenario.errors)}, "
+          f"outbox в очереди: {outbox_depth}")
+    print(f"подавлено до хендлера: дублей {main.THROTTLE.stats['duplicates']}, "
+          f"сверх лимита {main.THROTTLE.stats['throttled']}")
+    print(f"журнал проводок: {ledger['entries']} проводок, сходится с балансами: {'да' if ledger['ok'] else 'НЕТ'}")
+    print(f"апдейтов: {scenario.updates} за {elapsed:.2f} с — {scenario.updates / elapsed:.0f} апдейтов/с")
+    print(f"время обработки: p50 {percentile(all_latency, 0.5) * 1000:.1f} мс, "
+          f"p99 {percentile(all_latency, 0.99) * 1000:.1f} мс")
+    print(f"{'шаг':<20}{'n':>8}{'p50, мс':>10}{'p99, мс':>10}")
+    for step, values in scenario.latency.items():
+        print(f"{step:<20}{len(values):>8}{percentile(values, 0.5) * 1000:>10.1f}{percentile(values, 0.99) * 1000:>10.1f}")
+    print(f"RSS: {rss_before / 2**20:.1f} → {rss_bytes() / 2**20:.1f} МиБ")
+    print(f"{'t, с':>8}{'апдейтов':>10}{'RSS, МиБ':>10}{'хранилище, КиБ':>16}")
+    for t, updates, rss, size in samples:
+        print(f"{t:>8.1f}{updates:>10}{rss / 2**20:>10.1f}{size / 1024:>16.1f}")
+    print(f"вызовы API: {dict(api.calls)}; ошибки: {dict(api.errors)}")
+    print(f"данные: {workdir}")
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    p = argparse.ArgumentParser(description="Нагрузочный прогон хендлеров Gift Castle против fake Bot API")
+    p.add_argument("--pairs", type=int, default=1000, help="пар продавец/покупатель")
+    p.add_argument("--concurrency", type=int, default=200, help="пар, идущих одновременно")
+    p.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    p.add_argument("--latency", type=float, default=0.02, help="задержка ответа fake API, с")
+    p.add_argument("--jitter", type=float, default=0.01, help="разброс задержки, с")
+    p.add_argument("--error-rate", type=float, default=0.0, help="доля ответов-ошибок")
+    p.add_argument("--taps", type=int, default=1, help="копий каждого нажатия кнопки")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
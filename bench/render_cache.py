@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# bench/render_cache.py — стоимость рендера подписей/клавиатур до и после кеша
+#
+# «до» — исходная функция (fn.__wrapped__, без lru_cache), «после» — кешированная.
+# Для каждой меряем время вызова и объём выделенной памяти (tracemalloc).
+#
+#   python bench/render_cache.py [итераций]
+import os
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.chdir(tempfile.mkdtemp(prefix="gc-render-"))  # main.py открывает хранилище в cwd
+
+import main  # noqa: E402
+from ledger import SCALE  # noqa: E402
+
+# параметры «горячего» набора: одни и те же сделки показываются многим пользователям
+DEALS = [(f"#B{i}", "seller", f"Товар {i}", "Описание товара " * 4, (100 + i) * SCALE) for i in range(50)]
+ARGS = {
+    "kb_after_create_to_share": [(d[0],) for d in DEALS],
+    "kb_in_process_for_seller": [(d[0],) for d in DEALS],
+    "kb_wait_buyer_confirm": [(d[0],) for d in DEALS],
+    "start_welcome_text": [(f"@user{i}",) for i in range(50)],
+    "deal_summary_text": DEALS,
+    "inline_deal_result": [(d[0], d[2], d[4]) for d in DEALS],
+}
+
+
+def measure(fn, arg_sets, number: int):
+    calls = [(fn, a) for a in arg_sets] or [(fn, ())]
+
+    def run():
+        for f, a in calls:
+            f(*a)
+
+    run()  # прогрев (для кешированной версии — заполнение кеша)
+    per_call = timeit.timeit(run, number=number) / (number * len(calls))
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(10):
+        run()
+    allocated = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return per_call * 1e6, allocated / (10 * len(calls))
+
+
+def main_bench(number: int):
+    print(f"{'функция':32} {'до, мкс':>9} {'после, мкс':>11} {'до, Б':>9} {'после, Б':>9}")
+    total_before = total_after = 0.0
+    for fn in main.RENDER_STATIC + main.RENDER_PARAMETRIZED:
+        args = ARGS.get(fn.__name__, [()])
+        t0, m0 = measure(fn.__wrapped__, args, number)
+        t1, m1 = measure(fn, args, number)
+        total_before += t0
+        total_after += t1
+        print(f"{fn.__name__:32} {t0:9.2f} {t1:11.2f} {m0:9.0f} {m1:9.0f}")
+    print(f"{'итого на набор':32} {total_before:9.2f} {total_after:11.2f}")
+
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# bench/snapshot_load.py — старт с JSON-снапшота против двоичного data.snap
+#
+# Генерирует одно и то же состояние в двух форматах (потоково, без сборки
+# всего состояния в памяти) и в отдельном процессе на каждый замер меряет
+# время старта и пиковый RSS:
+#   json — прежний путь: json.loads всего data.json + построение индексов сделок;
+#   snap — JsonStore поверх data.snap: пользователи и индекс сделок сразу,
+#          тела сделок и чатов — по первому обращению.
+#
+#   python bench/snapshot_load.py [сделок] [пользователей]
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Mapping
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+STATUSES = ("open", "in_process", "transferred", "completed", "completed", "completed")
+
+
+def make_deal(n: int, users: int):
+    seller = 1 + n % users
+    status = STATUSES[n % len(STATUSES)]
+    return {"id": f"#D{n}", "seller_id": seller, "seller_username": f"user{seller}", "type": "NFT",
+            "name": f"Подарок {n}", "description": "Коллекционный подарок", "price_minor": (10 + n % 90) * 10**6,
+            "buyer_id": None if status == "open" else 1 + (n * 7) % users, "buyer_username": None,
+            "status": status, "escrow_minor": 0}
+
+
+class Generated(Mapping):
+    # раздел, значения которого создаются на лету при записи
+    def __init__(self, count: int, make):
+        self.count = count
+        self.make = make
+
+    def __iter__(self):
+        return (self.key(n) for n in range(self.count))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, key):
+        return self.make(int(key.lstrip("#D")))
+
+    def key(self, n: int) -> str:
+        return f"#D{n}" if self.make is not chat else str(n)
+
+
+def chat(n: int):
+    return {"last_message_id": n, "kind": "photo", "hash": None, "sent_at": 1700000000.0}
+
+
+def write_json(path: Path, deals: int, users: int):
+    dumps = lambda o: json.dumps(o, ensure_ascii=False, separators=(",", ":"))  # noqa: E731
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write('{"users":')
+        fh.write(dumps({str(u): {"balance_minor": 0, "username": f"user{u}"} for u in range(1, users + 1)}))
+        fh.write(',"deals":{')
+        for n in range(deals):
+            fh.write(("," if n else "") + dumps(f"#D{n}") + ":" + dumps(make_deal(n, users)))
+        fh.write('},"chats":{')
+        for n in range(users):
+            fh.write(("," if n else "") + dumps(str(n)) + ":" + dumps(chat(n)))
+        fh.write('},"outbox":{},"meta":{"ledger_version":1},"_meta":{"seq":0}}')
+
+
+def write_snap(path: Path, deals: int, users: int):
+    from snapshot import write_snapshot
+    write_snapshot(path, {
+        "users": {str(u): {"balance_minor": 0, "username": f"user{u}"} for u in range(1, users + 1)},
+        "deals": Generated(deals, lambda n: make_deal(n, users)),
+        "chats": Generated(users, chat),
+        "outbox": {}, "meta": {"ledger_version": 1},
+    }, 0)
+
+
+def measure(mode: str, path: str):
+    # выполняется в дочернем процессе
+    from journal import Journal
+    from storage import JsonStore, DealIndex, OpenDealSearchIndex
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    if mode == "json":
+        data, _ = Journal(Path(path))._read_snapshot()
+        DealIndex().rebuild(data["deals"])
+        OpenDealSearchIndex().rebuild(data["deals"])
+    else:
+        JsonStore(Path(path))
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"seconds": elapsed, "baseline_kib": baseline, "peak_kib": peak}))
+
+
+def run(deals: int, users: int):
+    tmp = Path(tempfile.mkdtemp(prefix="gc-snap-"))
+    (tmp / "json").mkdir()
+    (tmp / "snap").mkdir()
+    started = time.perf_counter()
+    write_json(tmp / "json" / "data.json", deals, users)
+    write_snap(tmp / "snap" / "data.snap", deals, users)
+    print(f"сделок: {deals}, пользователей и чатов: {users}; данные сгенерированы за "
+          f"{time.perf_counter() - started:.1f} с в {tmp}")
+    print(f"{'формат':<8}{'файл, МиБ':>11}{'старт, с':>10}{'пик RSS, МиБ':>14}{'прирост, МиБ':>14}")
+    for mode, name in (("json", "data.json"), ("snap", "data.snap")):
+        out = subprocess.run([sys.executable, __file__, "--measure", mode, str(tmp / mode / "data.json")],
+                             check=True, capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        size = (tmp / mode / name).stat().st_size
+        print(f"{mode:<8}{size / 2**20:>11.1f}{result['seconds']:>10.2f}{result['peak_kib'] / 1024:>14.0f}"
+              f"{(result['peak_kib'] - result['baseline_kib']) / 1024:>14.0f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3])
+    else:
+        deals = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+        users = int(sys.argv[2]) if len(sys.argv) > 2 else deals // 4
+        run(deals, users)
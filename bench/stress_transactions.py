@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# bench/stress_transactions.py — нагрузочная проверка атомарных переходов сделок
+#
+# Тысячи одновременных нажатий (двойные тапы, несколько покупателей на одну
+# сделку, повторные подтверждения, старые кнопки без номера сделки) проходят
+# через настоящие хендлеры main.py — dp.feed_raw_update против
+# bench/fake_bot_api.py, — так что проверяется и порядок блокировок в
+# buyer_continue_cb, seller_transferred_cb и buyer_confirm_cb. Затем инварианты:
+# деньги не появляются и не исчезают, у сделки один покупатель, балансы не
+# уходят в минус, каждая сделка передана и завершена ровно один раз, индексы
+# согласованы, журнал проводок сходится с балансами (reconcile_ledger).
+# ThrottleMiddleware отключён: иначе он отсёк бы повторные тапы до хендлеров.
+#
+#   python bench/stress_transactions.py [json|sqlite] [сделок] [покупателей]
+import asyncio
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+# корень репозитория — раньше bench/: там свои deal_ids.py и т.п.
+sys.path.insert(0, str(ROOT))
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+from ledger import SCALE  # noqa: E402
+from load_test import Scenario, DEAL_CREATED_RE  # noqa: E402
+
+SELLER_BASE = 10_000_000
+BUYER_BASE = 20_000_000
+N_SELLERS = 50
+BUYER_FUNDS = 100  # пополнение каждого покупателя через /gb
+JOIN_ROUNDS = 4  # раундов, в которых каждый покупатель пытается войти в случайную сделку
+TRANSFERRED_RE = re.compile(r"Вы подтвердили передачу товара по сделке (#[A-Z]\d+)")
+COMPLETED_RE = re.compile(r"Сделка (#[A-Z]\d+) завершена!")
+
+
+async def run(backend: str, n_deals: int, n_buyers: int):
+    workdir = Path(tempfile.mkdtemp(prefix="gc-stress-"))
+    api = FakeBotApi()
+    base = await api.start()
+    # main.py читает настройки из окружения и пишет файлы в текущий каталог
+    os.environ.update(BOT_TOKEN="123456:STRESS", BOT_API_BASE=base, STORAGE_BACKEND=backend,
+                      CALLBACK_DEDUP_WINDOW="0", ARCHIVE_INTERVAL="0", LEDGER_RECONCILE_INTERVAL="0")
+    os.chdir(workdir)
+    import main
+    from throttle import Limit
+    main.THROTTLE.limits = {group: Limit(1e9, 1e9) for group in main.THROTTLE.limits}
+    for name in ("aiohttp.access", "aiogram.event"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    await main.on_startup()
+    sc = Scenario(main, api, workdir)
+    sellers = [SELLER_BASE + i for i in range(N_SELLERS)]
+    buyers = [BUYER_BASE + i for i in range(n_buyers)]
+
+    # подготовка: сделки — мастером продавца, деньги покупателям — /gb владельца
+    async def create_deals(seller: int, count: int):
+        for _ in range(count):
+            await sc.tap("seller", seller, "role_seller")
+            await sc.tap("seller", seller, "seller_start")
+            for text in ("NFT", f"Подарок {seller}", "Коллекционный подарок", str(random.randint(1, 30))):
+                await sc.text("seller", seller, text)
+            deal_ids.append(DEAL_CREATED_RE.search(api.last(seller, "sendPhoto")["caption"]).group(1))
+
+    deal_ids = []
+    per_seller, extra = divmod(n_deals, N_SELLERS)
+    await asyncio.gather(*(create_deals(s, per_seller + (i < extra)) for i, s in enumerate(sellers)))
+    for uid in buyers:
+        await sc.text("gb", main.OWNER_ID, f"/gb {uid} {BUYER_FUNDS}")
+    initial_total = BUYER_FUNDS * SCALE * n_buyers
+    updates_before = sc.updates
+
+    started = time.perf_counter()
+    # каждый раунд: все покупатели выбирают сделку, затем одновременно жмут «Продолжить»,
+    # часть — дважды; на одну сделку нередко претендуют несколько покупателей
+    for _ in range(JOIN_ROUNDS):
+        async def enter(uid: int):
+            await sc.tap("role_buyer", uid, "role_buyer")
+            await sc.text("buyer_deal_id", uid, random.choice(deal_ids))
+        await asyncio.gather(*(enter(uid) for uid in buyers))
+        taps = [sc.tap("buyer_continue", uid, "deal_continue") for uid in buyers for _ in range(random.choice((1, 2)))]
+        random.shuffle(taps)
+        await asyncio.gather(*taps)
+
+    # «Товар Передан»: двойные тапы по кнопке сделки и старая кнопка без номера
+    deals = {d: await main.STORE.find_deal(d) for d in deal_ids}
+    taps = [sc.tap("seller_transferred", d["seller_id"], f"item_transferred:{d['id']}")
+            for d in deals.values() if d["status"] == "in_process" for _ in range(2)]
+    taps += [sc.tap("seller_transferred", uid, "item_transferred") for uid in sellers]
+    random.shuffle(taps)
+    await asyncio.gather(*taps)
+
+    # «Я получил товар»: тройные тапы
+    deals = {d: await main.STORE.find_deal(d) for d in deal_ids}
+    taps = [sc.tap("buyer_confirm", d["buyer_id"], f"buyer_confirm_receive:{d['id']}")
+            for d in deals.values() if d["status"] == "transferred" for _ in range(3)]
+    random.shuffle(taps)
+    await asyncio.gather(*taps)
+    elapsed = time.perf_counter() - started
+    n_updates = sc.updates - updates_before
+
+    await main.OUTBOX.stop()
+    total = 0
+    escrow = 0
+    for uid in set(buyers) | set(sellers):
+        balance = (await main.STORE.get_user(uid))["balance_minor"]
+        assert balance >= 0, f"отрицательный баланс у {uid}: {balance}"
+        total += balance
+    deals = {d: await main.STORE.find_deal(d) for d in deal_ids}
+    for deal in deals.values():
+        escrow += deal.get("escrow_minor", 0)
+        assert deal["status"] in ("open", "completed"), deal
+        assert (deal["status"] == "open") == (deal["buyer_id"] is None), deal
+    assert total + escrow == initial_total, (total, escrow, initial_total)
+    # повторный тап не должен ни второй раз перевести сделку, ни второй раз зачислить деньги
+    transferred = Counter(m.group(1) for chat in sellers for _, p in api.sent[chat]
+                          if (m := TRANSFERRED_RE.search(p.get("text", ""))))
+    completed = Counter(m.group(1) for chat in buyers for _, p in api.sent[chat]
+                        if (m := COMPLETED_RE.search(p.get("caption", ""))))
+    done = {d for d, deal in deals.items() if deal["status"] == "completed"}
+    assert set(transferred) == done and set(transferred.values()) <= {1}, transferred.most_common(3)
+    assert set(completed) == done and set(completed.values()) <= {1}, completed.most_common(3)
+    report = await main.STORE.reconcile_ledger()
+    assert report["ok"], report
+    problems = await main.STORE.check_indexes()
+    assert not problems, problems[:5]
+    assert len(main.LOCKS) == 0, "блокировки не освобождены"
+
+    await main.SCHEDULER.stop()
+    await main.ARCHIVER.stop()
+    await main.RECONCILER.stop()
+    await main.STORE.close()
+    await main.ARCHIVE.close()
+    await main.FSM_STORAGE.close()
+    await main.bot.session.close()
+    await api.stop()
+    print(f"{backend}: {n_updates} нажатий за {elapsed:.2f} с ({n_updates / elapsed:.0f}/с), "
+          f"завершено {len(done)} из {len(deal_ids)} сделок, инварианты соблюдены")
+
+
+if __name__ == "__main__":
+    backend = sys.argv[1] if len(sys.argv) > 1 else "json"
+    n_deals = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    n_buyers = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    asyncio.run(run(backend, n_deals, n_buyers))
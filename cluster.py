@@ -0,0 +1,234 @@
+# cluster.py — несколько процессов-воркеров с общим состоянием в SQLite
+#
+# Координатор (BOT_MODE=polling|webhook при WORKERS > 1) сам получает апдейты
+# и раскладывает их по воркерам по user_id: апдейты одного пользователя всегда
+# попадают в один процесс и обрабатываются там строго по очереди, разные
+# пользователи — параллельно, в разных процессах и на разных ядрах.
+#
+# Воркер — тот же main.py с BOT_MODE=worker: апдейты приходят JSON-строками
+# в stdin, EOF означает остановку. Общее состояние — SQLite (WAL, BEGIN IMMEDIATE),
+# поэтому режим работает только с STORAGE_BACKEND=sqlite. Упавший воркер
+# перезапускается с тем же номером и подхватывает свои недоставленные уведомления.
+# Координатор получает апдейты через lifecycle.Poller/WebhookServer так же, как
+# одиночный процесс: route() — обработчик его UpdateRunner, а offset и ещё не
+# обработанные воркерами апдейты переживают рестарт.
+# Обработанный апдейт воркер подтверждает строкой с update_id в отдельный pipe
+# (WORKER_ACK_FD). route() завершается только после подтверждения, поэтому до
+# него апдейт остаётся в pending координатора. Упал воркер — всё, что ему
+# передано и не подтверждено, уходит перезапущенному воркеру заново, по порядку update_id.
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sys
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from aiogram import Bot, Dispatcher
+
+log = logging.getLogger(__name__)
+
+# типы апдейтов, у которых есть отправитель
+_SENDER_FIELDS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                  "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+                  "chat_join_request")
+
+READ_LIMIT = 1 << 20  # байт на одну строку апдейта
+
+
+def update_shard_key(update: Dict[str, Any]) -> int:
+    # user_id отправителя; если его нет — чат; в крайнем случае — сам update_id
+    for field in _SENDER_FIELDS:
+        obj = update.get(field)
+        if not obj:
+            continue
+        sender = obj.get("from") or obj.get("user")
+        if sender:
+            return sender["id"]
+        chat = obj.get("chat") or (obj.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return update.get("update_id", 0)
+
+
+def shard_of(key: int, workers: int) -> int:
+    return key % workers
+
+
+class Coordinator:
+    def __init__(self, argv: List[str], workers: int, restart_delay: float = 1.0):
+        self.argv = argv
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self._procs: List[Optional[asyncio.subprocess.Process]] = [None] * workers
+        self._ready = [asyncio.Event() for _ in range(workers)]
+        # переданные воркеру и ещё не подтверждённые: update_id -> (строка, future подтверждения)
+        self._unacked: List[Dict[int, Tuple[bytes, asyncio.Future]]] = [{} for _ in range(workers)]
+        self._supervisors: List[asyncio.Task] = []
+        self._stopping = False
+        self.stats = {"routed": 0, "acked": 0, "resent": 0, "restarts": 0}
+
+    async def _spawn(self, idx: int) -> Tuple[asyncio.subprocess.Process, asyncio.Task]:
+        ack_read, ack_write = os.pipe()
+        env = dict(os.environ, BOT_MODE="worker", WORKER_INDEX=str(idx), WORKER_COUNT=str(self.workers),
+                   WORKER_ACK_FD=str(ack_write))
+        try:
+            proc = await asyncio.create_subprocess_exec(*self.argv, stdin=asyncio.subprocess.PIPE, env=env,
+                                                        pass_fds=(ack_write,))
+        except BaseException:
+            os.close(ack_read)
+            raise
+        finally:
+            # пишущий конец остаётся только у воркера: его выход — EOF для читателя подтверждений
+            os.close(ack_write)
+        reader = asyncio.StreamReader()
+        await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                           os.fdopen(ack_read, "rb", 0))
+        acks = asyncio.create_task(self._read_acks(idx, reader))
+        self._procs[idx] = proc
+        # неподтверждённые прежним воркером — первыми и по порядку, до новых апдейтов
+        unacked = self._unacked[idx]
+        for update_id in sorted(unacked):
+            self._write(proc, unacked[update_id][0])
+            self.stats["resent"] += 1
+        self._ready[idx].set()
+        log.info("cluster: воркер %d запущен (pid %d), повторно передано %d апдейтов", idx, proc.pid, len(unacked))
+        return proc, acks
+
+    async def _read_acks(self, idx: int, reader: asyncio.StreamReader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            item = self._unacked[idx].get(int(line))
+            if item is not None and not item[1].done():
+                item[1].set_result(None)
+                self.stats["acked"] += 1
+
+    async def _supervise(self, idx: int):
+        while not self._stopping:
+            proc, acks = await self._spawn(idx)
+            code = await proc.wait()
+            self._ready[idx].clear()
+            # подтверждения, успевшие уйти до выхода, не повторяются
+            await acks
+            if self._stopping:
+                return
+            self.stats["restarts"] += 1
+            log.error("cluster: воркер %d завершился с кодом %s, перезапуск", idx, code)
+            await asyncio.sleep(self.restart_delay)
+
+    async def start(self):
+        self._supervisors = [asyncio.create_task(self._supervise(i)) for i in range(self.workers)]
+        await asyncio.gather(*(ev.wait() for ev in self._ready))
+
+    @staticmethod
+    def _write(proc: asyncio.subprocess.Process, line: bytes):
+        try:
+            proc.stdin.write(line)
+        except (BrokenPipeError, ConnectionResetError):
+            # воркер уже упал — строку передаст заново _spawn перезапущенному
+            pass
+
+    async def route(self, update: Dict[str, Any]):
+        # до первого await: строки уходят воркеру в порядке вызовов route
+        idx = shard_of(update_shard_key(update), self.workers)
+        update_id = update["update_id"]
+        line = (json.dumps(update, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        acked = asyncio.get_running_loop().create_future()
+        self._unacked[idx][update_id] = (line, acked)
+        self.stats["routed"] += 1
+        try:
+            # пока воркер перезапускается, апдейты его пользователей ждут его, а не уходят другому
+            proc = self._procs[idx]
+            if self._ready[idx].is_set():
+                self._write(proc, line)
+                with contextlib.suppress(BrokenPipeError, ConnectionResetError):
+                    await proc.stdin.drain()
+            await acked
+        finally:
+            self._unacked[idx].pop(update_id, None)
+
+    async def stop(self, timeout: float = 30.0):
+        # EOF в stdin: воркер дорабатывает принятые апдейты и выходит сам
+        self._stopping = True
+        procs = [p for p in self._procs if p is not None and p.returncode is None]
+        for proc in procs:
+            proc.stdin.close()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in procs)), timeout)
+        except asyncio.TimeoutError:
+            log.warning("cluster: воркеры не остановились за %s с, завершаем принудительно", timeout)
+            for proc in procs:
+                if proc.returncode is None:
+                    proc.terminate()
+            await asyncio.gather(*(p.wait() for p in procs))
+        for task in self._supervisors:
+            task.cancel()
+        await asyncio.gather(*self._supervisors, return_exceptions=True)
+        log.info("cluster: %s", self.stats)
+
+
+class ShardWorker:
+    # апдейты одного пользователя — цепочкой, разных — параллельно (до max_concurrency)
+    def __init__(self, dp: Dispatcher, bot: Bot, max_concurrency: int = 64, ack_fd: Optional[int] = None):
+        self.dp = dp
+        self.bot = bot
+        self.ack_fd = ack_fd
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tails: Dict[int, asyncio.Task] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def serve(self, reader: asyncio.StreamReader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                update = json.loads(line)
+            except ValueError:
+                log.error("worker: битая строка апдейта пропущена")
+                continue
+            await self.submit(update)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def submit(self, update: Dict[str, Any]):
+        await self._slots.acquire()
+        key = update_shard_key(update)
+        task = asyncio.create_task(self._process(self._tails.get(key), update))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._done(key, t))
+
+    def _done(self, key: int, task: asyncio.Task):
+        self._tasks.discard(task)
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _process(self, prev: Optional[asyncio.Task], update: Dict[str, Any]):
+        try:
+            if prev is not None:
+                await asyncio.wait({prev})
+            await self.dp.feed_raw_update(self.bot, update)
+        except Exception:
+            log.exception("worker: ошибка обработки update %s", update.get("update_id"))
+        finally:
+            self._slots.release()
+        self._ack(update)
+
+    def _ack(self, update: Dict[str, Any]):
+        # и после ошибки хендлера: как и UpdateRunner, апдейт с ошибкой не повторяется
+        if self.ack_fd is None:
+            return
+        try:
+            os.write(self.ack_fd, b"%d\n" % update["update_id"])
+        except OSError:
+            log.exception("worker: подтверждение update %s не отправлено", update.get("update_id"))
+
+
+async def read_stdin() -> asyncio.StreamReader:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=READ_LIMIT)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    return reader
@@ -0,0 +1,210 @@
+# coalesce.py — разделение надёжных и «летучих» записей хранилища
+#
+# Финансовые записи (балансы, эскроу, статусы сделок) проходят в бэкенд сразу.
+# Запись чата (last_message_id и состояние сообщения, см. message_state.py) —
+# состояние навигации, которое можно восстановить: его копим в памяти
+# и сбрасываем одной пачкой по таймеру или при остановке.
+# Повторные записи того же чата между сбросами и записи без изменений
+# на диск не попадают вовсе.
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple
+
+from storage import Store
+
+log = logging.getLogger(__name__)
+
+
+class CoalescingStore(Store):
+    def __init__(self, inner: Store, flush_interval: float = 5.0, clean_cache_size: int = 10000):
+        self.inner = inner
+        self.flush_interval = flush_interval
+        self.clean_cache_size = clean_cache_size
+        self._dirty: Dict[int, Dict[str, Any]] = {}
+        # недавно сброшенные значения — чтобы распознать запись без изменений
+        self._clean: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._flusher: Optional[asyncio.Task] = None
+        self.stats = {
+            "durable_writes": 0,
+            "volatile_writes": 0,
+            "volatile_flushed": 0,
+            "flushes": 0,
+        }
+
+    def metrics(self) -> Dict[str, float]:
+        # writes_saved — летучие записи, которые так и не дошли до диска
+        out = dict(self.inner.metrics())
+        out.update(self.stats)
+        out["volatile_pending"] = len(self._dirty)
+        out["writes_saved"] = self.stats["volatile_writes"] - self.stats["volatile_flushed"] - len(self._dirty)
+        return out
+
+    async def start(self):
+        await self.inner.start()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+        log.info("coalesce: %s", self.metrics())
+        await self.inner.close()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("coalesce: ошибка сброса UI-состояния")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await self.inner.set_chat_messages(batch)
+        except BaseException:
+            # не теряем пачку: более свежие значения из _dirty приоритетнее
+            self._dirty = {**batch, **self._dirty}
+            raise
+        for chat_id, record in batch.items():
+            self._remember(chat_id, record)
+        self.stats["volatile_flushed"] += len(batch)
+        self.stats["flushes"] += 1
+
+    def _remember(self, chat_id: int, record: Dict[str, Any]):
+        self._clean[chat_id] = record
+        self._clean.move_to_end(chat_id)
+        if len(self._clean) > self.clean_cache_size:
+            self._clean.popitem(last=False)
+
+    # ----- летучее UI-состояние -----
+    async def set_chat_message(self, chat_id: int, record: Dict[str, Any]):
+        self.stats["volatile_writes"] += 1
+        if self._clean.get(chat_id) == record:
+            # на диске уже это значение — писать нечего
+            self._dirty.pop(chat_id, None)
+            return
+        # повторная запись до сброса просто перекрывает предыдущую
+        self._dirty[chat_id] = dict(record)
+
+    async def set_chat_messages(self, items: Dict[int, Dict[str, Any]]):
+        for chat_id, record in items.items():
+            await self.set_chat_message(chat_id, record)
+
+    async def get_chat_message(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        if chat_id in self._dirty:
+            return dict(self._dirty[chat_id])
+        if chat_id in self._clean:
+            return dict(self._clean[chat_id])
+        record = await self.inner.get_chat_message(chat_id)
+        if record is not None:
+            self._remember(chat_id, record)
+            return dict(record)
+        return None
+
+    # ----- надёжные записи: сразу в бэкенд -----
+    async def get_user(self, uid: int) -> Dict[str, Any]:
+        return await self.inner.get_user(uid)
+
+    async def set_username(self, uid: int, username: Optional[str]):
+        await self.inner.set_username(uid, username)
+
+    async def adjust_balance(self, uid: int, delta: int, update_id: Optional[int] = None) -> int:
+        self.stats["durable_writes"] += 1
+        return await self.inner.adjust_balance(uid, delta, update_id)
+
+    async def create_deal(self, deal: Dict[str, Any], update_id: Optional[int] = None) -> Dict[str, Any]:
+        self.stats["durable_writes"] += 1
+        return await self.inner.create_deal(deal, update_id)
+
+    async def find_deal(self, deal_id: str) -> Optional[Dict[str, Any]]:
+        return await self.inner.find_deal(deal_id)
+
+    async def update_deal(self, deal_id: str, **fields) -> Optional[Dict[str, Any]]:
+        self.stats["durable_writes"] += 1
+        return await self.inner.update_deal(deal_id, **fields)
+
+    async def join_deal(self, deal_id: str, buyer_id: int, buyer_username: Optional[str]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        self.stats["durable_writes"] += 1
+        return await self.inner.join_deal(deal_id, buyer_id, buyer_username)
+
+    async def transition_deal(self, deal_id: str, from_status: str, to_status: str, **fields) -> Optional[Dict[str, Any]]:
+        self.stats["durable_writes"] += 1
+        return await self.inner.transition_deal(deal_id, from_status, to_status, **fields)
+
+    async def complete_deal(self, deal_id: str, buyer_id: int) -> Optional[int]:
+        self.stats["durable_writes"] += 1
+        return await self.inner.complete_deal(deal_id, buyer_id)
+
+    async def cancel_deal(self, deal_id: str, from_status: str) -> Optional[int]:
+        self.stats["durable_writes"] += 1
+        return await self.inner.cancel_deal(deal_id, from_status)
+
+    async def reconcile_ledger(self, repair: bool = False, checkpoint: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        if repair:
+            self.stats["durable_writes"] += 1
+        return await self.inner.reconcile_ledger(repair, checkpoint)
+
+    async def find_party_deals(self, role: str, uid: int, status: str) -> List[Dict[str, Any]]:
+        return await self.inner.find_party_deals(role, uid, status)
+
+    async def check_indexes(self) -> List[str]:
+        return await self.inner.check_indexes()
+
+    async def search_open_deals(self, kind: str, prefix: str, offset: int, limit: int) -> List[Dict[str, Any]]:
+        return await self.inner.search_open_deals(kind, prefix, offset, limit)
+
+    async def terminal_deals(self, limit: int) -> List[Dict[str, Any]]:
+        return await self.inner.terminal_deals(limit)
+
+    async def evict_deals(self, deal_ids: List[str]) -> int:
+        self.stats["durable_writes"] += 1
+        return await self.inner.evict_deals(deal_ids)
+
+    async def deal_ids_with_status(self, statuses: Tuple[str, ...]) -> List[str]:
+        return await self.inner.deal_ids_with_status(statuses)
+
+    async def deal_counts(self) -> Dict[str, int]:
+        return await self.inner.deal_counts()
+
+    async def compact(self) -> bool:
+        # сначала отложенные записи — иначе они попадут уже в следующий сегмент
+        await self.flush()
+        return await self.inner.compact()
+
+    async def reserve_sequence(self, name: str, count: int) -> int:
+        self.stats["durable_writes"] += 1
+        return await self.inner.reserve_sequence(name, count)
+
+    async def save_outbox(self, item: Dict[str, Any]):
+        await self.inner.save_outbox(item)
+
+    async def delete_outbox(self, item_id: str):
+        await self.inner.delete_outbox(item_id)
+
+    async def load_outbox(self) -> List[Dict[str, Any]]:
+        return await self.inner.load_outbox()
+
+    async def save_job(self, job: Dict[str, Any]):
+        await self.inner.save_job(job)
+
+    async def delete_job(self, job_id: str):
+        await self.inner.delete_job(job_id)
+
+    async def load_jobs(self) -> List[Dict[str, Any]]:
+        return await self.inner.load_jobs()
+
+    async def load_runtime(self, name: str) -> Optional[Any]:
+        return await self.inner.load_runtime(name)
+
+    async def save_runtime(self, name: str, value: Any):
+        self.stats["durable_writes"] += 1
+        await self.inner.save_runtime(name, value)
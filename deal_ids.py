@@ -0,0 +1,70 @@
+# deal_ids.py — выдача номеров сделок без коллизий
+#
+# Номер в формате #A123: латинская буква + число 1..999999, всего
+# KEYSPACE = 26 * 999999 вариантов. Счётчик n (хранится в Store, выдаётся
+# блоками) отображается в номер аффинной перестановкой
+#     idx = (MULTIPLIER * n + OFFSET) mod KEYSPACE,
+# которая взаимно однозначна, пока gcd(MULTIPLIER, KEYSPACE) == 1: разные n дают
+# разные номера, а соседние сделки не получают соседних номеров. Старые
+# случайные номера из истории проверяются одним lookup'ом и пропускаются.
+import asyncio
+import logging
+import math
+import re
+
+from storage import Store
+
+log = logging.getLogger(__name__)
+
+LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+NUMBERS = 999999
+KEYSPACE = len(LETTERS) * NUMBERS
+MULTIPLIER = 15485863  # простое, не делит KEYSPACE
+OFFSET = 7340033
+SEQUENCE = "deal_id"
+
+DEAL_ID_RE = re.compile(r"#[A-Z]\d{1,6}")
+
+assert math.gcd(MULTIPLIER, KEYSPACE) == 1
+
+
+def encode(n: int) -> str:
+    idx = (MULTIPLIER * n + OFFSET) % KEYSPACE
+    letter, number = divmod(idx, NUMBERS)
+    return f"#{LETTERS[letter]}{number + 1}"
+
+
+class DealIdAllocator:
+    def __init__(self, store: Store, block: int = 100, warn_ratio: float = 0.8):
+        self.store = store
+        self.block = block
+        self.warn_ratio = warn_ratio
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+        self._warned = False
+
+    async def _counter(self) -> int:
+        # резервируем блок счётчиков одной записью; после крэша неиспользованный
+        # остаток блока просто пропадает — номера от этого не повторяются
+        async with self._lock:
+            if self._next >= self._end:
+                start = await self.store.reserve_sequence(SEQUENCE, self.block)
+                self._next, self._end = start, start + self.block
+            n = self._next
+            self._next += 1
+        if n >= KEYSPACE:
+            raise RuntimeError("deal_ids: пространство номеров сделок исчерпано")
+        if not self._warned and n >= KEYSPACE * self.warn_ratio:
+            self._warned = True
+            log.warning("deal_ids: использовано %.0f%% номеров сделок (%d из %d) — пора расширять формат",
+                        100 * n / KEYSPACE, n, KEYSPACE)
+        return n
+
+    async def allocate(self) -> str:
+        while True:
+            deal_id = encode(await self._counter())
+            if await self.store.find_deal(deal_id) is None:
+                return deal_id
+            # номер занят сделкой, созданной ещё случайным генератором
+            log.info("deal_ids: %s уже занят, берём следующий", deal_id)
@@ -0,0 +1,161 @@
+# fsm_storage.py — персистентное FSM-хранилище aiogram на SQLite
+#
+# Состояния мастера продавца и входа покупателя переживают рестарт и деплой.
+# Горячие ключи держим в ограниченном LRU-кеше, всё остальное — на диске;
+# брошенные на полпути сценарии удаляются по TTL.
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+from sqlite_store import connect
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fsm_updated ON fsm (updated);
+"""
+
+_MISSING = object()
+
+
+def _key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:{key.destiny}"
+
+
+class SqliteFSMStorage(BaseStorage):
+    def __init__(self, path: Path, ttl: float = 24 * 3600, cache_size: int = 10000):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.cache_size = cache_size
+        # один поток: записи по ключу применяются строго в порядке вызовов
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm")
+        self._conn = connect(self.path)
+        self._conn.executescript(SCHEMA)
+        self._cache: "OrderedDict[str, Tuple[Optional[str], Dict[str, Any], float]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0}
+        self._closed = False
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+
+    # ----- кеш -----
+    def _cache_get(self, k: str):
+        entry = self._cache.get(k)
+        if entry is None:
+            return _MISSING
+        if time.time() - entry[2] > self.ttl:
+            del self._cache[k]
+            return None
+        self._cache.move_to_end(k)
+        return entry
+
+    def _cache_put(self, k: str, state: Optional[str], data: Dict[str, Any], updated: float):
+        self._cache[k] = (state, data, updated)
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    # ----- диск -----
+    def _load(self, k: str):
+        row = self._conn.execute("SELECT state, data, updated FROM fsm WHERE key = ?", (k,)).fetchone()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def _save(self, k: str, state: Optional[str], data: Dict[str, Any], updated: float):
+        if state is None and not data:
+            self._conn.execute("DELETE FROM fsm WHERE key = ?", (k,))
+        else:
+            self._conn.execute("INSERT OR REPLACE INTO fsm (key, state, data, updated) VALUES (?, ?, ?, ?)",
+                               (k, state, json.dumps(data, ensure_ascii=False), updated))
+
+    async def _entry(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        k = _key(key)
+        entry = self._cache_get(k)
+        if entry is _MISSING:
+            self.stats["misses"] += 1
+            entry = await self._run(self._load, k)
+            # отсутствие состояния тоже кешируем: иначе каждый апдейт пользователя
+            # вне сценария ходил бы на диск
+            self._cache_put(k, *(entry or (None, {}, time.time())))
+        else:
+            self.stats["hits"] += 1
+        if entry is None:
+            return None, {}
+        return entry[0], entry[1]
+
+    async def _put(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]):
+        k = _key(key)
+        now = time.time()
+        if state is None and not data:
+            self._cache.pop(k, None)
+        else:
+            self._cache_put(k, state, data, now)
+        await self._run(self._save, k, state, data, now)
+
+    # ----- BaseStorage -----
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = await self._entry(key)
+        await self._put(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._entry(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = await self._entry(key)
+        await self._put(key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._entry(key)
+        return dict(data)
+
+    async def close(self) -> None:
+        # может вызываться и самим aiogram при остановке, и из main()
+        if self._closed:
+            return
+        self._closed = True
+        await asyncio.get_running_loop().run_in_executor(None, self._pool.shutdown)
+        self._conn.close()
+
+    # ----- обслуживание -----
+    def _evict(self, cutoff: float) -> int:
+        return self._conn.execute("DELETE FROM fsm WHERE updated < ?", (cutoff,)).rowcount
+
+    async def evict_expired(self) -> int:
+        cutoff = time.time() - self.ttl
+        for k in [k for k, entry in self._cache.items() if entry[2] < cutoff]:
+            del self._cache[k]
+        removed = await self._run(self._evict, cutoff)
+        self.stats["evicted"] += removed
+        if removed:
+            log.info("fsm: удалено %d брошенных сценариев", removed)
+        return removed
+
+    def _count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM fsm").fetchone()[0]
+
+    async def count(self) -> int:
+        return await self._run(self._count)
+
+    def _count_by_state(self) -> Dict[str, int]:
+        rows = self._conn.execute("SELECT COALESCE(state, ''), COUNT(*) FROM fsm GROUP BY state").fetchall()
+        return dict(rows)
+
+    async def count_by_state(self) -> Dict[str, int]:
+        # '' — ключи без состояния, но с данными
+        return await self._run(self._count_by_state)
@@ -0,0 +1,126 @@
+# inline_search.py — inline-поиск открытых сделок по префиксу номера и названию
+#
+# Telegram шлёт inline-запрос на каждое нажатие клавиши. Поэтому:
+#   * новый запрос пользователя отменяет его предыдущий, если тот ещё не отвечен:
+#     ответ на «перепечатанный» запрос никто не увидит. Последний запрос отвечается
+#     сразу, без паузы;
+#   * поиск идёт по индексу открытых сделок (Store.search_open_deals), а не перебором;
+#   * страницы по page_size результатов, дальше — через next_offset; порядок —
+#     (номер) или (первое совпавшее слово названия, номер), одинаковый в обоих бэкендах;
+#   * результаты не зависят от того, кто спрашивает, поэтому кеш общий, а ответ
+#     помечается is_personal=False и кешируется на стороне Telegram на cache_time.
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from aiogram import types
+
+from ledger import deal_price
+from storage import Store
+
+log = logging.getLogger(__name__)
+
+MAX_PAGE_SIZE = 50  # больше Telegram в одном ответе не принимает
+
+_ID_QUERY_RE = re.compile(r"#?([A-Z]\d{1,6}|[A-Z]?)", re.IGNORECASE)
+_WORD_RE = re.compile(r"\w+")
+
+
+def parse_query(query: str) -> Optional[Tuple[str, str]]:
+    # "#A12" / "a12" / "#" — префикс номера; иначе — префикс первого слова названия
+    q = query.strip()
+    if not q:
+        return None
+    m = _ID_QUERY_RE.fullmatch(q)
+    if m and (q.startswith("#") or any(ch.isdigit() for ch in q)):
+        return "id", "#" + m.group(1).upper()
+    words = _WORD_RE.findall(q.casefold())
+    if not words:
+        return None
+    return "name", words[0]
+
+
+class InlineSearch:
+    def __init__(self, store: Store, render: Callable[[str, str, int], types.InlineQueryResultArticle],
+                 howto: Callable[[], types.InlineQueryResultArticle], page_size: int = 20,
+                 cache_time: int = 10, cache_size: int = 2048):
+        self.store = store
+        self.render = render
+        self.howto = howto
+        self.page_size = min(page_size, MAX_PAGE_SIZE)
+        self.cache_time = cache_time
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, str, int], Tuple[float, List[Any], str]]" = OrderedDict()
+        self._answering: Dict[int, asyncio.Task] = {}  # uid -> ответ на его последний запрос
+        self.stats = {"queries": 0, "superseded": 0, "cache_hits": 0, "searches": 0}
+
+    async def answer(self, inline_query: types.InlineQuery):
+        self.stats["queries"] += 1
+        uid = inline_query.from_user.id
+        previous = self._answering.get(uid)
+        if previous is not None and not previous.done():
+            # пользователь уже набрал следующий символ — прежний ответ никто не увидит
+            previous.cancel()
+        task = self._answering[uid] = asyncio.ensure_future(self._answer(inline_query))
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if self._answering.get(uid) is task:
+                del self._answering[uid]
+        if task.cancelled():
+            self.stats["superseded"] += 1
+            return
+        task.result()
+
+    async def _answer(self, inline_query: types.InlineQuery):
+        results, next_offset = await self.search(inline_query.query, self._offset(inline_query.offset))
+        await inline_query.answer(results=results, cache_time=self.cache_time, is_personal=False,
+                                  next_offset=next_offset)
+
+    @staticmethod
+    def _offset(raw: str) -> int:
+        try:
+            return max(0, int(raw or 0))
+        except ValueError:
+            return 0
+
+    async def search(self, query: str, offset: int = 0) -> Tuple[List[Any], str]:
+        parsed = parse_query(query)
+        if parsed is None:
+            return ([self.howto()] if offset == 0 else []), ""
+        kind, prefix = parsed
+        key = (kind, prefix, offset)
+        cached = self._cache_get(key)
+        if cached is not None:
+            self.stats["cache_hits"] += 1
+            return cached
+        self.stats["searches"] += 1
+        # на одну сделку больше страницы — чтобы знать, есть ли следующая
+        deals = await self.store.search_open_deals(kind, prefix, offset, self.page_size + 1)
+        results = [self.render(d["id"], d["name"], deal_price(d)) for d in deals[:self.page_size]]
+        next_offset = str(offset + self.page_size) if len(deals) > self.page_size else ""
+        self._cache_put(key, (results, next_offset))
+        return results, next_offset
+
+    # ----- кеш -----
+    def _cache_get(self, key: Tuple[str, str, int]):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.cache_time:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry[1], entry[2]
+
+    def _cache_put(self, key: Tuple[str, str, int], value: Tuple[List[Any], str]):
+        self._cache[key] = (time.monotonic(), value[0], value[1])
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
@@ -0,0 +1,303 @@
+# journal.py — журнал изменений (WAL) и снапшоты состояния Gift Castle
+#
+# Вместо перезаписи всего data.json на каждое действие пишем в append-only
+# журнал только изменённые записи (раздел + ключ + новое значение).
+# fsync делается пачками фоновой задачей, а сжатие журнала в снапшот
+# выполняется в отдельном потоке по файлам на диске, не трогая event loop.
+#
+# Раскладка на диске (для snapshot_path = data.json):
+#   data.snap            — двоичный снапшот (snapshot.py); seq = последний вошедший сегмент
+#   data.wal.000001 ...  — сегменты журнала, по одной JSON-записи на строку
+#   data.json            — прежний JSON-снапшот ("_meta.seq"): при первом старте
+#                          переводится в data.snap и переименовывается в data.json.legacy
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+from snapshot import read_snapshot, write_snapshot, empty_section
+
+SECTIONS = ("users", "deals", "chats", "outbox", "meta", "ledger", "runtime", "jobs", "applied")
+
+log = logging.getLogger(__name__)
+
+
+def _dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def _fsync_dir(path: Path):
+    # на части ФС переименование становится надёжным только после fsync каталога
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def apply_record(data: Dict[str, Any], rec: Dict[str, Any]):
+    section = data.get(rec["s"])
+    if section is None:
+        section = data[rec["s"]] = empty_section(rec["s"])
+    if rec.get("d"):
+        section.pop(rec["k"], None)
+    else:
+        section[rec["k"]] = rec["v"]
+
+
+class Journal:
+    def __init__(self, snapshot_path: Path, fsync_interval: float = 0.05, compact_threshold: int = 20000):
+        self.snapshot_path = Path(snapshot_path)
+        self.binary_path = self.snapshot_path.with_suffix(".snap")
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+        self.data: Dict[str, Any] = {}
+        self.seq = 0
+        self._fh = None
+        self._buffer: List[str] = []
+        self._waiters: List[asyncio.Future] = []
+        self._inflight: Optional[asyncio.Future] = None
+        self._io_lock = threading.Lock()
+        self._segment_records = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._closing = False
+        self._compactor: Optional[threading.Thread] = None
+        # пишутся из потоков записи и сжатия; читаются только для метрик
+        self.stats = {"batches": 0, "records": 0, "bytes": 0, "write_seconds": 0.0,
+                      "snapshots": 0, "snapshot_bytes": 0, "snapshot_seconds": 0.0}
+
+    # ----- файлы -----
+    def _segment_path(self, seq: int) -> Path:
+        return self.snapshot_path.with_name(f"{self.snapshot_path.stem}.wal.{seq:06d}")
+
+    def _segments(self) -> List[Tuple[int, Path]]:
+        prefix = f"{self.snapshot_path.stem}.wal."
+        found = []
+        for p in self.snapshot_path.parent.glob(prefix + "*"):
+            suffix = p.name[len(prefix):]
+            if suffix.isdigit():
+                found.append((int(suffix), p))
+        return sorted(found)
+
+    def _read_snapshot(self) -> Tuple[Dict[str, Any], int]:
+        if self.binary_path.exists():
+            data, seq = read_snapshot(self.binary_path)
+        elif self.snapshot_path.exists():
+            data = json.loads(self.snapshot_path.read_text(encoding="utf-8"))
+            seq = int(data.pop("_meta", {}).get("seq", 0))
+        else:
+            data, seq = {}, 0
+        for s in SECTIONS:
+            if s not in data:
+                data[s] = empty_section(s)
+        return data, seq
+
+    def _write_snapshot(self, data: Dict[str, Any], seq: int) -> int:
+        size = write_snapshot(self.binary_path, data, seq)
+        _fsync_dir(self.binary_path.parent)
+        return size
+
+    @staticmethod
+    def _replay(data: Dict[str, Any], path: Path, repair: bool = False) -> int:
+        # возвращает число применённых записей; оборванный хвост (крэш посреди
+        # записи) отбрасывается, а при repair=True файл обрезается до целой части
+        applied = 0
+        good_len = 0
+        with open(path, "rb") as fh:
+            raw = fh.read()
+        for line in raw.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                break
+            apply_record(data, rec)
+            applied += 1
+            good_len += len(line)
+        if good_len != len(raw):
+            log.warning("journal %s: отброшен оборванный хвост (%d байт)", path.name, len(raw) - good_len)
+            if repair:
+                with open(path, "r+b") as fh:
+                    fh.truncate(good_len)
+        return applied
+
+    def load(self) -> Dict[str, Any]:
+        data, covered = self._read_snapshot()
+        if not self.binary_path.exists():
+            # новый каталог или прежний JSON-снапшот: дальше работаем только с data.snap
+            self._write_snapshot(data, covered)
+            if self.snapshot_path.exists():
+                os.replace(self.snapshot_path, self.snapshot_path.with_name(self.snapshot_path.name + ".legacy"))
+                log.info("journal: %s переведён в %s", self.snapshot_path.name, self.binary_path.name)
+        last = covered
+        replayed = 0
+        for seq, path in self._segments():
+            if seq <= covered:
+                # сегмент уже в снапшоте — крэш случился между заменой снапшота и удалением
+                path.unlink(missing_ok=True)
+                continue
+            replayed += self._replay(data, path, repair=True)
+            last = seq
+        self.data = data
+        self.seq = last + 1
+        self._fh = open(self._segment_path(self.seq), "a", encoding="utf-8")
+        self._segment_records = 0
+        if replayed:
+            log.info("journal: восстановлено %d записей поверх снапшота", replayed)
+        return data
+
+    def read(self) -> Dict[str, Any]:
+        # то же состояние, что даёт load(), но файлы не меняются: без перевода в data.snap,
+        # нового сегмента и обрезки оборванного хвоста (для migrate.py и других читателей)
+        data, covered = self._read_snapshot()
+        for seq, path in self._segments():
+            if seq > covered:
+                self._replay(data, path)
+        return data
+
+    # ----- запись -----
+    def record(self, section: str, key: str):
+        # фиксирует текущее значение data[section][key] (или его удаление)
+        value = self.data.get(section, {}).get(key)
+        if value is None:
+            line = _dumps({"s": section, "k": key, "d": 1})
+        else:
+            line = _dumps({"s": section, "k": key, "v": value})
+        self._buffer.append(line + "\n")
+        if self._wakeup is not None and len(self._buffer) == 1:
+            self._wakeup.set()
+
+    async def sync(self):
+        # дожидается fsync пачки, в которую попали уже сделанные записи
+        if not self._buffer:
+            if self._inflight is not None and not self._inflight.done():
+                await asyncio.shield(self._inflight)
+            return
+        if self._flusher is None:
+            self._write_batch(self._take_buffer())
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        self._wakeup.set()
+        await fut
+
+    def _take_buffer(self) -> List[str]:
+        lines, self._buffer = self._buffer, []
+        return lines
+
+    def _write_batch(self, lines: List[str]):
+        payload = "".join(lines)
+        with self._io_lock:
+            started = time.perf_counter()
+            self._fh.write(payload)
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._segment_records += len(lines)
+            self.stats["write_seconds"] += time.perf_counter() - started
+            self.stats["batches"] += 1
+            self.stats["records"] += len(lines)
+            self.stats["bytes"] += len(payload.encode("utf-8"))
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while not self._closing:
+            await self._wakeup.wait()
+            if not self._closing:
+                # короткая пауза собирает в одну пачку все записи, пришедшие за интервал
+                await asyncio.sleep(self.fsync_interval)
+            self._wakeup.clear()
+            await self._flush_once(loop)
+
+    async def _flush_once(self, loop: asyncio.AbstractEventLoop):
+        lines = self._take_buffer()
+        waiters, self._waiters = self._waiters, []
+        if lines:
+            self._inflight = loop.create_future()
+            waiters.append(self._inflight)
+        try:
+            if lines:
+                await loop.run_in_executor(None, self._write_batch, lines)
+        except Exception as e:
+            # пачку возвращаем в буфер — повторим на следующем цикле
+            log.exception("journal: ошибка записи пачки")
+            self._buffer[:0] = lines
+            self._wakeup.set()
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+        if self._segment_records >= self.compact_threshold:
+            self.rotate_and_compact()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        if self._buffer:
+            self._wakeup.set()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._flusher
+            self._flusher = None
+        if self._buffer:
+            self._write_batch(self._take_buffer())
+        if self._compactor is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._compactor.join)
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    # ----- сжатие -----
+    def has_tail(self) -> bool:
+        # есть записи, не слитые в снапшот: в текущем сегменте или в закрытых до рестарта
+        return bool(self._segment_records) or any(seq < self.seq for seq, _ in self._segments())
+
+    def rotate_and_compact(self) -> bool:
+        # закрываем текущий сегмент и сливаем все закрытые сегменты со снапшотом в фоне
+        if self._compactor is not None and self._compactor.is_alive():
+            return False
+        with self._io_lock:
+            sealed = self.seq
+            self._fh.close()
+            self.seq += 1
+            self._fh = open(self._segment_path(self.seq), "a", encoding="utf-8")
+            self._segment_records = 0
+        self._compactor = threading.Thread(target=self._compact, args=(sealed,), name="journal-compact", daemon=True)
+        self._compactor.start()
+        return True
+
+    def _compact(self, sealed: int):
+        started = time.perf_counter()
+        try:
+            # нетронутые с прошлого снапшота записи копируются без декодирования
+            data, covered = self._read_snapshot()
+            merged = []
+            for seq, path in self._segments():
+                if covered < seq <= sealed:
+                    self._replay(data, path)
+                    merged.append(path)
+            size = self._write_snapshot(data, sealed)
+            self.stats["snapshots"] += 1
+            self.stats["snapshot_bytes"] += size
+            self.stats["snapshot_seconds"] += time.perf_counter() - started
+            for path in merged:
+                path.unlink(missing_ok=True)
+            log.info("journal: снапшот обновлён до сегмента %d (%d сегм. слито)", sealed, len(merged))
+        except Exception:
+            log.exception("journal: ошибка сжатия, сегменты сохранены")
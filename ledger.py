@@ -0,0 +1,261 @@
+# ledger.py — денежные суммы в минорных единицах и журнал проводок
+#
+# Раньше балансы и эскроу были float с round(..., 6) и перезаписывались на
+# месте: истории нет, сверять не с чем. Теперь:
+#   * суммы — целые числа минорных единиц (SCALE = 10**6 — та же точность,
+#     что давал round(..., 6)); ввод разбирается через Decimal;
+#   * каждое движение денег — проводка двойной записи
+#     {id, ts, kind, debit, credit, amount, deal_id}: amount > 0 списывается со
+#     счёта debit и зачисляется на счёт credit. Проводки только дописываются,
+#     в той же транзакции хранилища, что и кешированные остатки
+#     (users.balance_minor, deals.escrow_minor), поэтому остатки всегда можно
+#     пересчитать из журнала (reconcile_ledger(repair=True)).
+# Счета:
+#   user:<id>         — баланс пользователя;
+#   escrow:<deal_id>  — средства, зарезервированные по сделке;
+#   external:owner    — пополнения и списания владельцем (/gb);
+#   external:opening  — входящие остатки при переходе со float-балансов.
+# Сумма остатков всех счетов всегда равна нулю.
+#
+# Сверка (reconcile) пересчитывает остатки по журналу и сравнивает с кешем.
+# Раз проводки не меняются, успешная сверка оставляет checkpoint — последний
+# id и ненулевые остатки, — и следующая досчитывает только более новые
+# проводки; полный проход LedgerReconciler делает раз в full_every запусков.
+import asyncio
+import logging
+import time
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+SCALE = 10 ** 6
+_QUANTUM = Decimal(1).scaleb(-6)
+# предел одной суммы (цена, /gb): 10**15 минорных единиц, так что остатки
+# с большим запасом укладываются в INTEGER SQLite (int64, ~9.2 * 10**18)
+MAX_AMOUNT = Decimal(10) ** 9
+
+OWNER_ACCOUNT = "external:owner"
+OPENING_ACCOUNT = "external:opening"
+
+KIND_ADJUSTMENT = "owner_adjustment"  # /gb
+KIND_HOLD = "escrow_hold"  # покупатель -> эскроу при присоединении
+KIND_RELEASE = "escrow_release"  # эскроу -> продавец при подтверждении
+KIND_REFUND = "escrow_refund"  # эскроу -> покупатель, если сделка отменена по сроку (scheduler.py)
+KIND_OPENING = "opening_balance"  # перенос float-балансов
+
+LIVE_ESCROW_STATUSES = ("in_process", "transferred")  # у остальных сделок эскроу пуст
+MISMATCH_SAMPLE = 20  # сколько расхождений каждого вида попадает в отчёт
+
+
+def parse_amount(text: str) -> int:
+    # "10", "10.5", "10,5", "-3" -> минорные единицы; больше 6 знаков после точки
+    # или по модулю больше MAX_AMOUNT — ошибка
+    try:
+        value = Decimal(text.strip().replace(",", "."))
+    except InvalidOperation:
+        raise ValueError(f"не сумма: {text!r}")
+    if not value.is_finite():
+        raise ValueError(f"не сумма: {text!r}")
+    if abs(value) > MAX_AMOUNT:
+        raise ValueError(f"сумма больше {MAX_AMOUNT}: {text!r}")
+    try:
+        exact = value == value.quantize(_QUANTUM)
+    except InvalidOperation:
+        # не помещается в точность контекста Decimal
+        raise ValueError(f"не сумма: {text!r}")
+    if not exact:
+        raise ValueError(f"больше 6 знаков после точки: {text!r}")
+    return int(value.scaleb(6))
+
+
+def to_minor(value: Any) -> int:
+    # прежние float-суммы (цена, эскроу, баланс) — через str, без двоичного хвоста
+    if value is None:
+        return 0
+    if isinstance(value, int):
+        return value * SCALE
+    return int(Decimal(str(value)).quantize(_QUANTUM).scaleb(6))
+
+
+def format_amount(minor: int) -> str:
+    # 10500000 -> "10.5", 100000000 -> "100"
+    text = f"{Decimal(minor).scaleb(-6):f}"
+    return text.rstrip("0").rstrip(".") if "." in text else text
+
+
+def deal_price(deal: Dict[str, Any]) -> int:
+    # у сделок, созданных до ledger.py, есть только float "price"
+    if deal.get("price_minor") is not None:
+        return deal["price_minor"]
+    return to_minor(deal.get("price"))
+
+
+def deal_escrow(deal: Dict[str, Any]) -> int:
+    if deal.get("escrow_minor") is not None:
+        return deal["escrow_minor"]
+    return to_minor(deal.get("escrow_amount"))
+
+
+def user_account(uid: int) -> str:
+    return f"user:{uid}"
+
+
+def escrow_account(deal_id: str) -> str:
+    return f"escrow:{deal_id}"
+
+
+def entry(kind: str, debit: str, credit: str, amount: int, deal_id: Optional[str] = None) -> Dict[str, Any]:
+    # проводка без id и ts — их назначает хранилище при записи
+    if not isinstance(amount, int) or amount <= 0:
+        raise ValueError(f"сумма проводки должна быть целой и положительной: {amount!r}")
+    if debit == credit:
+        raise ValueError(f"проводка на тот же счёт: {debit}")
+    return {"kind": kind, "debit": debit, "credit": credit, "amount": amount, "deal_id": deal_id}
+
+
+def signed_entry(kind: str, account: str, counterpart: str, delta: int,
+                 deal_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    # изменение account на delta за счёт counterpart; None, если двигать нечего
+    if delta > 0:
+        return entry(kind, counterpart, account, delta, deal_id)
+    if delta < 0:
+        return entry(kind, account, counterpart, -delta, deal_id)
+    return None
+
+
+def user_deltas(posting: Dict[str, Any]) -> List[Tuple[int, int]]:
+    # (uid, изменение) для счетов пользователей — их остатки хранилище кеширует
+    out = []
+    for account, delta in ((posting["debit"], -posting["amount"]), (posting["credit"], posting["amount"])):
+        kind, _, name = account.partition(":")
+        if kind == "user":
+            out.append((int(name), delta))
+    return out
+
+
+# ----- сверка -----
+def aggregate(rows: Iterable[Tuple[int, str, str, int]],
+              checkpoint: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, int], Dict[str, int]]:
+    # (id, debit, credit, amount) -> остатки счетов и сводка по проводкам;
+    # с checkpoint rows — только проводки после checkpoint["last_id"]
+    totals: Dict[str, int] = dict(checkpoint["totals"]) if checkpoint else {}
+    get = totals.get
+    count = checkpoint["entries"] if checkpoint else 0
+    first = checkpoint["first_id"] if checkpoint else None
+    last = checkpoint["last_id"] if checkpoint else None
+    bad = out_of_order = 0
+    for entry_id, debit, credit, amount in rows:
+        count += 1
+        if first is None:
+            first = last = entry_id
+        elif entry_id <= last:
+            out_of_order += 1
+        last = entry_id
+        if type(amount) is not int or amount <= 0 or debit == credit:
+            bad += 1
+            continue
+        totals[debit] = get(debit, 0) - amount
+        totals[credit] = get(credit, 0) + amount
+    return totals, {"entries": count, "first_id": first or 0, "last_id": last or 0,
+                    "bad_entries": bad, "out_of_order": out_of_order}
+
+
+def reconcile(totals: Dict[str, int], summary: Dict[str, int], balances: Dict[int, int],
+              escrows: Dict[str, int]) -> Dict[str, Any]:
+    # balances — кешированные балансы пользователей, escrows — escrow_minor живых
+    # сделок (LIVE_ESCROW_STATUSES). Эскроу-счёт сделки вне escrows должен быть пуст:
+    # завершённая или заархивированная сделка денег не держит.
+    report: Dict[str, Any] = dict(summary)
+    report["accounts"] = len(totals)
+    report["imbalance"] = sum(totals.values())
+    report["id_gaps"] = (summary["last_id"] - summary["first_id"] + 1 - summary["entries"]) if summary["entries"] else 0
+    users: Dict[int, int] = {}  # uid -> остаток по журналу там, где кеш расходится
+    deals: Dict[str, int] = {}
+    overdrawn = 0
+    for account, amount in totals.items():
+        kind, _, name = account.partition(":")
+        if kind == "user":
+            uid = int(name)
+            if balances.get(uid, 0) != amount:
+                users[uid] = amount
+            if amount < 0:
+                overdrawn += 1
+        elif kind == "escrow":
+            if escrows.get(name, 0) != amount:
+                deals[name] = amount
+    for uid, cached in balances.items():
+        if cached and user_account(uid) not in totals:
+            users[uid] = 0
+    for deal_id, cached in escrows.items():
+        if cached and escrow_account(deal_id) not in totals:
+            deals[deal_id] = 0
+    report["balance_mismatches"] = len(users)
+    report["escrow_mismatches"] = len(deals)
+    report["overdrawn"] = overdrawn  # /gb может увести баланс в минус — это не ошибка журнала
+    report["sample"] = {"users": dict(list(users.items())[:MISMATCH_SAMPLE]),
+                        "deals": dict(list(deals.items())[:MISMATCH_SAMPLE])}
+    report["ok"] = not (report["imbalance"] or report["bad_entries"] or report["out_of_order"]
+                        or report["id_gaps"] or users or deals)
+    report["repair"] = {"users": users, "deals": deals}
+    report["checkpoint"] = None
+    if report["ok"]:
+        report["checkpoint"] = {"last_id": summary["last_id"], "first_id": summary["first_id"],
+                                "entries": summary["entries"],
+                                "totals": {account: amount for account, amount in totals.items() if amount}}
+    return report
+
+
+class LedgerReconciler:
+    # фоновая сверка журнала проводок с кешированными остатками
+    def __init__(self, store, interval: float = 3600.0, full_every: int = 24):
+        self.store = store
+        self.interval = interval
+        self.full_every = full_every
+        self.last: Optional[Dict[str, Any]] = None
+        self._checkpoint: Optional[Dict[str, Any]] = None
+        self._since_full = 0
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"runs": 0, "full_runs": 0, "failures": 0, "entries": 0, "checked": 0, "seconds": 0.0}
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                log.exception("ledger: ошибка сверки")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self, full: bool = False) -> Dict[str, Any]:
+        # full — пересчитать весь журнал, а не только проводки после прошлой сверки
+        checkpoint = None if full or self._since_full >= self.full_every else self._checkpoint
+        started = time.perf_counter()
+        report = await self.store.reconcile_ledger(checkpoint=checkpoint)
+        report.pop("repair", None)
+        self._checkpoint = report.pop("checkpoint", None)
+        self._since_full = self._since_full + 1 if checkpoint is not None else 0
+        self.stats["runs"] += 1
+        self.stats["full_runs"] += checkpoint is None
+        self.stats["entries"] = report["entries"]
+        self.stats["checked"] = report["entries"] - (checkpoint["entries"] if checkpoint else 0)
+        self.stats["seconds"] = time.perf_counter() - started
+        self.last = report
+        if report["ok"]:
+            log.info("ledger: сверено %d проводок (новых %d) за %.2f с", report["entries"], self.stats["checked"],
+                     self.stats["seconds"])
+        else:
+            self.stats["failures"] += 1
+            log.error("ledger: журнал расходится с остатками: %s", report)
+        return report
@@ -0,0 +1,254 @@
+# lifecycle.py — остановка без потерь и продолжение приёма апдейтов после рестарта
+#
+# Платформа шлёт SIGTERM на каждый деплой и ежедневный рестарт. Раньше
+# dp.start_polling подтверждал апдейты Telegram сразу при получении, а при
+# остановке обрывались хендлеры, отложенные записи и уведомления. Теперь:
+#   * SIGTERM/SIGINT (Lifecycle) — новые апдейты больше не принимаются:
+#     polling прерывается, webhook отвечает 503, и Telegram повторит позже;
+#   * принятые апдейты (UpdateRunner) дорабатываются не дольше SHUTDOWN_TIMEOUT,
+#     оставшиеся отменяются;
+#   * в Store сохраняется состояние приёма {"offset", "pending"}: следующий
+#     update_id для getUpdates и тела апдейтов, принятых, но не завершённых,
+#     включая отменённые по таймауту. На старте pending обрабатываются первыми,
+#     а polling продолжается с offset — завершённые не повторяются, принятые не теряются;
+#   * затем main.py останавливает фоновые задачи и сбрасывает хранилище.
+# Telegram считает апдейты доставленными, когда следующий getUpdates приходит с
+# бо́льшим offset или webhook ответил 200. До этого момента состояние приёма
+# сохраняется (checkpoint): Poller не двигает offset, а webhook не отвечает,
+# пока принятые апдейты не записаны в pending. Завершение апдейтов сохраняется
+# не чаще save_interval, поэтому после падения повторяются только апдейты,
+# бывшие в работе на момент последнего сохранения, и ни один не теряется.
+# Повтор уже применённого апдейта не должен менять данные второй раз: /gb и
+# создание сделки передают update_id в Store (adjust_balance, create_deal), а
+# переходы сделок и так проверяют текущий статус.
+# Воркеры кластера сигналы игнорируют: их останавливает координатор через EOF.
+import asyncio
+import contextlib
+import logging
+import signal
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+log = logging.getLogger(__name__)
+
+STATE_KEY = "updates"  # имя состояния приёма в Store.load_runtime/save_runtime
+
+
+def raw_update(update: Any) -> Dict[str, Any]:
+    # polling отдаёт Update, webhook и pending — dict
+    if isinstance(update, Update):
+        return update.model_dump(mode="json", by_alias=True, exclude_none=True)
+    return update
+
+
+def dispatcher_handler(dp: Dispatcher, bot: Bot) -> Callable[[Any], Awaitable[Any]]:
+    async def handle(update: Any):
+        if isinstance(update, Update):
+            return await dp.feed_update(bot, update)
+        return await dp.feed_raw_update(bot, update)
+    return handle
+
+
+class Lifecycle:
+    def __init__(self):
+        self.stopping = asyncio.Event()
+        self.stats = {"signals": 0}
+
+    def install_signal_handlers(self, ignore: bool = False):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self._ignore if ignore else self.request_stop, sig)
+
+    def _ignore(self, sig: int):
+        self.stats["signals"] += 1
+        log.info("lifecycle: %s проигнорирован — воркер остановится по EOF от координатора",
+                 signal.Signals(sig).name)
+
+    def request_stop(self, sig: Optional[int] = None):
+        self.stats["signals"] += 1
+        if self.stopping.is_set():
+            log.warning("lifecycle: остановка уже идёт")
+            return
+        log.info("lifecycle: %s — прекращаем приём апдейтов", signal.Signals(sig).name if sig else "stop")
+        self.stopping.set()
+
+    async def wait(self):
+        await self.stopping.wait()
+
+
+class UpdateRunner:
+    # апдейты — задачами, не более max_concurrency разом; незавершённые помнит до конца обработки
+    def __init__(self, handle: Callable[[Any], Awaitable[Any]], max_concurrency: int = 64, store=None,
+                 key: str = STATE_KEY, save_interval: float = 1.0):
+        self.handle = handle
+        self.store = store
+        self.key = key
+        self.save_interval = save_interval
+        self.max_concurrency = max_concurrency
+        self.offset = 0  # следующий update_id для getUpdates
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._pending: Dict[int, Any] = {}
+        self._dirty = False
+        self._version = 0  # растёт с каждым принятым апдейтом
+        self._saved_version = 0
+        self._save_lock = asyncio.Lock()
+        self._saver: Optional[asyncio.Task] = None
+        self.stats = {"accepted": 0, "duplicates": 0, "finished": 0, "failed": 0, "replayed": 0,
+                      "abandoned": 0, "saves": 0, "drain_seconds": 0.0}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def restore(self):
+        # состояние прошлого запуска: offset и недоработанные апдейты — они идут первыми
+        if self.store is None:
+            return
+        state = await self.store.load_runtime(self.key) or {}
+        self.offset = state.get("offset", 0)
+        pending: List[Dict[str, Any]] = sorted(state.get("pending", ()), key=lambda u: u["update_id"])
+        for update in pending:
+            self.stats["replayed"] += 1
+            await self._start(update["update_id"], update)
+        if pending:
+            log.info("lifecycle: повторно обрабатываем %d апдейтов, не завершённых до рестарта", len(pending))
+
+    def start(self):
+        if self.store is not None:
+            self._saver = asyncio.create_task(self._save_loop())
+
+    async def submit(self, update_id: int, update: Any) -> bool:
+        # ждёт свободный слот; False — апдейт уже в работе
+        if update_id in self._pending:
+            self.stats["duplicates"] += 1
+            return False
+        self.stats["accepted"] += 1
+        await self._start(update_id, update)
+        return True
+
+    async def _start(self, update_id: int, update: Any):
+        await self._slots.acquire()
+        # offset двигается вместе с pending: сохранение между ними не пропустит апдейт
+        self.offset = max(self.offset, update_id + 1)
+        self._pending[update_id] = update
+        self._version += 1
+        self._dirty = True
+        self._tasks[update_id] = asyncio.create_task(self._process(update_id, update))
+
+    async def _process(self, update_id: int, update: Any):
+        try:
+            try:
+                await self.handle(update)
+                self.stats["finished"] += 1
+            except asyncio.CancelledError:
+                # отменён на остановке — остаётся в pending и повторится после рестарта
+                self.stats["abandoned"] += 1
+                raise
+            except Exception:
+                self.stats["failed"] += 1
+                log.exception("lifecycle: ошибка обработки update %s", update_id)
+            self._pending.pop(update_id, None)
+            self._dirty = True
+        finally:
+            self._tasks.pop(update_id, None)
+            self._slots.release()
+
+    async def drain(self, timeout: float) -> int:
+        # ждёт принятые апдейты не дольше timeout, остальные отменяет; возвращает число отменённых
+        started = time.perf_counter()
+        rest = set()
+        tasks = list(self._tasks.values())
+        if tasks:
+            log.info("lifecycle: дорабатываем %d апдейтов (до %g с)", len(tasks), timeout)
+            _, rest = await asyncio.wait(tasks, timeout=timeout)
+            for task in rest:
+                task.cancel()
+            await asyncio.gather(*rest, return_exceptions=True)
+            if rest:
+                log.warning("lifecycle: %d апдейтов не успели за %g с — повторятся после рестарта", len(rest), timeout)
+        if self._saver is not None:
+            self._saver.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._saver
+            self._saver = None
+        await self.save()
+        self.stats["drain_seconds"] = time.perf_counter() - started
+        return len(rest)
+
+    async def save(self):
+        if self.store is None:
+            return
+        self._dirty = False
+        version = self._version
+        await self.store.save_runtime(self.key, {"offset": self.offset,
+                                                 "pending": [raw_update(u) for u in self._pending.values()]})
+        self._saved_version = max(self._saved_version, version)
+        self.stats["saves"] += 1
+
+    async def checkpoint(self):
+        # до подтверждения Telegram: все принятые апдейты уже в Store. Одновременные
+        # вызовы (webhook) ждут одну запись, а не делают каждый свою
+        if self.store is None:
+            return
+        target = self._version
+        async with self._save_lock:
+            if self._saved_version < target:
+                await self.save()
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            if self._dirty:
+                try:
+                    await self.save()
+                except Exception:
+                    self._dirty = True
+                    log.exception("lifecycle: ошибка сохранения состояния приёма")
+
+
+class Poller:
+    # getUpdates с offset из UpdateRunner; остановка прерывает и текущий long poll
+    def __init__(self, bot: Bot, runner: UpdateRunner, timeout: int = 30, retry_delay: float = 1.0):
+        self.bot = bot
+        self.runner = runner
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.stats = {"polls": 0, "poll_errors": 0}
+
+    async def run(self, stopping: asyncio.Event, allowed_updates: List[str]):
+        while not stopping.is_set():
+            try:
+                # новый offset подтверждает Telegram прошлую пачку — сначала она должна быть в Store
+                await self.runner.checkpoint()
+            except Exception:
+                log.exception("lifecycle: ошибка сохранения состояния приёма, offset не двигаем")
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stopping.wait(), self.retry_delay)
+                continue
+            poll = asyncio.ensure_future(self.bot.get_updates(offset=self.runner.offset or None, timeout=self.timeout,
+                                                              allowed_updates=allowed_updates))
+            stop = asyncio.ensure_future(stopping.wait())
+            await asyncio.wait({poll, stop}, return_when=asyncio.FIRST_COMPLETED)
+            stop.cancel()
+            if not poll.done():
+                poll.cancel()
+                with contextlib.suppress(asyncio.CancelledError, Exception):
+                    await poll
+                return
+            self.stats["polls"] += 1
+            try:
+                updates = poll.result()
+            except Exception:
+                # в том числе 409 Conflict, пока прежний процесс не закрыл свой long poll
+                self.stats["poll_errors"] += 1
+                log.exception("lifecycle: ошибка getUpdates")
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stopping.wait(), self.retry_delay)
+                continue
+            for update in updates:
+                if update.update_id >= self.runner.offset:
+                    await self.runner.submit(update.update_id, update)
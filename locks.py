@@ -0,0 +1,52 @@
+# locks.py — именованные asyncio-блокировки (per-user / per-deal)
+#
+# Сериализуют обработку по одному ключу (двойной тап, два покупателя на одну
+# сделку), не блокируя остальных пользователей. Неиспользуемые блокировки
+# удаляются, так что словарь не растёт вместе с числом пользователей.
+import asyncio
+import contextlib
+from typing import Dict, List, AsyncIterator
+
+
+class KeyedLocks:
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._waiters: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    async def _acquire(self, key: str):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._release_ref(key)
+            raise
+
+    def _release_ref(self, key: str):
+        self._waiters[key] -= 1
+        if not self._waiters[key]:
+            del self._waiters[key]
+            del self._locks[key]
+
+    def _release(self, key: str):
+        self._locks[key].release()
+        self._release_ref(key)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys: str) -> AsyncIterator[None]:
+        # несколько ключей берём в отсортированном порядке — без взаимных блокировок
+        ordered: List[str] = sorted(set(keys))
+        taken: List[str] = []
+        try:
+            for key in ordered:
+                await self._acquire(key)
+                taken.append(key)
+            yield
+        finally:
+            for key in reversed(taken):
+                self._release(key)
@@ -1,74 +1,200 @@
 #!/usr/bin/env python3
 # main.py — Gift Castle (aiogram 3.x)
 import asyncio
-import json
 import logging
+import os
 import re
+import secrets
+import sys
+import time
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional, List
 
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command, Text
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery, Update
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from storage import open_store, JOIN_OK, JOIN_NOT_FOUND, JOIN_INSUFFICIENT
+from locks import KeyedLocks
+from outbox import Outbox
+from fsm_storage import SqliteFSMStorage
+from deal_ids import DealIdAllocator, DEAL_ID_RE
+from coalesce import CoalescingStore
+from webhook import WebhookServer
+from lifecycle import Lifecycle, UpdateRunner, Poller, dispatcher_handler
+from message_state import MessageTracker, message_record
+from inline_search import InlineSearch
+from cluster import Coordinator, ShardWorker, read_stdin
+from archive import DealArchive, DealArchiver
+from ledger import LedgerReconciler, parse_amount, format_amount, deal_price
+from throttle import ThrottleMiddleware, Limit
+from scheduler import Scheduler
+from metrics import Registry, HandlerMetricsMiddleware, ApiMetricsMiddleware, start_metrics_server
 
 # ---------------- CONFIG ----------------
-BOT_TOKEN = __import__("os").environ.get("BOT_TOKEN")
+BOT_TOKEN = os.environ.get("BOT_TOKEN")
+BOT_API_BASE = os.environ.get("BOT_API_BASE")  # свой Bot API сервер (local bot-api, bench/fake_bot_api.py)
 OWNER_ID = 6828395702  # владелец бота для команды /gb
 PHOTO_ID = "AgACAgIAAxkBAAMEaQ4BT_HrLKNH6naa15zKYnt8z6UAAjsPaxuAI3BI-o-YrxQPN8gBAAMCAAN4AAM2BA"
 DATA_FILE = Path("data.json")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")  # json | sqlite
+SQLITE_FILE = Path(os.environ.get("SQLITE_FILE", "gift_castle.sqlite3"))
+SQLITE_WORKERS = int(os.environ.get("SQLITE_WORKERS", "4"))
+JOURNAL_FSYNC_INTERVAL = 0.05  # сек; записи за интервал уходят на диск одной пачкой
+JOURNAL_COMPACT_THRESHOLD = 20000  # записей в сегменте журнала до сжатия в снапшот
+VOLATILE_FLUSH_INTERVAL = float(os.environ.get("VOLATILE_FLUSH_INTERVAL", "5"))  # сек; сброс last_message_id
+BOT_MODE = os.environ.get("BOT_MODE", "polling")  # polling | webhook | worker (запускается координатором)
+WORKERS = int(os.environ.get("WORKERS", "1"))  # >1 — координатор и столько процессов-воркеров, см. cluster.py
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "1"))
+WORKER_ACK_FD = int(os.environ["WORKER_ACK_FD"]) if os.environ.get("WORKER_ACK_FD") else None  # задаёт координатор
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # публичный адрес приложения, например https://app.herokuapp.com
+WEBHOOK_PATH = "/webhook"
+# проверяется в каждом запросе Telegram; если не задан, на каждый запуск — случайный (его получает set_webhook)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONCURRENCY = int(os.environ.get("WEBHOOK_MAX_CONCURRENCY", "64"))
+PORT = int(os.environ.get("PORT", "8080"))
+OUTBOX_GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", "25"))  # сообщений/с на весь бот
+OUTBOX_CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", "1"))  # сообщений/с в один чат
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "4096"))  # LRU для подписей/клавиатур с параметрами
+FSM_FILE = Path(os.environ.get("FSM_FILE", "fsm.sqlite3"))
+FSM_TTL = float(os.environ.get("FSM_TTL", str(24 * 3600)))  # сек; брошенный сценарий удаляется
+FSM_CACHE_SIZE = int(os.environ.get("FSM_CACHE_SIZE", "10000"))  # ключей в памяти
+FSM_EVICT_INTERVAL = 600  # сек
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))  # порт /metrics вне webhook-режима; 0 — выключено
+INLINE_PAGE_SIZE = 20  # результатов на страницу inline-поиска
+PICK_PAGE_SIZE = 20  # кнопок сделок в одном сообщении выбора (у Telegram лимит на клавиатуру — 100)
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "10"))  # сек; кеш ответа у Telegram и у нас
+ARCHIVE_DIR = Path(os.environ.get("ARCHIVE_DIR", "archive"))  # сегменты завершённых сделок и их индекс
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", "600"))  # сек; 0 — не переносить сделки в архив
+ARCHIVE_BATCH = 500  # сделок в одной пачке (gzip-member) архива
+LEDGER_RECONCILE_INTERVAL = float(os.environ.get("LEDGER_RECONCILE_INTERVAL", "3600"))  # сек; 0 — без фоновой сверки
+THROTTLE_LIMITS = {  # группа хендлеров (flags={"throttle": ...}) -> действий/с и запас на пользователя
+    "default": Limit(float(os.environ.get("THROTTLE_RATE", "2")), float(os.environ.get("THROTTLE_BURST", "6"))),
+    "deal": Limit(0.5, 3),  # шаги сделки: запись в хранилище и уведомление второй стороне
+    "balance": Limit(0.5, 2),
+}
+CALLBACK_DEDUP_WINDOW = float(os.environ.get("CALLBACK_DEDUP_WINDOW", "1.0"))  # сек; повтор того же нажатия — дубль
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", "2"))  # фоновых задач одновременно
+DEAL_OPEN_TTL = float(os.environ.get("DEAL_OPEN_TTL", str(7 * 24 * 3600)))  # сек без покупателя до отмены; 0 — не отменять
+DEAL_TRANSFER_TTL = float(os.environ.get("DEAL_TRANSFER_TTL", str(3 * 24 * 3600)))  # сек на передачу товара, затем отмена с возвратом
+DEAL_REMIND_AFTER = float(os.environ.get("DEAL_REMIND_AFTER", str(24 * 3600)))  # сек до напоминания стороне, чей ход; 0 — без напоминаний
+DEAL_CONFIRM_REMINDERS = 3  # напоминаний покупателю подтвердить получение; дальше — через поддержку
+DEAL_SWEEP_INTERVAL = 24 * 3600  # сек; поиск живых сделок без срока
+COMPACT_INTERVAL = float(os.environ.get("COMPACT_INTERVAL", str(6 * 3600)))  # сек; плановое сжатие журнала / WAL
+ROLLUP_INTERVAL = 60  # сек; пересчёт сделок по статусам для /metrics
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "20"))  # сек на доработку апдейтов после SIGTERM
 # ----------------------------------------
 
 if not BOT_TOKEN:
     raise SystemExit("Ошибка: переменная окружения BOT_TOKEN не задана")
+if max(WORKERS, WORKER_COUNT) > 1 and STORAGE_BACKEND != "sqlite":
+    raise SystemExit("Ошибка: несколько воркеров делят состояние только через STORAGE_BACKEND=sqlite")
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=BOT_TOKEN, parse_mode="Markdown")
-dp = Dispatcher(storage=MemoryStorage())
+bot = Bot(token=BOT_TOKEN, parse_mode="Markdown",
+          session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_BASE)) if BOT_API_BASE else None)
+FSM_STORAGE = SqliteFSMStorage(FSM_FILE, ttl=FSM_TTL, cache_size=FSM_CACHE_SIZE)
+dp = Dispatcher(storage=FSM_STORAGE)
+
+# ----------------- Metrics -----------------
+METRICS = Registry()
+HANDLER_LATENCY = METRICS.histogram("giftcastle_handler_seconds", "Время работы хендлера")
+HANDLER_ERRORS = METRICS.counter("giftcastle_handler_errors_total", "Исключения, вылетевшие из хендлера")
+API_LATENCY = METRICS.histogram("giftcastle_api_request_seconds", "Время вызова Bot API")
+API_ERRORS = METRICS.counter("giftcastle_api_errors_total", "Ошибки Bot API, включая перехваченные хендлерами")
+STORE_STATS = METRICS.gauge("giftcastle_store_stat", "Счётчики хранилища: журнал/SQLite, отложенные записи")
+OUTBOX_DEPTH = METRICS.gauge("giftcastle_outbox_depth", "Уведомлений в очереди")
+OUTBOX_STATS = METRICS.gauge("giftcastle_outbox_stat", "Счётчики очереди уведомлений")
+FSM_STATES = METRICS.gauge("giftcastle_fsm_states", "Активные сценарии по состояниям FSM")
+FSM_CACHE_STATS = METRICS.gauge("giftcastle_fsm_cache_stat", "Счётчики кеша FSM")
+INLINE_STATS = METRICS.gauge("giftcastle_inline_stat", "Счётчики inline-поиска")
+NAVIGATION_STATS = METRICS.gauge("giftcastle_navigation_stat", "Экраны меню: правки, пропуски, отправки")
+ARCHIVE_STATS = METRICS.gauge("giftcastle_archive_stat", "Архив завершённых сделок: перенос, поиск, сжатие")
+LEDGER_STATS = METRICS.gauge("giftcastle_ledger_stat", "Сверка журнала проводок с балансами")
+UPDATES_STATS = METRICS.gauge("giftcastle_updates_stat", "Приём апдейтов: в работе, повторы после рестарта, отмены")
+SUPPRESSED = METRICS.counter("giftcastle_suppressed_total", "Апдейты, отброшенные до хендлера: дубли нажатий и превышение лимита")
+SCHEDULER_STATS = METRICS.gauge("giftcastle_scheduler_stat", "Фоновые задачи: в очереди, выполняется, запуски, ошибки")
+DEALS = METRICS.gauge("giftcastle_deals", "Сделки в хранилище по статусам (пересчёт по расписанию)")
+THROTTLE_STATS = METRICS.gauge("giftcastle_throttle_stat", "Ограничение частоты: пропущено, подавлено, корзин в памяти")
+
+# раньше метрик хендлеров: подавленное нажатие — не запуск хендлера
+THROTTLE = ThrottleMiddleware(THROTTLE_LIMITS, SUPPRESSED, dedup_window=CALLBACK_DEDUP_WINDOW, exempt=(OWNER_ID,),
+                              throttled_text="⏳ Слишком часто, подождите пару секунд")
+for observer in (dp.message, dp.callback_query):
+    observer.middleware(THROTTLE)
+for observer in (dp.message, dp.callback_query, dp.inline_query):
+    observer.middleware(HandlerMetricsMiddleware(HANDLER_LATENCY, HANDLER_ERRORS))
+bot.session.middleware(ApiMetricsMiddleware(API_LATENCY, API_ERRORS))
 
 # ----------------- Helpers -----------------
-def load_data() -> Dict[str, Any]:
-    if not DATA_FILE.exists():
-        default = {"users": {}, "deals": {}, "chats": {}}
-        DATA_FILE.write_text(json.dumps(default, ensure_ascii=False, indent=2))
-        return default
-    return json.loads(DATA_FILE.read_text(encoding="utf-8"))
-
-def save_data(data: Dict[str, Any]):
-    DATA_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2))
-
-DATA = load_data()
-
-def ensure_user(uid: int):
-    uid_s = str(uid)
-    if uid_s not in DATA["users"]:
-        DATA["users"][uid_s] = {"balance": 0.0, "username": None}
-        save_data(DATA)
-
-def gen_deal_id() -> str:
-    # Формат: #A123 где буква A..Z случайная, число 1..999999
-    import random, string
-    letter = random.choice(string.ascii_uppercase)
-    number = random.randint(1, 999999)
-    return f"#{letter}{number}"
+# балансы и сделки пишутся сразу, навигационное UI-состояние копится и сбрасывается пачкой;
+# в кластере last_message_id чужого чата может поменять другой воркер (уведомления),
+# поэтому кеш уже сброшенных значений там не держим
+ARCHIVE = DealArchive(ARCHIVE_DIR)
+STORE = CoalescingStore(
+    open_store(STORAGE_BACKEND, DATA_FILE, SQLITE_FILE, fsync_interval=JOURNAL_FSYNC_INTERVAL,
+               compact_threshold=JOURNAL_COMPACT_THRESHOLD, sqlite_workers=SQLITE_WORKERS, archive=ARCHIVE),
+    flush_interval=VOLATILE_FLUSH_INTERVAL,
+    clean_cache_size=0 if WORKER_COUNT > 1 else 10000,
+)
+
+# завершённые сделки уходят из хранилища в архив; в кластере переносит только воркер 0
+ARCHIVER = DealArchiver(STORE, ARCHIVE, interval=ARCHIVE_INTERVAL, batch_size=ARCHIVE_BATCH)
+
+# журнал проводок сверяется с кешированными балансами; в кластере — только воркер 0
+RECONCILER = LedgerReconciler(STORE, interval=LEDGER_RECONCILE_INTERVAL)
+
+# SIGTERM останавливает приём апдейтов; принятые дорабатываются (до SHUTDOWN_TIMEOUT),
+# offset и незавершённые апдейты сохраняются в хранилище и подхватываются после рестарта
+LIFECYCLE = Lifecycle()
+UPDATES = UpdateRunner(dispatcher_handler(dp, bot), max_concurrency=WEBHOOK_MAX_CONCURRENCY, store=STORE)
+POLLER = Poller(bot, UPDATES)
+
+# сроки сделок и обслуживание по расписанию; очередь задач — в хранилище
+SCHEDULER = Scheduler(STORE, max_concurrency=SCHEDULER_CONCURRENCY, shard=WORKER_INDEX)
+
+# номера сделок: уникальны, без коллизий со старыми случайными номерами
+DEAL_IDS = DealIdAllocator(STORE)
+
+# уведомления второй стороне сделки уходят через очередь с учётом лимитов Telegram;
+# общий лимит бота делится между воркерами кластера
+OUTBOX = Outbox(bot, STORE, global_rate=OUTBOX_GLOBAL_RATE / WORKER_COUNT, chat_rate=OUTBOX_CHAT_RATE,
+                shard=WORKER_INDEX)
+
+# сериализуют обработку одного пользователя / одной сделки (двойные тапы и т.п.);
+# в кластере действуют внутри воркера — межпроцессную атомарность сделок даёт SQLite
+LOCKS = KeyedLocks()
+
+def user_lock(uid: int) -> str:
+    return f"user:{uid}"
+
+def deal_lock(deal_id: str) -> str:
+    return f"deal:{deal_id}"
+
+async def ensure_user(uid: int) -> Dict[str, Any]:
+    return await STORE.get_user(uid)
+
+async def gen_deal_id() -> str:
+    # Формат: #A123 где буква A..Z, число 1..999999 (см. deal_ids.py)
+    return await DEAL_IDS.allocate()
 
 def valid_deal_id_format(did: str) -> bool:
     # ожидаем латинскую букву и 1-6 цифр, с # впереди
-    return bool(re.fullmatch(r"#[A-Z]\d{1,6}", did))
-
-def get_chat_record(chat_id: int) -> Dict[str, Any]:
-    k = str(chat_id)
-    return DATA["chats"].get(k, {})
+    return len(did) <= 8 and DEAL_ID_RE.fullmatch(did) is not None
 
-def set_last_message(chat_id: int, message_id: int):
-    DATA["chats"][str(chat_id)] = {"last_message_id": message_id}
-    save_data(DATA)
+# навигационные экраны: правка последнего фото, без лишних запросов к API (см. message_state.py)
+MESSAGES = MessageTracker(bot, STORE)
 
-def get_last_message_id(chat_id: int) -> int | None:
-    rec = DATA["chats"].get(str(chat_id), {})
-    return rec.get("last_message_id")
+async def set_last_message(chat_id: int, message_id: int):
+    # после send_photo: это фото станет целью правки для следующих экранов
+    await STORE.set_chat_message(chat_id, message_record(message_id, "photo"))
 
 # ----------------- FSM States -----------------
 class SellerStates(StatesGroup):
@@ -81,12 +207,16 @@ class BuyerStates(StatesGroup):
     waiting_deal_id = State()
 
 # ----------------- Keyboards -----------------
+# клавиатуры и подписи кешируются: объекты aiogram неизменяемы, их можно
+# переиспользовать между апдейтами вместо сборки pydantic-моделей на каждый клик
+@lru_cache(maxsize=None)
 def kb_start_continue():
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Продолжить", callback_data="start_continue")]
     ])
     return kb
 
+@lru_cache(maxsize=None)
 def kb_main():
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -97,6 +227,15 @@ def kb_main():
     ])
     return kb
 
+@lru_cache(maxsize=None)
+def kb_seller_intro():
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Продолжить", callback_data="seller_start")],
+        [InlineKeyboardButton(text="↩️ Назад", callback_data="go_back_main")]
+    ])
+    return kb
+
+@lru_cache(maxsize=None)
 def kb_role_choice():
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🧑‍💼 Продавец", callback_data="role_seller"),
@@ -105,6 +244,7 @@ def kb_role_choice():
     ])
     return kb
 
+@lru_cache(maxsize=None)
 def kb_deal_actions():
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Продолжить ✔️", callback_data="deal_continue"),
@@ -112,6 +252,7 @@ def kb_deal_actions():
     ])
     return kb
 
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
 def kb_after_create_to_share(deal_id: str):
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Отправить покупателю", switch_inline_query=deal_id)],
@@ -119,18 +260,41 @@ def kb_after_create_to_share(deal_id: str):
     ])
     return kb
 
-def kb_in_process_for_seller():
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def kb_in_process_for_seller(deal_id: str):
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Товар Передан", callback_data="item_transferred")]
+        [InlineKeyboardButton(text="Товар Передан", callback_data=f"item_transferred:{deal_id}")]
     ])
     return kb
 
-def kb_wait_buyer_confirm():
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def kb_wait_buyer_confirm(deal_id: str):
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Я получил товар — Продолжить", callback_data="buyer_confirm_receive")]
+        [InlineKeyboardButton(text="Я получил товар — Продолжить", callback_data=f"buyer_confirm_receive:{deal_id}")]
     ])
     return kb
 
+# действие кнопки выбора -> (роль пользователя, статус сделок), см. pick_deal_page_cb
+PICK_ACTIONS = {"item_transferred": ("seller", "in_process"), "buyer_confirm_receive": ("buyer", "transferred")}
+
+def kb_pick_deal(action: str, deals: List[Dict[str, Any]], offset: int = 0):
+    # выбор конкретной сделки, если у пользователя их несколько в одном статусе;
+    # по PICK_PAGE_SIZE на страницу, листание — pick_page:<действие>:<смещение>
+    rows = [
+        [InlineKeyboardButton(text=f"{d['id']} — {d['name']}", callback_data=f"{action}:{d['id']}")]
+        for d in deals[offset:offset + PICK_PAGE_SIZE]
+    ]
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"pick_page:{action}:{max(0, offset - PICK_PAGE_SIZE)}"))
+    if offset + PICK_PAGE_SIZE < len(deals):
+        nav.append(InlineKeyboardButton(text="Ещё ➡️", callback_data=f"pick_page:{action}:{offset + PICK_PAGE_SIZE}"))
+    if nav:
+        rows.append(nav)
+    kb = InlineKeyboardMarkup(inline_keyboard=rows)
+    return kb
+
+@lru_cache(maxsize=None)
 def kb_balance_withdraw():
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Запросить вывод", url="https://t.me/GiftCastleRelayer")],
@@ -139,6 +303,7 @@ def kb_balance_withdraw():
     return kb
 
 # ----------------- Messaging Content -----------------
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
 def start_welcome_text(username: str) -> str:
     # >=20 words, Markdown formatting
     text = (
@@ -151,6 +316,7 @@ def start_welcome_text(username: str) -> str:
     )
     return text
 
+@lru_cache(maxsize=None)
 def intro_screen_text() -> str:
     text = (
         "🏰 *Gift Castle — ваш надёжный партнёр в торговле на платформе Telegram!*  \n\n"
@@ -161,12 +327,68 @@ def intro_screen_text() -> str:
     )
     return text
 
+@lru_cache(maxsize=None)
+def start_continue_text() -> str:
+    return "*🎖️ Gift Castle — Эталон безопасных сделок!*  \n\n" + intro_screen_text()
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def deal_summary_text(deal_id: str, seller_username: str, name: str, description: str, price: int) -> str:
+    return (
+        f"*Сделка {deal_id}*  \n\n"
+        f"👨‍💼 *Продавец:* @{seller_username}  \n"
+        f"✅ *Товар:* \"{name}\"  \n"
+        f"🗒️ *Описание:* {description}  \n"
+        f"💵 *Стоимость:* {format_amount(price)} ₽  \n\n"
+        "Для продолжения нажмите *Продолжить ✔️*, для отмены — *Отмена ❌*."
+    )
+
+@lru_cache(maxsize=None)
+def inline_howto_result() -> types.InlineQueryResultArticle:
+    return types.InlineQueryResultArticle(
+        id="howto",
+        title="Отправить номер сделки покупателю",
+        input_message_content=types.InputTextMessageContent(message_text="Отправьте номер сделки покупателю, чтобы он мог присоединиться: #A123"),
+        description="Отправьте покупателю ссылку/номер сделки"
+    )
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def inline_deal_result(deal_id: str, name: str, price: int) -> types.InlineQueryResultArticle:
+    price = format_amount(price)
+    txt = f"*Сделка {deal_id}* — {name} — {price} ₽  \nПрисоединяйтесь, чтобы участвовать в безопасной сделке."
+    return types.InlineQueryResultArticle(
+        id=deal_id, title=f"Сделка {deal_id}", input_message_content=types.InputTextMessageContent(message_text=txt, parse_mode="Markdown"),
+        description=f"{name} — {price} ₽"
+    )
+
+# все функции рендера — для прогрева на старте и для bench/render_cache.py
+RENDER_STATIC = (kb_start_continue, kb_main, kb_seller_intro, kb_role_choice, kb_deal_actions, kb_balance_withdraw,
+                 intro_screen_text, start_continue_text, inline_howto_result)
+RENDER_PARAMETRIZED = (kb_after_create_to_share, kb_in_process_for_seller, kb_wait_buyer_confirm,
+                       start_welcome_text, deal_summary_text, inline_deal_result)
+
+def warm_render_cache():
+    for fn in RENDER_STATIC:
+        fn()
+
+# inline-поиск открытых сделок по префиксу номера или названию
+INLINE_SEARCH = InlineSearch(STORE, inline_deal_result, inline_howto_result, page_size=INLINE_PAGE_SIZE,
+                             cache_time=INLINE_CACHE_TIME)
+
 # ----------------- Handlers -----------------
+async def find_callback_deals(c: CallbackQuery, role: str, status: str) -> List[Dict[str, Any]]:
+    # в кнопках номер сделки передаётся в callback_data ("item_transferred:#A123");
+    # у старых кнопок его нет — тогда берём все сделки пользователя из индекса
+    _, _, deal_id = c.data.partition(":")
+    if deal_id:
+        deal = await STORE.find_deal(deal_id)
+        if deal is not None and deal.get(f"{role}_id") == c.from_user.id and deal["status"] == status:
+            return [deal]
+        return []
+    return await STORE.find_party_deals(role, c.from_user.id, status)
+
 @dp.message(Command(commands=["start"]))
 async def cmd_start(m: Message, state: FSMContext):
-    ensure_user(m.from_user.id)
-    DATA["users"][str(m.from_user.id)]["username"] = m.from_user.username or m.from_user.full_name
-    save_data(DATA)
+    await STORE.set_username(m.from_user.id, m.from_user.username or m.from_user.full_name)
 
     caption = start_welcome_text("@" + (m.from_user.username or m.from_user.full_name))
     # send photo and save last message id to edit in future
@@ -176,74 +398,40 @@ async def cmd_start(m: Message, state: FSMContext):
         caption=caption,
         reply_markup=kb_start_continue()
     )
-    set_last_message(m.chat.id, sent.message_id)
+    await set_last_message(m.chat.id, sent.message_id)
 
-@dp.callback_query(Text("start_continue"))
+@dp.callback_query(F.data == "start_continue")
 async def on_start_continue(c: CallbackQuery):
     await c.answer()
-    caption = "*🎖️ Gift Castle — Эталон безопасных сделок!*  \n\n"
-    caption += intro_screen_text()
+    caption = start_continue_text()
     # include small decorative line and buttons
-    last_id = get_last_message_id(c.message.chat.id)
-    try:
-        await bot.edit_message_caption(
-            chat_id=c.message.chat.id,
-            message_id=last_id or c.message.message_id,
-            caption=caption,
-            reply_markup=kb_main()
-        )
-        set_last_message(c.message.chat.id, last_id or c.message.message_id)
-    except Exception:
-        # fallback: send new
-        sent = await bot.send_photo(chat_id=c.message.chat.id, photo=PHOTO_ID, caption=caption, reply_markup=kb_main())
-        set_last_message(c.message.chat.id, sent.message_id)
-
-@dp.callback_query(Text("go_back_main"))
+    await MESSAGES.show_photo(c.message.chat.id, PHOTO_ID, caption, kb_main(), current=c.message)
+
+@dp.callback_query(F.data == "go_back_main")
 async def go_back(c: CallbackQuery):
     await c.answer()
     caption = intro_screen_text()
-    last_id = get_last_message_id(c.message.chat.id)
-    try:
-        await bot.edit_message_caption(chat_id=c.message.chat.id, message_id=last_id or c.message.message_id, caption=caption, reply_markup=kb_main())
-        set_last_message(c.message.chat.id, last_id or c.message.message_id)
-    except Exception:
-        sent = await bot.send_photo(chat_id=c.message.chat.id, photo=PHOTO_ID, caption=caption, reply_markup=kb_main())
-        set_last_message(c.message.chat.id, sent.message_id)
+    await MESSAGES.show_photo(c.message.chat.id, PHOTO_ID, caption, kb_main(), current=c.message)
 
 # ----- Create deal flow -----
-@dp.callback_query(Text("create_deal"))
+@dp.callback_query(F.data == "create_deal")
 async def create_deal_cb(c: CallbackQuery):
     await c.answer()
     caption = "📝 *Создание сделки*  \n\n• Пожалуйста, выберите роль в сделке для её создания.  \n\n" \
               "_Сделка — это соглашение между сторонами, направленное на передачу товара и оплату. " \
               "Выберите роль, чтобы начать процесс._"
-    last_id = get_last_message_id(c.message.chat.id)
-    try:
-        await bot.edit_message_caption(chat_id=c.message.chat.id, message_id=last_id or c.message.message_id, caption=caption, reply_markup=kb_role_choice())
-        set_last_message(c.message.chat.id, last_id or c.message.message_id)
-    except Exception:
-        sent = await bot.send_photo(chat_id=c.message.chat.id, photo=PHOTO_ID, caption=caption, reply_markup=kb_role_choice())
-        set_last_message(c.message.chat.id, sent.message_id)
+    await MESSAGES.show_photo(c.message.chat.id, PHOTO_ID, caption, kb_role_choice(), current=c.message)
 
 # Seller path
-@dp.callback_query(Text("role_seller"))
+@dp.callback_query(F.data == "role_seller")
 async def role_seller(c: CallbackQuery):
     await c.answer()
     caption = "🧑‍💼 *Продавец*  \n\nПродавец — сторона, которая обязуется передать товар в собственность покупателя и получить за него плату.  \n\n" \
               "Нажмите *Продолжить*, чтобы задать параметры товара и создать сделку."
-    last_id = get_last_message_id(c.message.chat.id)
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Продолжить", callback_data="seller_start")],
-        [InlineKeyboardButton(text="↩️ Назад", callback_data="go_back_main")]
-    ])
-    try:
-        await bot.edit_message_caption(chat_id=c.message.chat.id, message_id=last_id or c.message.message_id, caption=caption, reply_markup=kb)
-        set_last_message(c.message.chat.id, last_id or c.message.message_id)
-    except Exception:
-        sent = await bot.send_photo(chat_id=c.message.chat.id, photo=PHOTO_ID, caption=caption, reply_markup=kb)
-        set_last_message(c.message.chat.id, sent.message_id)
+    kb = kb_seller_intro()
+    await MESSAGES.show_photo(c.message.chat.id, PHOTO_ID, caption, kb, current=c.message)
 
-@dp.callback_query(Text("seller_start"))
+@dp.callback_query(F.data == "seller_start")
 async def seller_start(c: CallbackQuery, state: FSMContext):
     await c.answer()
     await state.set_state(SellerStates.waiting_type)
@@ -269,43 +457,46 @@ async def seller_receive_description(m: Message, state: FSMContext):
     await m.reply("💵 *Введите стоимость товара в ₽* — цифрами, без символов.", reply=False)
 
 @dp.message(SellerStates.waiting_price)
-async def seller_receive_price(m: Message, state: FSMContext):
+async def seller_receive_price(m: Message, state: FSMContext, event_update: Update):
     txt = m.text.strip().replace(",", ".")
     try:
-        price = float(re.sub(r"[^\d.]", "", txt))
-    except Exception:
+        price = parse_amount(re.sub(r"[^\d.]", "", txt))
+    except ValueError:
         await m.reply("⚠️ Неверный формат суммы. Введите только числа, например: 1234 или 1234.56", reply=False)
         return
     data = await state.get_data()
-    deal_id = gen_deal_id()
+    deal_id = await gen_deal_id()
     seller_uid = m.from_user.id
-    ensure_user(seller_uid)
-    DATA["deals"][deal_id] = {
+    await ensure_user(seller_uid)
+    deal = {
         "id": deal_id,
         "type": data.get("item_type"),
         "name": data.get("item_name"),
         "description": data.get("item_description"),
-        "price": price,
+        "price_minor": price,
         "seller_id": seller_uid,
         "seller_username": m.from_user.username or m.from_user.full_name,
         "buyer_id": None,
         "status": "open"  # open -> in_process -> transferred -> completed or cancelled
     }
-    save_data(DATA)
+    # повтор апдейта после рестарта вернёт уже созданную сделку, а не вторую такую же
+    deal = await STORE.create_deal(deal, update_id=event_update.update_id)
+    deal_id = deal["id"]
+    await track_deal(deal_id, "open")
     await state.clear()
-    caption = f"✅ *Сделка {deal_id} успешно создана!*  \n\n• *Тип товара:* {DATA['deals'][deal_id]['type']}  \n• *Название товара:* {DATA['deals'][deal_id]['name']}  \n• *Описание:* {DATA['deals'][deal_id]['description']}  \n• *Цена:* {DATA['deals'][deal_id]['price']} ₽  \n\nОтправьте покупателю номер сделки для присоединения — он подключится к операции и процесс пойдёт дальше."
+    caption = f"✅ *Сделка {deal_id} успешно создана!*  \n\n• *Тип товара:* {deal['type']}  \n• *Название товара:* {deal['name']}  \n• *Описание:* {deal['description']}  \n• *Цена:* {format_amount(price)} ₽  \n\nОтправьте покупателю номер сделки для присоединения — он подключится к операции и процесс пойдёт дальше."
     sent = await bot.send_photo(chat_id=m.chat.id, photo=PHOTO_ID, caption=caption, reply_markup=kb_after_create_to_share(deal_id))
-    set_last_message(m.chat.id, sent.message_id)
+    await set_last_message(m.chat.id, sent.message_id)
 
 # Buyer path
-@dp.callback_query(Text("role_buyer"))
-async def role_buyer(c: CallbackQuery):
+@dp.callback_query(F.data == "role_buyer")
+async def role_buyer(c: CallbackQuery, state: FSMContext):
     await c.answer()
-    await BuyerStates.waiting_deal_id.set()
+    await state.set_state(BuyerStates.waiting_deal_id)
     # ask for deal id
     sent = await bot.send_photo(chat_id=c.message.chat.id, photo=PHOTO_ID,
                          caption="🧾 *Покупатель*  \n\nВведите номер сделки в формате `#A123` для присоединения к сделке.  \n\n_Пример: #A1, #B12, #C1234 — буква латинская + 1–6 цифр._")
-    set_last_message(c.message.chat.id, sent.message_id)
+    await set_last_message(c.message.chat.id, sent.message_id)
 
 @dp.message(BuyerStates.waiting_deal_id)
 async def buyer_enter_deal_id(m: Message, state: FSMContext):
@@ -313,168 +504,162 @@ async def buyer_enter_deal_id(m: Message, state: FSMContext):
     if not valid_deal_id_format(text):
         await m.reply("❗ Формат номера сделки неверный. Пример правильного формата: `#A123` — латинская буква и 1–6 цифр.", parse_mode="Markdown")
         return
-    if text not in DATA["deals"]:
+    deal = await STORE.find_deal(text)
+    if deal is None:
         await m.reply("⚠️ Сделка с таким номером не найдена. Проверьте корректность и попробуйте снова.")
         return
-    deal = DATA["deals"][text]
     if deal["status"] != "open":
         await m.reply("ℹ️ Эта сделка уже не доступна для присоединения — проверьте статус у продавца.")
         return
     buyer_uid = m.from_user.id
-    ensure_user(buyer_uid)
+    await ensure_user(buyer_uid)
     # show deal summary with actions
-    caption = (
-        f"*Сделка {text}*  \n\n"
-        f"👨‍💼 *Продавец:* @{deal['seller_username']}  \n"
-        f"✅ *Товар:* \"{deal['name']}\"  \n"
-        f"🗒️ *Описание:* {deal['description']}  \n"
-        f"💵 *Стоимость:* {deal['price']} ₽  \n\n"
-        "Для продолжения нажмите *Продолжить ✔️*, для отмены — *Отмена ❌*."
-    )
+    caption = deal_summary_text(text, deal['seller_username'], deal['name'], deal['description'], deal_price(deal))
     # store buyer choice in temp session
     await state.update_data(joining_deal=text)
     sent = await bot.send_photo(chat_id=m.chat.id, photo=PHOTO_ID, caption=caption, reply_markup=kb_deal_actions())
-    set_last_message(m.chat.id, sent.message_id)
+    await set_last_message(m.chat.id, sent.message_id)
 
-@dp.callback_query(Text("deal_continue"))
+@dp.callback_query(F.data == "deal_continue", flags={"throttle": "deal"})
 async def buyer_continue_cb(c: CallbackQuery, state: FSMContext):
     await c.answer()
-    ctx = await state.get_data()
-    deal_id = ctx.get("joining_deal")
-    if not deal_id or deal_id not in DATA["deals"]:
+    buyer_uid = c.from_user.id
+    # проверка баланса, списание и перевод в эскроу — одна транзакция хранилища,
+    # которая уже сохранена на диск к моменту отправки уведомлений
+    async with LOCKS.hold(user_lock(buyer_uid)):
+        ctx = await state.get_data()
+        deal_id = ctx.get("joining_deal")
+        result, deal = JOIN_NOT_FOUND, None
+        if deal_id:
+            async with LOCKS.hold(deal_lock(deal_id)):
+                result, deal = await STORE.join_deal(deal_id, buyer_uid, c.from_user.username or c.from_user.full_name)
+    if result == JOIN_NOT_FOUND:
         await bot.send_message(chat_id=c.from_user.id, text="Ошибка: данные о сделке потеряны. Попробуйте снова.")
         await state.clear()
         return
-    deal = DATA["deals"][deal_id]
-    buyer_uid = c.from_user.id
-    ensure_user(buyer_uid)
-    buyer_balance = DATA["users"][str(buyer_uid)]["balance"]
-    price = float(deal["price"])
-    if buyer_balance < price:
+    if result == JOIN_INSUFFICIENT:
         caption = "⚠️ *Ошибка:* Недостаточно средств для продолжения сделки.  \n\n" \
                   "Пожалуйста, пополните баланс или свяжитесь с поддержкой для уточнений."
         await bot.send_photo(chat_id=c.message.chat.id, photo=PHOTO_ID, caption=caption, reply_markup=kb_balance_withdraw())
         return
-    # списываем средства с покупателя (виртуально) и переводим в эскроу (внутр. поле)
-    DATA["users"][str(buyer_uid)]["balance"] = round(buyer_balance - price, 6)
-    deal["buyer_id"] = buyer_uid
-    deal["buyer_username"] = c.from_user.username or c.from_user.full_name
-    deal["status"] = "in_process"
-    # эскроу: сохраняем в поле escrow_amount (виртуально)
-    deal["escrow_amount"] = price
-    save_data(DATA)
+    if result != JOIN_OK:
+        # повторный тап или другой покупатель успел раньше
+        await bot.send_message(chat_id=c.from_user.id, text="ℹ️ Эта сделка уже не доступна для присоединения — проверьте статус у продавца.")
+        return
+    await track_deal(deal_id, "in_process", previous="open")
+    price = format_amount(deal["escrow_minor"])
 
     # уведомления
     caption = f"💳 *Покупатель присоединился к сделке {deal_id}!*  \n\n" \
               f"Вы присоединились к сделке {deal_id}; ожидайте ответа от продавца. " \
               f"Средства в размере *{price} ₽* зарезервированы в гарант-аккаунте до подтверждения передачи товара."
     sent = await bot.send_photo(chat_id=c.message.chat.id, photo=PHOTO_ID, caption=caption)
-    set_last_message(c.message.chat.id, sent.message_id)
+    await set_last_message(c.message.chat.id, sent.message_id)
 
-    # уведомить продавца в личку (если доступно)
+    # уведомить продавца в личку (очередь доставит с повторами)
     seller_id = deal["seller_id"]
-    try:
-        caption2 = f"🔔 *Уведомление:* @{deal.get('buyer_username','покупатель')} присоединился к сделке {deal_id}.  \n\n" \
-                   "Для продолжения передайте товар поддержке @GiftCastleRelayer и нажмите кнопку *Товар Передан*."
-        await bot.send_photo(chat_id=seller_id, photo=PHOTO_ID, caption=caption2, reply_markup=kb_in_process_for_seller())
-    except Exception:
-        # не критично, можно не доставить
-        pass
-
-@dp.callback_query(Text("deal_cancel"))
+    caption2 = f"🔔 *Уведомление:* @{deal.get('buyer_username','покупатель')} присоединился к сделке {deal_id}.  \n\n" \
+               "Для продолжения передайте товар поддержке @GiftCastleRelayer и нажмите кнопку *Товар Передан*."
+    await OUTBOX.send_photo(seller_id, photo=PHOTO_ID, caption=caption2, reply_markup=kb_in_process_for_seller(deal_id))
+
+@dp.callback_query(F.data == "deal_cancel", flags={"throttle": "deal"})
 async def deal_cancel_cb(c: CallbackQuery, state: FSMContext):
     await c.answer("Вы отменили продолжение сделки; вернитесь в меню.", show_alert=False)
     await state.clear()
     caption = "Вы отменили продолжение сделки. Возвращайтесь в меню и начните заново, когда будете готовы."
     sent = await bot.send_photo(chat_id=c.message.chat.id, photo=PHOTO_ID, caption=caption, reply_markup=kb_main())
-    set_last_message(c.message.chat.id, sent.message_id)
+    await set_last_message(c.message.chat.id, sent.message_id)
 
 # Seller confirms transferred to support
-@dp.callback_query(Text("item_transferred"))
+@dp.callback_query(F.data.startswith("item_transferred"), flags={"throttle": "deal"})
 async def seller_transferred_cb(c: CallbackQuery):
     await c.answer()
     # find deal where this seller has in_process status
-    seller_id = c.from_user.id
-    # find the most recent in_process deal by this seller (simplified)
-    deal = None
-    for d in DATA["deals"].values():
-        if d["seller_id"] == seller_id and d["status"] == "in_process":
-            deal = d
-            break
-    if not deal:
+    deals = await find_callback_deals(c, "seller", "in_process")
+    if not deals:
         await bot.send_message(chat_id=c.from_user.id, text="ℹ️ Сделка в статусе 'в процессе' не найдена. Возможно, она уже обработана.")
         return
-    deal_id = deal["id"]
-    deal["status"] = "transferred"
-    save_data(DATA)
+    if len(deals) > 1:
+        await bot.send_message(chat_id=c.from_user.id, text="ℹ️ У вас несколько сделок в процессе — выберите, по какой товар передан.",
+                               reply_markup=kb_pick_deal("item_transferred", deals))
+        return
+    deal_id = deals[0]["id"]
+    async with LOCKS.hold(deal_lock(deal_id)):
+        deal = await STORE.transition_deal(deal_id, "in_process", "transferred")
+    if deal is None:
+        await bot.send_message(chat_id=c.from_user.id, text="ℹ️ Сделка в статусе 'в процессе' не найдена. Возможно, она уже обработана.")
+        return
+    await track_deal(deal_id, "transferred", previous="in_process")
     # notify buyer
     buyer_id = deal.get("buyer_id")
     if buyer_id:
         caption = f"📦 *Сделка {deal_id} — Товар передан!*  \n\nПродавец подтвердил передачу товара поддержке. " \
                   "После получения товара нажмите кнопку *Я получил товар — Продолжить*, чтобы завершить сделку и освободить средства продавцу."
-        try:
-            sent = await bot.send_photo(chat_id=buyer_id, photo=PHOTO_ID, caption=caption, reply_markup=kb_wait_buyer_confirm())
-            set_last_message(buyer_id, sent.message_id)
-        except Exception:
-            pass
+        await OUTBOX.send_photo(buyer_id, photo=PHOTO_ID, caption=caption, reply_markup=kb_wait_buyer_confirm(deal_id),
+                                track_last_message=True)
     # confirm to seller
     await bot.send_message(chat_id=c.from_user.id, text=f"✅ Вы подтвердили передачу товара по сделке {deal_id}. Ожидайте подтверждения от покупателя.")
 
 # Buyer confirms receipt -> complete deal
-@dp.callback_query(Text("buyer_confirm_receive"))
+@dp.callback_query(F.data.startswith("buyer_confirm_receive"), flags={"throttle": "deal"})
 async def buyer_confirm_cb(c: CallbackQuery):
     await c.answer()
     # find deal by this buyer with status transferred
-    buyer_id = c.from_user.id
-    deal = None
-    for d in DATA["deals"].values():
-        if d.get("buyer_id") == buyer_id and d["status"] == "transferred":
-            deal = d
-            break
-    if not deal:
+    deals = await find_callback_deals(c, "buyer", "transferred")
+    if not deals:
         await bot.send_message(chat_id=c.from_user.id, text="ℹ️ Подтверждаемых сделок не найдено. Проверьте статусы.")
         return
+    if len(deals) > 1:
+        await bot.send_message(chat_id=c.from_user.id, text="ℹ️ Товар передан по нескольким сделкам — выберите, получение какой подтверждаете.",
+                               reply_markup=kb_pick_deal("buyer_confirm_receive", deals))
+        return
+    deal = deals[0]
     deal_id = deal["id"]
-    amount = float(deal.get("escrow_amount", 0.0))
     seller_id = deal["seller_id"]
-    # credit seller balance
-    ensure_user(seller_id)
-    DATA["users"][str(seller_id)]["balance"] = round(DATA["users"][str(seller_id)]["balance"] + amount, 6)
-    deal["status"] = "completed"
-    # cleanup escrow
-    deal["escrow_amount"] = 0.0
-    save_data(DATA)
+    # credit seller balance and cleanup escrow — атомарно, повторный тап ничего не зачислит
+    async with LOCKS.hold(deal_lock(deal_id)):
+        amount = await STORE.complete_deal(deal_id, c.from_user.id)
+    if amount is None:
+        await bot.send_message(chat_id=c.from_user.id, text="ℹ️ Подтверждаемых сделок не найдено. Проверьте статусы.")
+        return
+    await track_deal(deal_id, None, previous="transferred")
 
     # notify both
-    try:
-        await bot.send_photo(chat_id=seller_id, photo=PHOTO_ID,
-                             caption=f"🎉 *Сделка {deal_id} успешно завершена!*  \n\nТовар доставлен, средства в размере *{amount} ₽* зачислены на ваш баланс.")
-    except Exception:
-        pass
+    await OUTBOX.send_photo(seller_id, photo=PHOTO_ID,
+                            caption=f"🎉 *Сделка {deal_id} успешно завершена!*  \n\nТовар доставлен, средства в размере *{format_amount(amount)} ₽* зачислены на ваш баланс.")
     await bot.send_photo(chat_id=c.from_user.id, photo=PHOTO_ID,
                          caption=f"✅ *Сделка {deal_id} завершена!*  \n\nСпасибо за сделку — средства переведены продавцу, баланс обновлён.")
 
+@dp.callback_query(F.data.startswith("pick_page:"))
+async def pick_deal_page_cb(c: CallbackQuery):
+    await c.answer()
+    _, action, offset = c.data.split(":", 2)
+    if action not in PICK_ACTIONS or not offset.isdigit():
+        return
+    role, status = PICK_ACTIONS[action]
+    # список перечитывается: пока листали, часть сделок могла сменить статус
+    deals = await STORE.find_party_deals(role, c.from_user.id, status)
+    offset = min(int(offset), max(0, len(deals) - 1) // PICK_PAGE_SIZE * PICK_PAGE_SIZE)
+    try:
+        await bot.edit_message_reply_markup(chat_id=c.message.chat.id, message_id=c.message.message_id,
+                                            reply_markup=kb_pick_deal(action, deals, offset))
+    except TelegramBadRequest:
+        pass  # «message is not modified» на повторном нажатии или сообщение уже удалено
+
 # ----- Balance flow -----
-@dp.callback_query(Text("show_balance"))
+@dp.callback_query(F.data == "show_balance", flags={"throttle": "balance"})
 async def show_balance_cb(c: CallbackQuery):
     await c.answer()
     uid = c.from_user.id
-    ensure_user(uid)
-    bal = DATA["users"][str(uid)]["balance"]
+    bal = format_amount((await ensure_user(uid))["balance_minor"])
     caption = f"💰 *Ваш баланс: {bal} TON*  \n\n" \
               "Это внутренний баланс бота Gift Castle, предназначенный для взаимодействия в рамках сделок и управления расчетами. " \
               "Для вывода средств обратитесь в поддержку и ожидайте ответ от наших сотрудников."
-    last_id = get_last_message_id(c.message.chat.id)
-    try:
-        await bot.edit_message_caption(chat_id=c.message.chat.id, message_id=last_id or c.message.message_id, caption=caption, reply_markup=kb_balance_withdraw())
-        set_last_message(c.message.chat.id, last_id or c.message.message_id)
-    except Exception:
-        sent = await bot.send_photo(chat_id=c.message.chat.id, photo=PHOTO_ID, caption=caption, reply_markup=kb_balance_withdraw())
-        set_last_message(c.message.chat.id, sent.message_id)
+    await MESSAGES.show_photo(c.message.chat.id, PHOTO_ID, caption, kb_balance_withdraw(), current=c.message)
 
 # ----- Owner command: /gb id сумма -----
 @dp.message(Command(commands=["gb"]))
-async def cmd_gb(m: Message):
+async def cmd_gb(m: Message, event_update: Update):
     if m.from_user.id != OWNER_ID:
         await m.reply("_Команда доступна только владельцу бота._")
         return
@@ -484,42 +669,24 @@ async def cmd_gb(m: Message):
         return
     try:
         target_id = int(parts[1])
-        amount = float(parts[2])
-    except Exception:
+        amount = parse_amount(parts[2])
+    except ValueError:
         await m.reply("Неверный формат. ID должен быть числом, сумма — число (может содержать точку).")
         return
-    ensure_user(target_id)
-    DATA["users"][str(target_id)]["balance"] = round(DATA["users"][str(target_id)]["balance"] + amount, 6)
-    save_data(DATA)
-    await m.reply(f"✅ Баланс пользователя {target_id} успешно изменён на +{amount} TON. Текущий баланс: {DATA['users'][str(target_id)]['balance']} TON")
+    # повтор апдейта после рестарта не зачислит сумму второй раз
+    balance = await STORE.adjust_balance(target_id, amount, update_id=event_update.update_id)
+    change = format_amount(amount) if amount < 0 else "+" + format_amount(amount)
+    await m.reply(f"✅ Баланс пользователя {target_id} успешно изменён на {change} TON. "
+                  f"Текущий баланс: {format_amount(balance)} TON")
 
 # ----- Inline query support (публикация номера сделки в чате) -----
 @dp.inline_query()
 async def inline_q(inline_query: types.InlineQuery):
-    q = inline_query.query.strip().upper()
-    results = []
-    # если пустой запрос — предложим инструкцию
-    if q == "":
-        articles = types.InlineQueryResultArticle(
-            id="howto",
-            title="Отправить номер сделки покупателю",
-            input_message_content=types.InputTextMessageContent(message_text="Отправьте номер сделки покупателю, чтобы он мог присоединиться: #A123"),
-            description="Отправьте покупателю ссылку/номер сделки"
-        )
-        results.append(articles)
-    else:
-        # допускаем, что пользователь вводит #A123 — найдем сделку
-        if q in DATA["deals"]:
-            d = DATA["deals"][q]
-            txt = f"*Сделка {q}* — {d['name']} — {d['price']} ₽  \nПрисоединяйтесь, чтобы участвовать в безопасной сделке."
-            results.append(types.InlineQueryResultArticle(
-                id=q, title=f"Сделка {q}", input_message_content=types.InputTextMessageContent(message_text=txt, parse_mode="Markdown"),
-                description=f"{d['name']} — {d['price']} ₽"
-            ))
-    await inline_query.answer(results=results, cache_time=0)
+    # пустой запрос — инструкция; "#A1", "a12" — префикс номера; иначе — слово из названия
+    await INLINE_SEARCH.answer(inline_query)
 
 # ----- Generic help and fallback -----
-@dp.callback_query(Text("help"))
+@dp.callback_query(F.data == "help")
 async def help_cb(c: CallbackQuery):
     await c.answer()
     await bot.send_message(chat_id=c.from_user.id, text="Для помощи свяжитесь с поддержкой: @GiftCastleRelayer")
@@ -534,16 +701,234 @@ async def fallback(m: Message):
     )
     await m.reply(txt)
 
+# ----------------- Deal timeouts -----------------
+# у живой сделки одна задача на статус: "expire" — отмена (с возвратом эскроу покупателю),
+# "remind" — напоминание стороне, от которой ждём действия. Задача сверяет статус
+# при запуске: сделка, ушедшая дальше, ничего не получит
+DEAL_TIMEOUT_STATUSES = ("open", "in_process", "transferred")
+
+def deal_job_id(deal_id: str, status: str) -> str:
+    return f"deal:{deal_id}:{status}"
+
+def days(seconds: float) -> str:
+    return f"{seconds / 86400:g} дн."
+
+async def schedule_deal_step(deal_id: str, status: str, stage: str, delay: float, since: float, reminders: int = 0):
+    await SCHEDULER.schedule(deal_job_id(deal_id, status), "deal_timeout", delay, deal_id=deal_id, status=status,
+                             stage=stage, since=since, reminders=reminders)
+
+async def track_deal(deal_id: str, status: Optional[str], previous: Optional[str] = None):
+    # сделка только что перешла в status (None — завершена): срок прежнего статуса больше не нужен
+    if previous is not None:
+        await SCHEDULER.cancel(deal_job_id(deal_id, previous))
+    now = time.time()
+    if status == "open" and DEAL_OPEN_TTL:
+        await schedule_deal_step(deal_id, status, "expire", DEAL_OPEN_TTL, now)
+    elif status == "in_process" and DEAL_REMIND_AFTER and (not DEAL_TRANSFER_TTL or DEAL_REMIND_AFTER < DEAL_TRANSFER_TTL):
+        await schedule_deal_step(deal_id, status, "remind", DEAL_REMIND_AFTER, now)
+    elif status == "in_process" and DEAL_TRANSFER_TTL:
+        await schedule_deal_step(deal_id, status, "expire", DEAL_TRANSFER_TTL, now)
+    elif status == "transferred" and DEAL_REMIND_AFTER and DEAL_CONFIRM_REMINDERS:
+        # эскроу по переданному товару сам не освобождается и не возвращается — спор решает поддержка
+        await schedule_deal_step(deal_id, status, "remind", DEAL_REMIND_AFTER, now)
+
+async def expire_deal(deal: Dict[str, Any]):
+    deal_id, status = deal["id"], deal["status"]
+    async with LOCKS.hold(deal_lock(deal_id)):
+        refunded = await STORE.cancel_deal(deal_id, status)
+    if refunded is None:
+        return
+    logging.info("deal: %s отменена по сроку в статусе %s, возврат %s", deal_id, status, format_amount(refunded))
+    if status == "open":
+        await OUTBOX.send_message(deal["seller_id"], text=f"⌛ Сделка {deal_id} отменена: за {days(DEAL_OPEN_TTL)} к ней никто не присоединился. "
+                                                          "Создайте новую сделку, когда будете готовы.")
+        return
+    await OUTBOX.send_message(deal["seller_id"], text=f"⌛ Сделка {deal_id} отменена: товар не был передан за {days(DEAL_TRANSFER_TTL)}. "
+                                                      "Средства возвращены покупателю.")
+    await OUTBOX.send_message(deal["buyer_id"], text=f"⌛ Сделка {deal_id} отменена: продавец не передал товар за {days(DEAL_TRANSFER_TTL)}. "
+                                                     f"*{format_amount(refunded)} ₽* возвращены на ваш баланс.")
+
+async def deal_timeout(args: Dict[str, Any]):
+    deal_id, status = args["deal_id"], args["status"]
+    deal = await STORE.find_deal(deal_id)
+    if deal is None or deal["status"] != status:
+        return
+    if args["stage"] == "expire":
+        await expire_deal(deal)
+    elif status == "in_process":
+        await OUTBOX.send_photo(deal["seller_id"], photo=PHOTO_ID,
+                                caption=f"⏰ *Сделка {deal_id} ждёт передачи товара.*  \n\nПокупатель уже внёс средства. "
+                                        "Передайте товар поддержке @GiftCastleRelayer и нажмите кнопку *Товар Передан*"
+                                        + (f" — иначе сделка будет отменена через {days(args['since'] + DEAL_TRANSFER_TTL - time.time())}"
+                                           if DEAL_TRANSFER_TTL else "") + ".",
+                                reply_markup=kb_in_process_for_seller(deal_id))
+        if DEAL_TRANSFER_TTL:
+            await schedule_deal_step(deal_id, status, "expire", args["since"] + DEAL_TRANSFER_TTL - time.time(),
+                                     args["since"])
+    else:
+        await OUTBOX.send_photo(deal["buyer_id"], photo=PHOTO_ID,
+                                caption=f"⏰ *Сделка {deal_id}: продавец передал товар.*  \n\nЕсли товар получен, нажмите "
+                                        "*Я получил товар — Продолжить*. Если возникла проблема — напишите @GiftCastleRelayer.",
+                                reply_markup=kb_wait_buyer_confirm(deal_id))
+        if args["reminders"] + 1 < DEAL_CONFIRM_REMINDERS:
+            await schedule_deal_step(deal_id, status, "remind", DEAL_REMIND_AFTER, args["since"], args["reminders"] + 1)
+
+# ----------------- Scheduled maintenance -----------------
+async def deal_sweep(args: Dict[str, Any]):
+    # живые сделки без задачи срока — созданные до планировщика; срок им отсчитывается от находки
+    known = {job["id"] for job in await STORE.load_jobs()}
+    added = 0
+    for status in DEAL_TIMEOUT_STATUSES:
+        for deal_id in await STORE.deal_ids_with_status((status,)):
+            if deal_job_id(deal_id, status) not in known:
+                await track_deal(deal_id, status)
+                added += 1
+    if added:
+        logging.info("scheduler: назначены сроки %d сделкам", added)
+
+async def fsm_evict(args: Dict[str, Any]):
+    await FSM_STORAGE.evict_expired()
+
+async def storage_compaction(args: Dict[str, Any]):
+    if await STORE.compact():
+        logging.info("scheduler: плановое сжатие хранилища запущено")
+
+async def metrics_rollup(args: Dict[str, Any]):
+    # GROUP BY по всем сделкам — раз в ROLLUP_INTERVAL, а не на каждый запрос /metrics
+    DEALS.replace("status", await STORE.deal_counts())
+
+SCHEDULER.register("deal_timeout", deal_timeout)
+SCHEDULER.register("deal_sweep", deal_sweep)
+SCHEDULER.register("fsm_evict", fsm_evict)
+SCHEDULER.register("compact", storage_compaction)
+SCHEDULER.register("metrics_rollup", metrics_rollup)
+
 # ----------------- Startup/Shutdown -----------------
+@METRICS.collector
+async def collect_runtime_metrics():
+    STORE_STATS.replace("stat", STORE.metrics())
+    OUTBOX_DEPTH.set(OUTBOX.depth)
+    OUTBOX_STATS.replace("stat", OUTBOX.stats)
+    FSM_STATES.replace("state", await FSM_STORAGE.count_by_state())
+    FSM_CACHE_STATS.replace("stat", FSM_STORAGE.stats)
+    INLINE_STATS.replace("stat", INLINE_SEARCH.stats)
+    NAVIGATION_STATS.replace("stat", MESSAGES.stats)
+    ARCHIVE_STATS.replace("stat", dict(ARCHIVE.stats, **ARCHIVER.stats))
+    LEDGER_STATS.replace("stat", RECONCILER.stats)
+    SCHEDULER_STATS.replace("stat", dict(SCHEDULER.stats, queued=SCHEDULER.depth, running=SCHEDULER.running))
+    THROTTLE_STATS.replace("stat", THROTTLE.stats)
+    UPDATES_STATS.replace("stat", dict(UPDATES.stats, in_flight=UPDATES.in_flight, offset=UPDATES.offset,
+                                       **POLLER.stats))
+
+async def start_metrics():
+    # в webhook-режиме /metrics отдаёт сам webhook-сервер; воркеры кластера — на METRICS_PORT+1+номер
+    if not METRICS_PORT or BOT_MODE == "webhook":
+        return None
+    port = METRICS_PORT + 1 + WORKER_INDEX if BOT_MODE == "worker" else METRICS_PORT
+    try:
+        return await start_metrics_server(METRICS, "0.0.0.0", port)
+    except OSError as e:
+        # занятый порт не должен мешать боту работать — только метрикам
+        logging.error("metrics: не удалось открыть порт %d: %s", port, e)
+        return None
+
 async def on_startup():
     logging.info("Gift Castle Bot starting...")
+    warm_render_cache()
+    await FSM_STORAGE.evict_expired()
+    await STORE.start()
+    await OUTBOX.start()
+    await SCHEDULER.start()
+    await SCHEDULER.every("fsm_evict", FSM_EVICT_INTERVAL, first_delay=FSM_EVICT_INTERVAL)
+    if WORKER_INDEX == 0:
+        # общее для кластера хранилище обслуживает один воркер
+        await SCHEDULER.every("metrics_rollup", ROLLUP_INTERVAL)
+        await SCHEDULER.every("compact", COMPACT_INTERVAL, first_delay=COMPACT_INTERVAL)
+        await SCHEDULER.every("deal_sweep", DEAL_SWEEP_INTERVAL, first_delay=60)
+    if ARCHIVE_INTERVAL and WORKER_INDEX == 0:
+        await ARCHIVER.start()
+    if LEDGER_RECONCILE_INTERVAL and WORKER_INDEX == 0:
+        RECONCILER.start()
+
+async def run_webhook(runner: UpdateRunner):
+    if not WEBHOOK_URL:
+        raise SystemExit("Ошибка: для BOT_MODE=webhook нужна переменная окружения WEBHOOK_URL")
+    server = WebhookServer(runner, WEBHOOK_SECRET, path=WEBHOOK_PATH)
+    server.app.router.add_get("/metrics", METRICS.handle)
+    await runner.restore()
+    runner.start()
+    await server.start("0.0.0.0", PORT)
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=min(runner.max_concurrency, 100),
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    try:
+        await LIFECYCLE.wait()
+    finally:
+        await server.stop(SHUTDOWN_TIMEOUT)
+
+async def run_polling(runner: UpdateRunner, poller: Poller):
+    # getUpdates не работает, пока установлен webhook
+    await bot.delete_webhook()
+    await runner.restore()
+    runner.start()
+    try:
+        await poller.run(LIFECYCLE.stopping, dp.resolve_used_update_types())
+    finally:
+        await runner.drain(SHUTDOWN_TIMEOUT)
+
+async def run_coordinator():
+    # координатор сам ничего не обрабатывает — только принимает апдейты и раздаёт воркерам;
+    # route() ждёт подтверждения воркера, а в stdin пишет до первого await — порядок update_id сохраняется
+    coordinator = Coordinator([sys.executable, os.path.abspath(__file__)], WORKERS)
+    runner = UpdateRunner(coordinator.route, max_concurrency=WEBHOOK_MAX_CONCURRENCY, store=STORE)
+    LIFECYCLE.install_signal_handlers()
+    await coordinator.start()
+    metrics_runner = await start_metrics()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(runner)
+        else:
+            await run_polling(runner, Poller(bot, runner))
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await coordinator.stop(SHUTDOWN_TIMEOUT)
+        await STORE.close()
+        await ARCHIVE.close()
+        await FSM_STORAGE.close()
+        await bot.session.close()
 
 async def main():
+    if BOT_MODE != "worker" and WORKERS > 1:
+        await run_coordinator()
+        return
+    # воркер кластера останавливает координатор — закрытием stdin
+    LIFECYCLE.install_signal_handlers(ignore=BOT_MODE == "worker")
     await on_startup()
+    metrics_runner = await start_metrics()
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "worker":
+            await ShardWorker(dp, bot, max_concurrency=WEBHOOK_MAX_CONCURRENCY, ack_fd=WORKER_ACK_FD).serve(await read_stdin())
+        elif BOT_MODE == "webhook":
+            await run_webhook(UPDATES)
+        else:
+            await run_polling(UPDATES, POLLER)
     finally:
+        # хендлеры уже доработали: дальше — фоновые задачи, очередь уведомлений и сброс хранилища
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await SCHEDULER.stop()
+        await ARCHIVER.stop()
+        await RECONCILER.stop()
+        await OUTBOX.stop()
+        await STORE.close()
+        await ARCHIVE.close()
+        await FSM_STORAGE.close()
         await bot.session.close()
+        logging.info("Gift Castle Bot остановлен: %s", UPDATES.stats)
 
 if __name__ == "__main__":
     asyncio.run(main())
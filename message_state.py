@@ -0,0 +1,104 @@
+# message_state.py — навигационное сообщение чата и его состояние
+#
+# Экраны меню показываются правкой подписи последнего фото бота в чате.
+# Раньше каждый клик шёл «edit_message_caption, а при любой ошибке —
+# send_photo»: два запроса к API в плохих случаях, и «message is not modified»
+# считался такой же ошибкой. Теперь в записи чата (Store.set_chat_message)
+# хранится, что сейчас показано:
+#   last_message_id — сообщение, которое правим;
+#   kind            — "photo" | "text": у текстового сообщения нет подписи;
+#   hash            — хеш подписи и клавиатуры (None — неизвестно);
+#   sent_at         — время отправки: старые сообщения бот править не может.
+# Тот же экран повторно не отправляется вовсе, а заведомо неудачная правка
+# сразу заменяется отправкой нового фото.
+import hashlib
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, Message
+
+from storage import Store
+
+log = logging.getLogger(__name__)
+
+EDIT_WINDOW = 48 * 3600  # сек; сообщения старше бот править не может
+NOT_MODIFIED = "message is not modified"
+
+
+def content_hash(caption: str, reply_markup: Optional[InlineKeyboardMarkup]) -> str:
+    h = hashlib.blake2b(caption.encode("utf-8"), digest_size=12)
+    if reply_markup is not None:
+        h.update(reply_markup.model_dump_json(exclude_none=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+def message_record(message_id: int, kind: str = "photo", content: Optional[str] = None) -> Dict[str, Any]:
+    return {"last_message_id": message_id, "kind": kind, "hash": content, "sent_at": time.time()}
+
+
+def _sent_at(record: Optional[Dict[str, Any]], target: int, current: Optional[Message]) -> float:
+    # окно правки отсчитывается от отправки сообщения, а не от последней правки
+    if record and record.get("last_message_id") == target and record.get("sent_at"):
+        return record["sent_at"]
+    return current.date.timestamp() if current is not None else time.time()
+
+
+class MessageTracker:
+    def __init__(self, bot: Bot, store: Store, edit_window: float = EDIT_WINDOW):
+        self.bot = bot
+        self.store = store
+        self.edit_window = edit_window
+        self.stats = {"edited": 0, "unchanged": 0, "not_modified": 0, "edit_failed": 0, "sent": 0, "sent_directly": 0}
+
+    def _target(self, record: Optional[Dict[str, Any]], current: Optional[Message]) -> Tuple[Optional[int], bool]:
+        # какое сообщение править и есть ли смысл пытаться
+        now = time.time()
+        if record and record.get("last_message_id"):
+            # у старых записей есть только last_message_id — пробуем, как раньше
+            editable = record.get("kind", "photo") == "photo" and now - record.get("sent_at", now) < self.edit_window
+            return record["last_message_id"], editable
+        if current is not None:
+            return current.message_id, bool(current.photo) and now - current.date.timestamp() < self.edit_window
+        return None, False
+
+    async def show_photo(self, chat_id: int, photo: str, caption: str,
+                         reply_markup: Optional[InlineKeyboardMarkup] = None, current: Optional[Message] = None) -> int:
+        # current — сообщение, под которым нажата кнопка (запасная цель правки)
+        content = content_hash(caption, reply_markup)
+        record = await self.store.get_chat_message(chat_id)
+        target, editable = self._target(record, current)
+        if record and target == record.get("last_message_id") and record.get("hash") == content:
+            # на экране уже ровно это — повторный тап
+            self.stats["unchanged"] += 1
+            return target
+        if target is not None and editable:
+            try:
+                await self.bot.edit_message_caption(chat_id=chat_id, message_id=target, caption=caption,
+                                                    reply_markup=reply_markup)
+                self.stats["edited"] += 1
+            except TelegramBadRequest as e:
+                if NOT_MODIFIED not in e.message:
+                    # удалено пользователем, слишком старое, без подписи — больше не пробуем
+                    self.stats["edit_failed"] += 1
+                    log.info("message_state: правка %s/%s не удалась: %s", chat_id, target, e.message)
+                    return await self._send(chat_id, photo, caption, reply_markup, content)
+                self.stats["not_modified"] += 1
+            except Exception:
+                self.stats["edit_failed"] += 1
+                log.exception("message_state: ошибка правки %s/%s", chat_id, target)
+                return await self._send(chat_id, photo, caption, reply_markup, content)
+            await self.store.set_chat_message(chat_id, dict(message_record(target, "photo", content),
+                                                            sent_at=_sent_at(record, target, current)))
+            return target
+        self.stats["sent_directly"] += 1
+        return await self._send(chat_id, photo, caption, reply_markup, content)
+
+    async def _send(self, chat_id: int, photo: str, caption: str, reply_markup: Optional[InlineKeyboardMarkup],
+                    content: str) -> int:
+        sent = await self.bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, reply_markup=reply_markup)
+        self.stats["sent"] += 1
+        await self.store.set_chat_message(chat_id, message_record(sent.message_id, "photo", content))
+        return sent.message_id
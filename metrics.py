@@ -0,0 +1,199 @@
+# metrics.py — метрики в текстовом формате Prometheus и их сбор
+#
+# Без внешних зависимостей: счётчики, gauge и гистограммы с метками,
+# текстовая выдача для /metrics. Источники:
+#   * HandlerMetricsMiddleware — время и ошибки каждого хендлера aiogram;
+#   * ApiMetricsMiddleware — время и ошибки каждого вызова Bot API, в том числе
+#     тех, что хендлеры глотают в fallback (edit_message_caption → send_photo);
+#   * коллекторы — корутины, которые перед выдачей обновляют gauge из stats
+#     хранилища, очереди уведомлений, FSM и т.п.
+import bisect
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Tuple
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        name += "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+    return f"{name} {value!r}" if isinstance(value, float) else f"{name} {value}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+
+    def lines(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+    def samples(self) -> Iterable[str]:
+        return ()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.values.items():
+            yield _format(self.name, labels, value)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[_labels(labels)] = value
+
+    def replace(self, label: str, values: Dict[str, float]):
+        # весь набор значений одной метки разом: исчезнувшие ключи (состояния FSM и т.п.) пропадают
+        self.values = {((label, str(k)),): v for k, v in values.items()}
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+        # по меткам: [счётчики корзин (последняя — +Inf), сумма]
+        self.values: Dict[Labels, List[Any]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield _format(self.name + "_bucket", labels + (("le", le),), cumulative)
+            yield _format(self.name + "_sum", labels, total)
+            yield _format(self.name + "_count", labels, cumulative)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Awaitable[None]]] = []
+
+    def _add(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metrics: {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(name, help))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._add(Gauge(name, help))
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, buckets))
+
+    def collector(self, fn: Callable[[], Awaitable[None]]):
+        self._collectors.append(fn)
+        return fn
+
+    async def render(self) -> str:
+        for fn in self._collectors:
+            try:
+                await fn()
+            except Exception:
+                # одна сломанная метрика не должна отключать остальные
+                log.exception("metrics: ошибка коллектора %s", getattr(fn, "__name__", fn))
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(body=(await self.render()).encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # регистрируется как inner middleware: aiogram кладёт в data выбранный хендлер
+    def __init__(self, latency: Histogram, errors: Counter):
+        self.latency = latency
+        self.errors = errors
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            self.errors.inc(handler=name, error=type(e).__name__)
+            raise
+        finally:
+            self.latency.observe(time.perf_counter() - started, handler=name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    def __init__(self, latency: Histogram, errors: Counter):
+        self.latency = latency
+        self.errors = errors
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            self.errors.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            self.latency.observe(time.perf_counter() - started, method=name)
+
+
+async def start_metrics_server(registry: Registry, host: str, port: int) -> web.AppRunner:
+    # отдельный сервер для режимов без webhook (polling, воркеры кластера)
+    app = web.Application()
+    app.router.add_get("/metrics", registry.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("metrics: слушаем %s:%d/metrics", host, port)
+    return runner
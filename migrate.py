@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# migrate.py — разовый перенос data.json (снапшот data.snap или прежний JSON + журнал) в SQLite
+#
+#   python migrate.py [data.json] [gift_castle.sqlite3]
+import json
+import logging
+import sys
+from pathlib import Path
+
+from journal import Journal, SECTIONS
+from sqlite_store import connect, init_schema, deal_row, chat_row, index_deal_names
+
+
+def migrate(json_path: Path, sqlite_path: Path) -> dict:
+    # источник только читается: data.json не переименовывается, data.snap и сегменты не создаются
+    data = Journal(json_path).read()
+    conn = connect(sqlite_path)
+    init_schema(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (id, balance, balance_minor, username) VALUES (?, ?, ?, ?)",
+            ((int(uid), float(u.get("balance", 0.0)), u.get("balance_minor", 0), u.get("username"))
+             for uid, u in data["users"].items()),
+        )
+        # данные до ledger.py (нет meta.ledger_version) переведёт в проводки сам SqliteStore
+        conn.executemany(
+            "INSERT OR REPLACE INTO ledger (id, ts, kind, debit, credit, amount, deal_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((e["id"], e["ts"], e["kind"], e["debit"], e["credit"], e["amount"], e.get("deal_id"))
+             for e in data["ledger"].values()),
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO deals (id, seller_id, buyer_id, status, body) VALUES (?, ?, ?, ?, ?)",
+            (deal_row(d) for d in data["deals"].values()),
+        )
+        for deal in data["deals"].values():
+            if deal["status"] == "open":
+                index_deal_names(conn, deal)
+        conn.executemany(
+            "INSERT OR REPLACE INTO chats (id, last_message_id, state) VALUES (?, ?, ?)",
+            (chat_row(int(cid), c) for cid, c in data["chats"].items()),
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+            data["meta"].items(),
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO outbox (id, body) VALUES (?, ?)",
+            ((oid, json.dumps(item, ensure_ascii=False)) for oid, item in data["outbox"].items()),
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO jobs (id, body) VALUES (?, ?)",
+            ((jid, json.dumps(job, ensure_ascii=False)) for jid, job in data["jobs"].items()),
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO runtime (name, body) VALUES (?, ?)",
+            ((name, json.dumps(value, ensure_ascii=False)) for name, value in data["runtime"].items()),
+        )
+        # отметки применённых апдейтов переносятся вместе с runtime: pending не повторится дважды
+        conn.executemany(
+            "INSERT OR REPLACE INTO applied (update_id, ledger_id, deal_id) VALUES (?, ?, ?)",
+            ((int(uid), a.get("ledger_id"), a.get("deal_id")) for uid, a in data["applied"].items()),
+        )
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    conn.close()
+    return {s: len(data[s]) for s in SECTIONS}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    src = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("data.json")
+    dst = Path(sys.argv[2]) if len(sys.argv) > 2 else Path("gift_castle.sqlite3")
+    if not src.exists() and not src.with_suffix(".snap").exists():
+        raise SystemExit(f"Ошибка: файл {src} не найден")
+    counts = migrate(src, dst)
+    logging.info("Перенесено в %s: %s", dst, counts)
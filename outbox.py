@@ -0,0 +1,227 @@
+# outbox.py — очередь исходящих уведомлений с учётом лимитов Telegram
+#
+# Хендлер кладёт уведомление в очередь и сразу возвращается. Отправкой
+# занимается фоновый диспетчер:
+#   * общий token bucket (лимит бота) и token bucket на каждый чат;
+#   * TelegramRetryAfter приостанавливает всю отправку на указанное время;
+#   * сетевые/серверные ошибки — повтор с экспоненциальной задержкой и jitter;
+#   * уведомление хранится в Store до успешной доставки, поэтому переживает рестарт;
+#     в кластере каждый воркер после рестарта подхватывает только свои (поле shard).
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+import uuid
+from typing import Dict, Any, Optional, List, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+
+from storage import Store
+from message_state import message_record
+
+log = logging.getLogger(__name__)
+
+SUPPORTED_METHODS = ("send_photo", "send_message")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        # сколько ждать до появления токена (0 — можно сейчас)
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class Outbox:
+    def __init__(self, bot: Bot, store: Store, global_rate: float = 25.0, chat_rate: float = 1.0,
+                 chat_burst: float = 3.0, max_attempts: int = 8, max_in_flight: int = 16, shard: int = 0):
+        self.bot = bot
+        self.store = store
+        self.shard = shard
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._items: Dict[str, Dict[str, Any]] = {}
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._sending: Set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        self.stats = {"enqueued": 0, "sent": 0, "retried": 0, "retry_after": 0, "dropped": 0}
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    async def start(self):
+        # недоставленное до рестарта — снова в очередь
+        restored = [item for item in await self.store.load_outbox() if item.get("shard", 0) == self.shard]
+        for item in restored:
+            self._schedule(item, time.monotonic())
+        if restored:
+            log.info("outbox: восстановлено %d недоставленных уведомлений", len(restored))
+        self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # неотправленное остаётся в Store и уйдёт после следующего запуска
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+
+    async def enqueue(self, method: str, chat_id: int, track_last_message: bool = False, **params):
+        if method not in SUPPORTED_METHODS:
+            raise ValueError(f"outbox: метод {method} не поддерживается")
+        markup = params.get("reply_markup")
+        if isinstance(markup, InlineKeyboardMarkup):
+            params["reply_markup"] = markup.model_dump(exclude_none=True)
+        item = {
+            "id": uuid.uuid4().hex,
+            "method": method,
+            "chat_id": chat_id,
+            "params": params,
+            "attempts": 0,
+            "track_last_message": track_last_message,
+            "shard": self.shard,
+        }
+        await self.store.save_outbox(item)
+        self.stats["enqueued"] += 1
+        self._schedule(item, time.monotonic())
+
+    async def send_photo(self, chat_id: int, **params):
+        await self.enqueue("send_photo", chat_id, **params)
+
+    async def send_message(self, chat_id: int, **params):
+        await self.enqueue("send_message", chat_id, **params)
+
+    def _schedule(self, item: Dict[str, Any], due: float):
+        self._items[item["id"]] = item
+        heapq.heappush(self._heap, (due, next(self._seq), item["id"]))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _gc_buckets(self, now: float):
+        # полные корзины ничем не отличаются от новых — их можно забыть
+        for chat_id in [cid for cid, b in self._chat_buckets.items() if b.idle(now)]:
+            del self._chat_buckets[chat_id]
+
+    async def _run(self):
+        last_gc = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - last_gc > 60:
+                self._gc_buckets(now)
+                last_gc = now
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            due, _, item_id = self._heap[0]
+            wait = max(due, self._paused_until) - now
+            if wait > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            item = self._items[item_id]
+            chat_wait = self._chat_bucket(item["chat_id"]).delay(now)
+            if chat_wait > 0:
+                heapq.heappush(self._heap, (now + chat_wait, next(self._seq), item_id))
+                continue
+            global_wait = self.global_bucket.delay(now)
+            if global_wait > 0:
+                heapq.heappush(self._heap, (now + global_wait, next(self._seq), item_id))
+                continue
+            self._chat_bucket(item["chat_id"]).take(now)
+            self.global_bucket.take(now)
+            await self._slots.acquire()
+            task = asyncio.create_task(self._deliver(item))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _deliver(self, item: Dict[str, Any]):
+        try:
+            params = dict(item["params"])
+            if isinstance(params.get("reply_markup"), dict):
+                params["reply_markup"] = InlineKeyboardMarkup.model_validate(params["reply_markup"])
+            try:
+                sent = await getattr(self.bot, item["method"])(chat_id=item["chat_id"], **params)
+            except TelegramRetryAfter as e:
+                # flood control: останавливаем всю отправку, а не только этот чат
+                self.stats["retry_after"] += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                self._schedule(item, time.monotonic() + e.retry_after)
+                log.warning("outbox: RetryAfter %s с", e.retry_after)
+                return
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # бот заблокирован / чат не существует — повтор не поможет
+                log.warning("outbox: уведомление в %s не доставлено: %s", item["chat_id"], e)
+                await self._finish(item, dropped=True)
+                return
+            except Exception:
+                item["attempts"] += 1
+                if item["attempts"] >= self.max_attempts:
+                    log.exception("outbox: уведомление в %s не доставлено после %d попыток",
+                                  item["chat_id"], item["attempts"])
+                    await self._finish(item, dropped=True)
+                    return
+                backoff = min(300.0, 2 ** item["attempts"]) * random.uniform(0.5, 1.5)
+                self.stats["retried"] += 1
+                await self.store.save_outbox(item)
+                self._schedule(item, time.monotonic() + backoff)
+                return
+            if item.get("track_last_message"):
+                kind = "photo" if item["method"] == "send_photo" else "text"
+                try:
+                    await self.store.set_chat_message(item["chat_id"], message_record(sent.message_id, kind))
+                except Exception:
+                    # уведомление уже доставлено — без _finish оно ушло бы повторно после рестарта
+                    log.exception("outbox: не сохранено последнее сообщение чата %s", item["chat_id"])
+            await self._finish(item)
+        finally:
+            self._slots.release()
+
+    async def _finish(self, item: Dict[str, Any], dropped: bool = False):
+        self._items.pop(item["id"], None)
+        self.stats["dropped" if dropped else "sent"] += 1
+        await self.store.delete_outbox(item["id"])
@@ -0,0 +1,187 @@
+# scheduler.py — отложенные и периодические задачи внутри процесса бота
+#
+# Задача — запись {"id", "kind", "due", "args", "interval", "attempts", "shard"}
+# в Store (как уведомления outbox.py), поэтому переживает рестарт: due — время
+# по часам системы, а не monotonic. В памяти — куча (due, seq, id): следующая
+# задача берётся за O(log n), без обхода очереди. Перепланирование или отмена
+# не ищут старую запись в куче — она просто перестаёт быть актуальной
+# (seq в _entry) и пропускается, когда окажется наверху.
+#
+# Обработчик регистрируется на kind и получает args. Одновременно выполняется
+# не больше max_concurrency задач — фоновая работа не отнимает loop у хендлеров
+# апдейтов; тяжёлое (SQLite, сжатие) и так уходит в потоки. Ошибка — повтор с
+# экспоненциальной задержкой, после max_attempts разовая задача снимается.
+# Периодическая задача (every) после запуска планируется заново через interval.
+# Обработчики должны быть идемпотентны: задача, прерванная остановкой или
+# падением процесса, выполнится снова. В кластере у каждого воркера свои
+# задачи (поле shard), id периодических задач содержат номер воркера.
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from storage import Store
+
+log = logging.getLogger(__name__)
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class Scheduler:
+    def __init__(self, store: Store, max_concurrency: int = 2, shard: int = 0, retry_delay: float = 30.0,
+                 max_attempts: int = 5):
+        self.store = store
+        self.shard = shard
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self._handlers: Dict[str, Handler] = {}
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._entry: Dict[str, int] = {}  # id -> seq актуальной записи кучи
+        self._seq = itertools.count()
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._running: Dict[str, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        self.stats = {"scheduled": 0, "ran": 0, "failed": 0, "dropped": 0, "seconds": 0.0}
+
+    @property
+    def depth(self) -> int:
+        return len(self._jobs)
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    def register(self, kind: str, handler: Handler):
+        self._handlers[kind] = handler
+
+    def periodic_id(self, kind: str) -> str:
+        return f"{kind}@{self.shard}"
+
+    async def start(self):
+        restored = [job for job in await self.store.load_jobs() if job.get("shard", 0) == self.shard]
+        for job in restored:
+            self._push(job)
+        if restored:
+            log.info("scheduler: восстановлено %d задач", len(restored))
+        self._runner = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        # выполняющиеся задачи получают timeout, прерванные остаются в Store
+        if self._runner is not None:
+            self._runner.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._runner
+            self._runner = None
+        tasks = list(self._running.values())
+        if tasks:
+            _, rest = await asyncio.wait(tasks, timeout=timeout)
+            for task in rest:
+                task.cancel()
+            await asyncio.gather(*rest, return_exceptions=True)
+
+    # ----- планирование -----
+    async def schedule(self, job_id: str, kind: str, delay: float, interval: Optional[float] = None, **args):
+        # задача с тем же id заменяется
+        job = {"id": job_id, "kind": kind, "due": time.time() + max(0.0, delay), "args": args,
+               "interval": interval, "attempts": 0, "shard": self.shard}
+        await self.store.save_job(job)
+        self._push(job)
+        self.stats["scheduled"] += 1
+
+    async def every(self, kind: str, interval: float, first_delay: float = 0.0):
+        # срок следующего запуска сохраняется: рестарт не запускает задачу заново раньше времени
+        job_id = self.periodic_id(kind)
+        job = self._jobs.get(job_id)
+        if job is None:
+            await self.schedule(job_id, kind, first_delay, interval=interval)
+        elif job.get("interval") != interval:
+            await self.schedule(job_id, kind, min(job["due"] - time.time(), interval), interval=interval)
+
+    async def cancel(self, job_id: str):
+        # выполняющуюся задачу не прерывает, но после неё она не повторится
+        if self._jobs.pop(job_id, None) is not None:
+            self._entry.pop(job_id, None)
+            await self.store.delete_job(job_id)
+
+    def _push(self, job: Dict[str, Any]):
+        seq = next(self._seq)
+        self._jobs[job["id"]] = job
+        self._entry[job["id"]] = seq
+        heapq.heappush(self._heap, (job["due"], seq, job["id"]))
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    # ----- выполнение -----
+    def _head(self) -> Optional[Tuple[float, int, str]]:
+        heap = self._heap
+        while heap and self._entry.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    async def _run(self):
+        while True:
+            head = self._head()
+            wait = head[0] - time.time() if head else None
+            if wait is None or wait > 0:
+                self._wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                continue
+            await self._slots.acquire()
+            # пока ждали слот, голова кучи могла смениться
+            head = self._head()
+            if head is None or head[0] > time.time():
+                self._slots.release()
+                continue
+            _, _, job_id = heapq.heappop(self._heap)
+            del self._entry[job_id]
+            job = self._jobs[job_id]
+            self._running[job_id] = asyncio.create_task(self._execute(job))
+
+    async def _execute(self, job: Dict[str, Any]):
+        started = time.perf_counter()
+        try:
+            handler = self._handlers.get(job["kind"])
+            if handler is None:
+                raise LookupError(f"нет обработчика задач {job['kind']!r}")
+            await handler(job["args"])
+            self.stats["ran"] += 1
+            error = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats["failed"] += 1
+            log.exception("scheduler: ошибка задачи %s", job["id"])
+            error = e
+        finally:
+            self.stats["seconds"] += time.perf_counter() - started
+            self._running.pop(job["id"], None)
+            self._slots.release()
+        # обработчик мог сам перепланировать задачу — тогда она уже не та же запись
+        if self._jobs.get(job["id"]) is job:
+            await self._reschedule(job, error)
+
+    async def _reschedule(self, job: Dict[str, Any], error: Optional[Exception]):
+        now = time.time()
+        if error is not None and job["attempts"] + 1 < self.max_attempts:
+            attempts = job["attempts"] + 1
+            delay = self.retry_delay * 2 ** (attempts - 1)
+            if job["interval"]:
+                delay = min(delay, job["interval"])
+            job = dict(job, due=now + delay, attempts=attempts)
+        elif job["interval"]:
+            job = dict(job, due=now + job["interval"], attempts=0)
+        else:
+            if error is not None:
+                self.stats["dropped"] += 1
+                log.error("scheduler: задача %s снята после %d попыток", job["id"], self.max_attempts)
+            del self._jobs[job["id"]]
+            await self.store.delete_job(job["id"])
+            return
+        await self.store.save_job(job)
+        self._push(job)
@@ -0,0 +1,226 @@
+# snapshot.py — двоичный снапшот состояния с ленивым чтением через mmap
+#
+# Раньше снапшот был одним JSON-документом: на старте весь data.json
+# разбирался целиком, хотя большинство сделок и чатов до следующего рестарта
+# никто не открывает. Формат data.snap:
+#   MAGIC (8 байт) | u64 смещение footer'а
+#   записи: u32 длина | JSON-тело
+#   блоки индекса: ключи через \0, смещения записей (u64), колонки сводки
+#   footer: u32 длина | JSON {"seq", "sections": {раздел: {...}}}
+# Малые разделы (EAGER_SECTIONS) лежат одной записью и читаются сразу. Для
+# остальных на старте читаются только блоки индекса — целиком, без разбора по
+# записи, — а тела декодируются при первом обращении (LazySection). Колонки
+# сводки — поля, нужные индексам JsonStore (LAZY_SUMMARY): индексы сделок
+# строятся без разбора тел. Сжатие журнала копирует нетронутые записи байт в байт.
+import itertools
+import json
+import mmap
+import os
+import struct
+from array import array
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+MAGIC = b"GCSNAP\x00\x01"
+_HEADER = struct.Struct("<8sQ")
+_LEN = struct.Struct("<I")
+_NONE = -(1 << 63)  # None в целочисленной колонке
+
+EAGER_SECTIONS = ("users", "outbox", "meta", "runtime", "jobs", "applied")
+LAZY_SUMMARY = {"deals": ("seller_id", "buyer_id", "status", "name"),
+                "ledger": ("id", "debit", "credit", "amount")}
+
+
+def _dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _block(buf, where: List[int]) -> bytes:
+    at, length = where
+    return buf[at:at + length]
+
+
+def _int_column(values: List[Any]) -> Optional[bytes]:
+    try:
+        return array("q", [_NONE if v is None else v for v in values]).tobytes()
+    except (TypeError, OverflowError):
+        return None
+
+
+class LazySection(MutableMapping):
+    # dict раздела: порядок ключей как в снапшоте, новые — в конце. Значения
+    # ленивых разделов — объекты JSON, поэтому int в _items — номер ещё не
+    # прочитанной записи снапшота
+    def __init__(self, buf=None, meta: Optional[Dict[str, Any]] = None):
+        self._buf = buf
+        self._meta = meta or {}
+        keys = _block(buf, meta["keys"]).decode("utf-8").split("\0") if meta and meta["count"] else []
+        self._offsets = array("Q")
+        if meta:
+            self._offsets.frombytes(_block(buf, meta["offsets"]))
+        self._items: Dict[str, Any] = dict(zip(keys, range(len(keys))))
+        self._pristine = True  # ключи и значения ровно как в снапшоте
+        self.decoded = 0  # тел, прочитанных из снапшота
+
+    def _record(self, pos: int) -> bytes:
+        offset = self._offsets[pos]
+        (length,) = _LEN.unpack_from(self._buf, offset)
+        return self._buf[offset:offset + _LEN.size + length]
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._items[key]
+        if type(value) is int:
+            value = self._items[key] = json.loads(self._record(value)[_LEN.size:])
+            self._pristine = False
+            self.decoded += 1
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        self._items[key] = value
+        self._pristine = False
+
+    def __delitem__(self, key: str):
+        del self._items[key]
+        self._pristine = False
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._items
+
+    def column(self, field: str) -> List[Any]:
+        # значения поля сводки по номерам записей снапшота
+        spec = self._meta.get("columns", {}).get(field)
+        if spec is None:
+            return [None] * len(self._offsets)
+        raw = _block(self._buf, spec["at"])
+        if spec["type"] == "int":
+            values = array("q")
+            values.frombytes(raw)
+            return [None if v == _NONE else v for v in values]
+        return json.loads(raw)
+
+    def rows(self, fields: Tuple[str, ...]) -> Iterator[Tuple[Any, ...]]:
+        # (ключ, поля...) по всем ключам; непрочитанные тела не декодируются.
+        # Ключи фиксируются при вызове, а колонки читаются уже при переборе —
+        # его можно вести из другого потока, пока loop дописывает новые записи
+        # (сверка журнала проводок, ledger.py)
+        if self._pristine:
+            return self._rows(list(self._items), True, fields)
+        return self._rows(list(self._items.items()), False, fields)
+
+    def rows_after(self, key: str, fields: Tuple[str, ...]) -> Iterator[Tuple[Any, ...]]:
+        # как rows, но только ключи после key — для разделов, куда ключи дописываются
+        # по возрастанию (ledger): хвост ищется с конца, без обхода всего раздела
+        tail = list(itertools.takewhile(lambda k: k > key, reversed(self._items)))
+        tail.reverse()
+        return self._rows([(k, self._items[k]) for k in tail], False, fields)
+
+    def _rows(self, items: List[Any], pristine: bool, fields: Tuple[str, ...]) -> Iterator[Tuple[Any, ...]]:
+        if pristine:
+            # номера записей совпадают с порядком ключей
+            yield from zip(items, *(self.column(f) for f in fields))
+            return
+        columns = None  # читаются, только если есть непрочитанные записи
+        for key, value in items:
+            if type(value) is int:
+                if columns is None:
+                    columns = [self.column(f) for f in fields]
+                yield (key,) + tuple(c[value] for c in columns)
+            else:
+                yield (key,) + tuple(value.get(f) for f in fields)
+
+    def raw_items(self, fields: Tuple[str, ...]) -> Iterator[Tuple[str, Optional[bytes], Any]]:
+        # (ключ, запись как есть или None, значение или сводка) — для копирования без декодирования
+        columns = [self.column(f) for f in fields]
+        for key, value in self._items.items():
+            if type(value) is int:
+                yield key, self._record(value), [c[value] for c in columns]
+            else:
+                yield key, None, value
+
+
+def read_snapshot(path: Path) -> Tuple[Dict[str, Any], int]:
+    with open(path, "rb") as fh:
+        buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, footer_at = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path}: не снапшот Gift Castle")
+    (length,) = _LEN.unpack_from(buf, footer_at)
+    footer = json.loads(buf[footer_at + _LEN.size:footer_at + _LEN.size + length])
+    data: Dict[str, Any] = {}
+    for name, meta in footer["sections"].items():
+        if "offset" in meta:
+            (size,) = _LEN.unpack_from(buf, meta["offset"])
+            start = meta["offset"] + _LEN.size
+            data[name] = json.loads(buf[start:start + size])
+        else:
+            data[name] = LazySection(buf, meta)
+    return data, int(footer["seq"])
+
+
+def empty_section(name: str):
+    return {} if name in EAGER_SECTIONS else LazySection()
+
+
+def write_snapshot(path: Path, data: Dict[str, Any], seq: int) -> int:
+    # пишет во временный файл и атомарно подменяет; возвращает размер
+    tmp = path.with_name(path.name + ".tmp")
+    sections: Dict[str, Any] = {}
+    with open(tmp, "wb") as fh:
+        fh.write(_HEADER.pack(MAGIC, 0))
+
+        def put(body: bytes) -> int:
+            offset = fh.tell()
+            fh.write(_LEN.pack(len(body)))
+            fh.write(body)
+            return offset
+
+        def put_block(body: bytes) -> List[int]:
+            offset = fh.tell()
+            fh.write(body)
+            return [offset, len(body)]
+
+        for name, section in data.items():
+            if name in EAGER_SECTIONS:
+                sections[name] = {"offset": put(_dumps(dict(section)))}
+                continue
+            fields = LAZY_SUMMARY.get(name, ())
+            items = section.raw_items(fields) if isinstance(section, LazySection) else \
+                ((k, None, v) for k, v in section.items())
+            keys: List[str] = []
+            offsets = array("Q")
+            columns: List[List[Any]] = [[] for _ in fields]
+            for key, record, value in items:
+                keys.append(key)
+                if record is None:
+                    offsets.append(put(_dumps(value)))
+                    summary = [value.get(f) for f in fields]
+                else:
+                    offsets.append(fh.tell())
+                    fh.write(record)
+                    summary = value
+                for column, v in zip(columns, summary):
+                    column.append(v)
+            meta: Dict[str, Any] = {"count": len(keys), "keys": put_block("\0".join(keys).encode("utf-8")),
+                                    "offsets": put_block(offsets.tobytes()), "columns": {}}
+            for field, column in zip(fields, columns):
+                packed = _int_column(column)
+                if packed is not None:
+                    meta["columns"][field] = {"type": "int", "at": put_block(packed)}
+                else:
+                    meta["columns"][field] = {"type": "json", "at": put_block(_dumps(column))}
+            sections[name] = meta
+        footer_at = put(_dumps({"seq": seq, "sections": sections}))
+        fh.seek(0)
+        fh.write(_HEADER.pack(MAGIC, footer_at))
+        fh.flush()
+        os.fsync(fh.fileno())
+        size = fh.seek(0, os.SEEK_END)
+    os.replace(tmp, path)
+    return size
@@ -0,0 +1,613 @@
+# sqlite_store.py — SQLite-бэкенд хранилища (WAL, индексированные таблицы)
+#
+# Память не растёт вместе с историей сделок: в процессе ничего не кешируется,
+# все запросы идут в базу через пул потоков, чтобы не блокировать event loop.
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, Optional, Callable, List, Tuple
+
+from ledger import (KIND_ADJUSTMENT, KIND_HOLD, KIND_RELEASE, KIND_REFUND, KIND_OPENING, OWNER_ACCOUNT, OPENING_ACCOUNT,
+                    LIVE_ESCROW_STATUSES, aggregate, reconcile, deal_price, deal_escrow, entry, signed_entry, to_minor,
+                    user_account, escrow_account, user_deltas)
+from storage import Store, TERMINAL_STATUSES, name_tokens, PREFIX_END, JOIN_OK, JOIN_NOT_FOUND, JOIN_UNAVAILABLE, JOIN_INSUFFICIENT
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    balance REAL NOT NULL DEFAULT 0,
+    username TEXT
+);
+CREATE TABLE IF NOT EXISTS deals (
+    id TEXT PRIMARY KEY,
+    seller_id INTEGER NOT NULL,
+    buyer_id INTEGER,
+    status TEXT NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deals_seller_status ON deals (seller_id, status);
+CREATE INDEX IF NOT EXISTS deals_buyer_status ON deals (buyer_id, status);
+CREATE INDEX IF NOT EXISTS deals_status_id ON deals (status, id);
+CREATE TABLE IF NOT EXISTS deal_names (
+    token TEXT NOT NULL,
+    deal_id TEXT NOT NULL,
+    PRIMARY KEY (token, deal_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS deal_names_deal ON deal_names (deal_id);
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY,
+    last_message_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runtime (
+    name TEXT PRIMARY KEY,
+    body TEXT NOT NULL
+);
+-- апдейты Telegram, чьи изменения уже записаны: повтор после рестарта их пропускает
+CREATE TABLE IF NOT EXISTS applied (
+    update_id INTEGER PRIMARY KEY,
+    ledger_id INTEGER,
+    deal_id TEXT
+);
+CREATE INDEX IF NOT EXISTS applied_deal ON applied (deal_id);
+CREATE TABLE IF NOT EXISTS ledger (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    debit TEXT NOT NULL,
+    credit TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    deal_id TEXT,
+    CHECK (typeof(amount) = 'integer' AND amount > 0 AND debit != credit)
+);
+-- покрывающие индексы: остатки счетов считаются GROUP BY без чтения таблицы
+CREATE INDEX IF NOT EXISTS ledger_debit ON ledger (debit, amount);
+CREATE INDEX IF NOT EXISTS ledger_credit ON ledger (credit, amount);
+"""
+
+def connect(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+def init_schema(conn: sqlite3.Connection):
+    conn.executescript(SCHEMA)
+    # базы до появления состояния сообщения чата: в chats был только last_message_id
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(chats)")}
+    if "state" not in columns:
+        conn.execute("ALTER TABLE chats ADD COLUMN state TEXT")
+    # базы до ledger.py: баланс был REAL в users.balance (колонка остаётся, но не используется)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    if "balance_minor" not in columns:
+        try:
+            conn.execute("ALTER TABLE users ADD COLUMN balance_minor INTEGER NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError as e:
+            # соседний воркер кластера успел первым
+            if "duplicate column" not in str(e):
+                raise
+
+
+def chat_row(chat_id: int, record: Dict[str, Any]):
+    # last_message_id — отдельной колонкой, остальное состояние — JSON
+    extra = {k: v for k, v in record.items() if k != "last_message_id"}
+    return chat_id, record.get("last_message_id"), json.dumps(extra) if extra else None
+
+
+def index_deal_names(conn: sqlite3.Connection, deal: Dict[str, Any]):
+    # слова названия ищутся только у открытых сделок
+    conn.execute("DELETE FROM deal_names WHERE deal_id = ?", (deal["id"],))
+    if deal["status"] == "open":
+        conn.executemany("INSERT OR IGNORE INTO deal_names (token, deal_id) VALUES (?, ?)",
+                         ((token, deal["id"]) for token in name_tokens(deal.get("name"))))
+
+
+def deal_row(deal: Dict[str, Any]):
+    return (deal["id"], deal["seller_id"], deal.get("buyer_id"), deal["status"],
+            json.dumps(deal, ensure_ascii=False))
+
+
+class SqliteStore(Store):
+    def __init__(self, path: Path, workers: int = 4, archive=None):
+        self.path = Path(path)
+        self.archive = archive
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sqlite")
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []  # по одному на поток — закрываются в close()
+        self._stats_lock = threading.Lock()
+        self.stats = {"writes": 0, "write_seconds": 0.0, "write_errors": 0}
+        conn = self._conn()
+        init_schema(conn)
+        self._backfill_deal_names(conn)
+        self._write(self._migrate_ledger)
+
+    @classmethod
+    def _migrate_ledger(cls, conn: sqlite3.Connection):
+        # float-балансы и эскроу живых сделок становятся входящими проводками; флаг
+        # проверяется под блокировкой записи — воркеры кластера не перенесут дважды
+        if conn.execute("SELECT 1 FROM meta WHERE name = 'ledger_version'").fetchone() is not None:
+            return
+        for uid, balance in conn.execute("SELECT id, balance FROM users WHERE balance != 0").fetchall():
+            opening = signed_entry(KIND_OPENING, user_account(uid), OPENING_ACCOUNT, to_minor(balance))
+            if opening is not None:
+                cls._post(conn, opening)
+        marks = ", ".join("?" * len(LIVE_ESCROW_STATUSES))
+        for (body,) in conn.execute(f"SELECT body FROM deals WHERE status IN ({marks})",
+                                    LIVE_ESCROW_STATUSES).fetchall():
+            deal = json.loads(body)
+            escrow = deal_escrow(deal)
+            fields = {"price_minor": deal_price(deal), "escrow_minor": escrow}
+            deal.pop("price", None)
+            deal.pop("escrow_amount", None)
+            deal.update(fields)
+            conn.execute("UPDATE deals SET body = ? WHERE id = ?", (deal_row(deal)[4], deal["id"]))
+            opening = signed_entry(KIND_OPENING, escrow_account(deal["id"]), OPENING_ACCOUNT, escrow, deal["id"])
+            if opening is not None:
+                cls._post(conn, opening)
+        conn.execute("INSERT INTO meta (name, value) VALUES ('ledger_version', 1)")
+
+    def _backfill_deal_names(self, conn: sqlite3.Connection):
+        # базы, созданные до появления поиска по названию
+        if conn.execute("SELECT 1 FROM deal_names LIMIT 1").fetchone() is not None:
+            return
+        rows = conn.execute("SELECT body FROM deals WHERE status = 'open'").fetchall()
+        if rows:
+            self._write(lambda c: [index_deal_names(c, json.loads(r[0])) for r in rows])
+
+    # у каждого потока пула своё соединение: читатели в WAL не мешают друг другу
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect(self.path)
+            with self._stats_lock:
+                self._conns.append(conn)
+        return conn
+
+    async def _run(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+
+    def _write(self, fn: Callable, *args):
+        # BEGIN IMMEDIATE сразу берёт блокировку записи — без гонок read-modify-write
+        conn = self._conn()
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            with self._stats_lock:
+                self.stats["write_errors"] += 1
+            raise
+        conn.execute("COMMIT")
+        with self._stats_lock:
+            self.stats["writes"] += 1
+            self.stats["write_seconds"] += time.perf_counter() - started
+        return result
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._pool.shutdown)
+        # после shutdown потоки пула не работают; закрытие последнего соединения
+        # делает checkpoint WAL и удаляет -wal/-shm, не дожидаясь сборщика мусора
+        with self._stats_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+
+    def metrics(self) -> Dict[str, float]:
+        with self._stats_lock:
+            return {"sqlite_" + k: v for k, v in self.stats.items()}
+
+    # ----- users -----
+    @staticmethod
+    def _ensure_user(conn: sqlite3.Connection, uid: int):
+        conn.execute("INSERT OR IGNORE INTO users (id, balance_minor, username) VALUES (?, 0, NULL)", (uid,))
+
+    def _get_user(self, uid: int) -> Dict[str, Any]:
+        conn = self._conn()
+        row = conn.execute("SELECT balance_minor, username FROM users WHERE id = ?", (uid,)).fetchone()
+        if row is None:
+            self._write(self._ensure_user, uid)
+            return {"balance_minor": 0, "username": None}
+        return {"balance_minor": row[0], "username": row[1]}
+
+    async def get_user(self, uid: int) -> Dict[str, Any]:
+        return await self._run(self._get_user, uid)
+
+    @classmethod
+    def _set_username(cls, conn: sqlite3.Connection, uid: int, username: Optional[str]):
+        cls._ensure_user(conn, uid)
+        conn.execute("UPDATE users SET username = ? WHERE id = ?", (username, uid))
+
+    async def set_username(self, uid: int, username: Optional[str]):
+        await self._run(self._write, self._set_username, uid, username)
+
+    # ----- ledger -----
+    @classmethod
+    def _post(cls, conn: sqlite3.Connection, posting: Dict[str, Any]) -> int:
+        # проводка и кешированные балансы — в транзакции вызывающего; возвращает id
+        cur = conn.execute("INSERT INTO ledger (ts, kind, debit, credit, amount, deal_id) VALUES (?, ?, ?, ?, ?, ?)",
+                     (time.time(), posting["kind"], posting["debit"], posting["credit"], posting["amount"],
+                      posting["deal_id"]))
+        for uid, delta in user_deltas(posting):
+            cls._ensure_user(conn, uid)
+            conn.execute("UPDATE users SET balance_minor = balance_minor + ? WHERE id = ?", (delta, uid))
+        return cur.lastrowid
+
+    @staticmethod
+    def _applied(conn: sqlite3.Connection, update_id: Optional[int]) -> Optional[Tuple[Optional[int], Optional[str]]]:
+        if update_id is None:
+            return None
+        return conn.execute("SELECT ledger_id, deal_id FROM applied WHERE update_id = ?", (update_id,)).fetchone()
+
+    @classmethod
+    def _adjust_balance(cls, conn: sqlite3.Connection, uid: int, delta: int, update_id: Optional[int]) -> int:
+        cls._ensure_user(conn, uid)
+        posting = signed_entry(KIND_ADJUSTMENT, user_account(uid), OWNER_ACCOUNT, delta)
+        if posting is not None and cls._applied(conn, update_id) is None:
+            entry_id = cls._post(conn, posting)
+            if update_id is not None:
+                conn.execute("INSERT INTO applied (update_id, ledger_id) VALUES (?, ?)", (update_id, entry_id))
+        (balance,) = conn.execute("SELECT balance_minor FROM users WHERE id = ?", (uid,)).fetchone()
+        return balance
+
+    async def adjust_balance(self, uid: int, delta: int, update_id: Optional[int] = None) -> int:
+        return await self._run(self._write, self._adjust_balance, uid, delta, update_id)
+
+    # ----- deals -----
+    @staticmethod
+    def _insert_deal(conn: sqlite3.Connection, deal: Dict[str, Any]):
+        conn.execute("INSERT OR REPLACE INTO deals (id, seller_id, buyer_id, status, body) VALUES (?, ?, ?, ?, ?)",
+                     deal_row(deal))
+        index_deal_names(conn, deal)
+
+    @classmethod
+    def _create_deal(cls, conn: sqlite3.Connection, deal: Dict[str, Any], update_id: Optional[int]) -> Dict[str, Any]:
+        applied = cls._applied(conn, update_id)
+        if applied is not None:
+            existing = cls._select_deal(conn, applied[1])
+            if existing is not None:
+                return existing
+        if update_id is not None:
+            deal["update_id"] = update_id
+            conn.execute("INSERT OR REPLACE INTO applied (update_id, deal_id) VALUES (?, ?)", (update_id, deal["id"]))
+        cls._insert_deal(conn, deal)
+        return deal
+
+    async def create_deal(self, deal: Dict[str, Any], update_id: Optional[int] = None) -> Dict[str, Any]:
+        return await self._run(self._write, self._create_deal, dict(deal), update_id)
+
+    @staticmethod
+    def _select_deal(conn: sqlite3.Connection, deal_id: str) -> Optional[Dict[str, Any]]:
+        row = conn.execute("SELECT body FROM deals WHERE id = ?", (deal_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def find_deal(self, deal_id: str) -> Optional[Dict[str, Any]]:
+        deal = await self._run(lambda: self._select_deal(self._conn(), deal_id))
+        if deal is None and self.archive is not None:
+            return await self.archive.find(deal_id)
+        return deal
+
+    @classmethod
+    def _update_deal(cls, conn: sqlite3.Connection, deal_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        deal = cls._select_deal(conn, deal_id)
+        if deal is None:
+            return None
+        deal.update(fields)
+        conn.execute("UPDATE deals SET seller_id = ?, buyer_id = ?, status = ?, body = ? WHERE id = ?",
+                     deal_row(deal)[1:] + (deal_id,))
+        if "status" in fields or "name" in fields:
+            index_deal_names(conn, deal)
+        return deal
+
+    async def update_deal(self, deal_id: str, **fields) -> Optional[Dict[str, Any]]:
+        return await self._run(self._write, self._update_deal, deal_id, fields)
+
+    @classmethod
+    def _join_deal(cls, conn: sqlite3.Connection, deal_id: str, buyer_id: int,
+                   buyer_username: Optional[str]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        deal = cls._select_deal(conn, deal_id)
+        if deal is None:
+            return JOIN_NOT_FOUND, None
+        if deal["status"] != "open":
+            return JOIN_UNAVAILABLE, deal
+        price = deal_price(deal)
+        cls._ensure_user(conn, buyer_id)
+        (balance,) = conn.execute("SELECT balance_minor FROM users WHERE id = ?", (buyer_id,)).fetchone()
+        if balance < price:
+            return JOIN_INSUFFICIENT, deal
+        if price:
+            cls._post(conn, entry(KIND_HOLD, user_account(buyer_id), escrow_account(deal_id), price, deal_id))
+        deal = cls._update_deal(conn, deal_id, {"buyer_id": buyer_id, "buyer_username": buyer_username,
+                                                "status": "in_process", "price_minor": price, "escrow_minor": price})
+        return JOIN_OK, deal
+
+    async def join_deal(self, deal_id: str, buyer_id: int, buyer_username: Optional[str]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        return await self._run(self._write, self._join_deal, deal_id, buyer_id, buyer_username)
+
+    @classmethod
+    def _transition_deal(cls, conn: sqlite3.Connection, deal_id: str, from_status: str,
+                         fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        deal = cls._select_deal(conn, deal_id)
+        if deal is None or deal["status"] != from_status:
+            return None
+        return cls._update_deal(conn, deal_id, fields)
+
+    async def transition_deal(self, deal_id: str, from_status: str, to_status: str, **fields) -> Optional[Dict[str, Any]]:
+        return await self._run(self._write, self._transition_deal, deal_id, from_status, dict(fields, status=to_status))
+
+    @classmethod
+    def _complete_deal(cls, conn: sqlite3.Connection, deal_id: str, buyer_id: int) -> Optional[int]:
+        deal = cls._select_deal(conn, deal_id)
+        if deal is None or deal["status"] != "transferred" or deal.get("buyer_id") != buyer_id:
+            return None
+        amount = deal_escrow(deal)
+        if amount:
+            cls._post(conn, entry(KIND_RELEASE, escrow_account(deal_id), user_account(deal["seller_id"]), amount, deal_id))
+        cls._update_deal(conn, deal_id, {"status": "completed", "escrow_minor": 0})
+        return amount
+
+    async def complete_deal(self, deal_id: str, buyer_id: int) -> Optional[int]:
+        return await self._run(self._write, self._complete_deal, deal_id, buyer_id)
+
+    @classmethod
+    def _cancel_deal(cls, conn: sqlite3.Connection, deal_id: str, from_status: str) -> Optional[int]:
+        deal = cls._select_deal(conn, deal_id)
+        if deal is None or deal["status"] != from_status:
+            return None
+        amount = deal_escrow(deal)
+        if amount:
+            cls._post(conn, entry(KIND_REFUND, escrow_account(deal_id), user_account(deal["buyer_id"]), amount, deal_id))
+        cls._update_deal(conn, deal_id, {"status": "cancelled", "escrow_minor": 0})
+        return amount
+
+    async def cancel_deal(self, deal_id: str, from_status: str) -> Optional[int]:
+        return await self._run(self._write, self._cancel_deal, deal_id, from_status)
+
+    @staticmethod
+    def _ledger_report(conn: sqlite3.Connection, checkpoint: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        if checkpoint is not None:
+            # только новые проводки — диапазон по первичному ключу
+            totals, summary = aggregate(conn.execute(
+                "SELECT id, debit, credit, amount FROM ledger WHERE id > ? ORDER BY id", (checkpoint["last_id"],)),
+                checkpoint)
+        else:
+            # остатки — по покрывающим индексам ledger_debit/ledger_credit; id — AUTOINCREMENT, порядок
+            # гарантирован, а сумму и счета проверяет CHECK таблицы — отдельный проход по ней не нужен
+            totals = dict(conn.execute("SELECT debit, -SUM(amount) FROM ledger GROUP BY debit"))
+            for account, amount in conn.execute("SELECT credit, SUM(amount) FROM ledger GROUP BY credit"):
+                totals[account] = totals.get(account, 0) + amount
+            count, first, last = conn.execute("SELECT COUNT(*), MIN(id), MAX(id) FROM ledger").fetchone()
+            summary = {"entries": count, "first_id": first or 0, "last_id": last or 0, "bad_entries": 0,
+                       "out_of_order": 0}
+        balances = dict(conn.execute("SELECT id, balance_minor FROM users WHERE balance_minor != 0"))
+        marks = ", ".join("?" * len(LIVE_ESCROW_STATUSES))
+        escrows = {deal_id: deal_escrow(json.loads(body)) for deal_id, body in conn.execute(
+            f"SELECT id, body FROM deals WHERE status IN ({marks})", LIVE_ESCROW_STATUSES)}
+        return reconcile(totals, summary, balances, escrows)
+
+    def _reconcile(self, checkpoint: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        # все чтения в одной транзакции — согласованный срез WAL, запись не блокируется
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            return self._ledger_report(conn, checkpoint)
+        finally:
+            conn.execute("COMMIT")
+
+    @classmethod
+    def _repair_ledger(cls, conn: sqlite3.Connection, checkpoint: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        report = cls._ledger_report(conn, checkpoint)
+        for uid, amount in report["repair"]["users"].items():
+            cls._ensure_user(conn, uid)
+            conn.execute("UPDATE users SET balance_minor = ? WHERE id = ?", (amount, uid))
+        for deal_id, amount in report["repair"]["deals"].items():
+            deal = cls._select_deal(conn, deal_id)
+            if deal is not None and deal["status"] in LIVE_ESCROW_STATUSES:
+                cls._update_deal(conn, deal_id, {"escrow_minor": amount})
+        return report
+
+    async def reconcile_ledger(self, repair: bool = False, checkpoint: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        if repair:
+            return await self._run(self._write, self._repair_ledger, checkpoint)
+        return await self._run(self._reconcile, checkpoint)
+
+    def _find_party_deals(self, role: str, uid: int, status: str) -> List[Dict[str, Any]]:
+        column = {"seller": "seller_id", "buyer": "buyer_id"}[role]
+        rows = self._conn().execute(
+            f"SELECT body FROM deals WHERE {column} = ? AND status = ? ORDER BY rowid", (uid, status)
+        ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    async def find_party_deals(self, role: str, uid: int, status: str) -> List[Dict[str, Any]]:
+        return await self._run(self._find_party_deals, role, uid, status)
+
+    def _check_indexes(self) -> List[str]:
+        # индексные колонки должны совпадать с телом сделки
+        problems = []
+        for did, seller_id, buyer_id, status, body in self._conn().execute(
+                "SELECT id, seller_id, buyer_id, status, body FROM deals"):
+            deal = json.loads(body)
+            if (seller_id, buyer_id, status) != (deal["seller_id"], deal.get("buyer_id"), deal["status"]):
+                problems.append(f"{did}: колонки ({seller_id}, {buyer_id}, {status}) не совпадают с телом сделки")
+        (integrity,) = self._conn().execute("PRAGMA quick_check").fetchone()
+        if integrity != "ok":
+            problems.append(f"quick_check: {integrity}")
+        return problems
+
+    async def check_indexes(self) -> List[str]:
+        return await self._run(self._check_indexes)
+
+    def _deal_ids_with_status(self, statuses: Tuple[str, ...]) -> List[str]:
+        marks = ", ".join("?" * len(statuses))
+        return [r[0] for r in self._conn().execute(f"SELECT id FROM deals WHERE status IN ({marks})", statuses)]
+
+    async def deal_ids_with_status(self, statuses: Tuple[str, ...]) -> List[str]:
+        return await self._run(self._deal_ids_with_status, tuple(statuses))
+
+    def _deal_counts(self) -> Dict[str, int]:
+        return dict(self._conn().execute("SELECT status, COUNT(*) FROM deals GROUP BY status"))
+
+    async def deal_counts(self) -> Dict[str, int]:
+        return await self._run(self._deal_counts)
+
+    def _compact(self) -> bool:
+        # WAL растёт, пока его не переносит checkpoint без читателей; TRUNCATE обрезает файл
+        conn = self._conn()
+        busy, _log, _moved = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        conn.execute("PRAGMA optimize")
+        return not busy
+
+    async def compact(self) -> bool:
+        return await self._run(self._compact)
+
+    def _search_open_deals(self, kind: str, prefix: str, offset: int, limit: int) -> List[Dict[str, Any]]:
+        if kind == "id":
+            sql = ("SELECT body FROM deals WHERE status = 'open' AND id >= ? AND id < ? "
+                   "ORDER BY id LIMIT ? OFFSET ?")
+        else:
+            # порядок как в OpenDealSearchIndex.by_name: первое совпавшее слово, затем номер
+            sql = ("SELECT d.body FROM deal_names n JOIN deals d ON d.id = n.deal_id "
+                   "WHERE n.token >= ? AND n.token < ? "
+                   "GROUP BY n.deal_id ORDER BY MIN(n.token), n.deal_id LIMIT ? OFFSET ?")
+        rows = self._conn().execute(sql, (prefix, prefix + PREFIX_END, limit, offset)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    async def search_open_deals(self, kind: str, prefix: str, offset: int, limit: int) -> List[Dict[str, Any]]:
+        return await self._run(self._search_open_deals, kind, prefix, offset, limit)
+
+    # ----- archive -----
+    def _terminal_deals(self, limit: int) -> List[Dict[str, Any]]:
+        marks = ", ".join("?" * len(TERMINAL_STATUSES))
+        rows = self._conn().execute(f"SELECT body FROM deals WHERE status IN ({marks}) LIMIT ?",
+                                    TERMINAL_STATUSES + (limit,)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    async def terminal_deals(self, limit: int) -> List[Dict[str, Any]]:
+        return await self._run(self._terminal_deals, limit)
+
+    @staticmethod
+    def _evict_deals(conn: sqlite3.Connection, deal_ids: List[str]) -> int:
+        marks = ", ".join("?" * len(TERMINAL_STATUSES))
+        evicted = 0
+        for deal_id in deal_ids:
+            cur = conn.execute(f"DELETE FROM deals WHERE id = ? AND status IN ({marks})", (deal_id,) + TERMINAL_STATUSES)
+            if cur.rowcount:
+                conn.execute("DELETE FROM deal_names WHERE deal_id = ?", (deal_id,))
+                # апдейт, создавший сделку, давно завершён — его отметка больше не нужна
+                conn.execute("DELETE FROM applied WHERE deal_id = ?", (deal_id,))
+                evicted += 1
+        return evicted
+
+    async def evict_deals(self, deal_ids: List[str]) -> int:
+        return await self._run(self._write, self._evict_deals, list(deal_ids))
+
+    # ----- chats -----
+    @staticmethod
+    def _set_chat_messages(conn: sqlite3.Connection, items: Dict[int, Dict[str, Any]]):
+        conn.executemany("INSERT OR REPLACE INTO chats (id, last_message_id, state) VALUES (?, ?, ?)",
+                         (chat_row(chat_id, record) for chat_id, record in items.items()))
+
+    async def set_chat_message(self, chat_id: int, record: Dict[str, Any]):
+        await self._run(self._write, self._set_chat_messages, {chat_id: dict(record)})
+
+    async def set_chat_messages(self, items: Dict[int, Dict[str, Any]]):
+        # одна транзакция на всю пачку
+        await self._run(self._write, self._set_chat_messages, dict(items))
+
+    def _get_chat_message(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT last_message_id, state FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        record = json.loads(row[1]) if row[1] else {}
+        record["last_message_id"] = row[0]
+        return record
+
+    async def get_chat_message(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        return await self._run(self._get_chat_message, chat_id)
+
+    # ----- meta -----
+    @staticmethod
+    def _reserve_sequence(conn: sqlite3.Connection, name: str, count: int) -> int:
+        row = conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        start = row[0] if row else 0
+        conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, start + count))
+        return start
+
+    async def reserve_sequence(self, name: str, count: int) -> int:
+        return await self._run(self._write, self._reserve_sequence, name, count)
+
+    # ----- outbox -----
+    @staticmethod
+    def _save_outbox(conn: sqlite3.Connection, item: Dict[str, Any]):
+        conn.execute("INSERT OR REPLACE INTO outbox (id, body) VALUES (?, ?)",
+                     (item["id"], json.dumps(item, ensure_ascii=False)))
+
+    async def save_outbox(self, item: Dict[str, Any]):
+        await self._run(self._write, self._save_outbox, dict(item))
+
+    @staticmethod
+    def _delete_outbox(conn: sqlite3.Connection, item_id: str):
+        conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+
+    async def delete_outbox(self, item_id: str):
+        await self._run(self._write, self._delete_outbox, item_id)
+
+    def _load_outbox(self) -> List[Dict[str, Any]]:
+        return [json.loads(r[0]) for r in self._conn().execute("SELECT body FROM outbox ORDER BY rowid")]
+
+    async def load_outbox(self) -> List[Dict[str, Any]]:
+        return await self._run(self._load_outbox)
+
+    # ----- jobs -----
+    @staticmethod
+    def _save_job(conn: sqlite3.Connection, job: Dict[str, Any]):
+        conn.execute("INSERT OR REPLACE INTO jobs (id, body) VALUES (?, ?)",
+                     (job["id"], json.dumps(job, ensure_ascii=False)))
+
+    async def save_job(self, job: Dict[str, Any]):
+        await self._run(self._write, self._save_job, dict(job))
+
+    @staticmethod
+    def _delete_job(conn: sqlite3.Connection, job_id: str):
+        conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    async def delete_job(self, job_id: str):
+        await self._run(self._write, self._delete_job, job_id)
+
+    def _load_jobs(self) -> List[Dict[str, Any]]:
+        return [json.loads(r[0]) for r in self._conn().execute("SELECT body FROM jobs")]
+
+    async def load_jobs(self) -> List[Dict[str, Any]]:
+        return await self._run(self._load_jobs)
+
+    # ----- runtime -----
+    @staticmethod
+    def _save_runtime(conn: sqlite3.Connection, name: str, body: str):
+        conn.execute("INSERT OR REPLACE INTO runtime (name, body) VALUES (?, ?)", (name, body))
+
+    async def save_runtime(self, name: str, value: Any):
+        await self._run(self._write, self._save_runtime, name, json.dumps(value, ensure_ascii=False))
+
+    def _load_runtime(self, name: str) -> Optional[Any]:
+        row = self._conn().execute("SELECT body FROM runtime WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def load_runtime(self, name: str) -> Optional[Any]:
+        return await self._run(self._load_runtime, name)
@@ -0,0 +1,671 @@
+# storage.py — интерфейс хранилища Gift Castle и JSON-бэкенд поверх журнала
+#
+# Хендлеры не трогают сырой DATA, а работают через Store. Бэкенды:
+#   JsonStore   — всё состояние в памяти, изменения пишутся в журнал (journal.py)
+#   SqliteStore — таблицы в SQLite (WAL), см. sqlite_store.py
+# Сделки в терминальных статусах переносятся в архив (archive.py); find_deal
+# ищет номер сначала в хранилище, затем в архиве. Суммы — целые минорные
+# единицы, каждое движение денег — проводка в журнале ledger (ledger.py).
+import abc
+import asyncio
+import bisect
+import itertools
+import re
+import time
+from pathlib import Path
+from typing import Dict, Any, Iterable, Iterator, Optional, List, Tuple
+
+from journal import Journal
+from ledger import (KIND_ADJUSTMENT, KIND_HOLD, KIND_RELEASE, KIND_REFUND, KIND_OPENING, OWNER_ACCOUNT, OPENING_ACCOUNT,
+                    LIVE_ESCROW_STATUSES, aggregate, reconcile, deal_price, deal_escrow, entry, signed_entry,
+                    to_minor, user_account, escrow_account, user_deltas)
+from snapshot import LazySection
+
+PARTY_ROLES = ("seller", "buyer")
+TERMINAL_STATUSES = ("completed", "cancelled")  # такие сделки уходят в архив (archive.py)
+
+_TOKEN_RE = re.compile(r"\w+")
+PREFIX_END = "\U0010ffff"  # верхняя граница диапазона для поиска по префиксу
+
+
+def name_tokens(name: Optional[str]) -> List[str]:
+    # слова названия в нижнем регистре — ключи поиска по имени
+    return sorted(set(_TOKEN_RE.findall((name or "").casefold())))
+
+# результаты join_deal
+JOIN_OK = "ok"
+JOIN_NOT_FOUND = "not_found"
+JOIN_UNAVAILABLE = "unavailable"  # сделка уже не в статусе open
+JOIN_INSUFFICIENT = "insufficient"  # не хватает средств на балансе
+
+
+class DealIndex:
+    # вторичные индексы (роль, user_id, статус) -> id сделок в порядке создания;
+    # dict используется как упорядоченное множество
+    def __init__(self):
+        self._by: Dict[Tuple[str, int, str], Dict[str, None]] = {}
+
+    @staticmethod
+    def keys(deal: Dict[str, Any]) -> List[Tuple[str, int, str]]:
+        out = []
+        for role in PARTY_ROLES:
+            uid = deal.get(f"{role}_id")
+            if uid is not None:
+                out.append((role, uid, deal["status"]))
+        return out
+
+    def add(self, deal: Dict[str, Any]):
+        for key in self.keys(deal):
+            self._by.setdefault(key, {})[deal["id"]] = None
+
+    def remove(self, deal: Dict[str, Any]):
+        for key in self.keys(deal):
+            ids = self._by.get(key)
+            if ids is not None:
+                ids.pop(deal["id"], None)
+                if not ids:
+                    del self._by[key]
+
+    def get(self, role: str, uid: int, status: str) -> List[str]:
+        return list(self._by.get((role, uid, status), ()))
+
+    def with_status(self, statuses: Tuple[str, ...]) -> Iterator[str]:
+        # у каждой сделки есть продавец — ключей seller хватает, чтобы перечислить все
+        for (role, _uid, status), ids in self._by.items():
+            if role == "seller" and status in statuses:
+                yield from ids
+
+    def counts(self) -> Dict[str, int]:
+        out: Dict[str, int] = {}
+        for (role, _uid, status), ids in self._by.items():
+            if role == "seller":
+                out[status] = out.get(status, 0) + len(ids)
+        return out
+
+    def rebuild(self, deals: Dict[str, Dict[str, Any]]):
+        self.rebuild_rows((d["id"], d.get("seller_id"), d.get("buyer_id"), d["status"]) for d in deals.values())
+
+    def rebuild_rows(self, rows: Iterable[Tuple[str, Optional[int], Optional[int], str]]):
+        # (id, seller_id, buyer_id, status) — на старте берутся из сводки снапшота
+        by: Dict[Tuple[str, int, str], Dict[str, None]] = {}
+        for deal_id, seller_id, buyer_id, status in rows:
+            if seller_id is not None:
+                by.setdefault(("seller", seller_id, status), {})[deal_id] = None
+            if buyer_id is not None:
+                by.setdefault(("buyer", buyer_id, status), {})[deal_id] = None
+        self._by = by
+
+    def check(self, deals: Dict[str, Dict[str, Any]]) -> List[str]:
+        # сверка с полным перебором; возвращает список расхождений
+        expected = DealIndex()
+        expected.rebuild(deals)
+        problems = []
+        for key in set(expected._by) | set(self._by):
+            want = list(expected._by.get(key, ()))
+            have = list(self._by.get(key, ()))
+            if sorted(want) != sorted(have):
+                problems.append(f"{key}: ожидалось {want}, в индексе {have}")
+        return problems
+
+
+class OpenDealSearchIndex:
+    # отсортированные массивы по открытым сделкам: номера и (слово названия, номер);
+    # поиск по префиксу — два bisect, без перебора всех сделок
+    def __init__(self):
+        self.ids: List[str] = []
+        self.names: List[Tuple[str, str]] = []
+
+    def add(self, deal: Dict[str, Any]):
+        if deal["status"] != "open":
+            return
+        i = bisect.bisect_left(self.ids, deal["id"])
+        if i == len(self.ids) or self.ids[i] != deal["id"]:
+            self.ids.insert(i, deal["id"])
+        for token in name_tokens(deal.get("name")):
+            bisect.insort(self.names, (token, deal["id"]))
+
+    def remove(self, deal: Dict[str, Any]):
+        if deal["status"] != "open":
+            return
+        i = bisect.bisect_left(self.ids, deal["id"])
+        if i < len(self.ids) and self.ids[i] == deal["id"]:
+            del self.ids[i]
+        for token in name_tokens(deal.get("name")):
+            j = bisect.bisect_left(self.names, (token, deal["id"]))
+            if j < len(self.names) and self.names[j] == (token, deal["id"]):
+                del self.names[j]
+
+    def rebuild(self, deals: Dict[str, Dict[str, Any]]):
+        self.rebuild_rows((d["id"], d["status"], d.get("name")) for d in deals.values())
+
+    def rebuild_rows(self, rows: Iterable[Tuple[str, str, Optional[str]]]):
+        # (id, status, name)
+        open_deals = [(deal_id, name) for deal_id, status, name in rows if status == "open"]
+        self.ids = sorted(deal_id for deal_id, _ in open_deals)
+        self.names = sorted((token, deal_id) for deal_id, name in open_deals for token in name_tokens(name))
+
+    def by_id(self, prefix: str, offset: int, limit: int) -> List[str]:
+        start = bisect.bisect_left(self.ids, prefix) + offset
+        end = min(bisect.bisect_left(self.ids, prefix + PREFIX_END), start + limit)
+        return self.ids[start:end]
+
+    def by_name(self, prefix: str, offset: int, limit: int) -> List[str]:
+        # одна сделка может совпасть несколькими словами — отдаём её один раз
+        out: List[str] = []
+        seen = set()
+        i = bisect.bisect_left(self.names, (prefix,))
+        end = bisect.bisect_left(self.names, (prefix + PREFIX_END,))
+        while i < end and len(out) < offset + limit:
+            did = self.names[i][1]
+            if did not in seen:
+                seen.add(did)
+                out.append(did)
+            i += 1
+        return out[offset:]
+
+
+class Store(abc.ABC):
+    # все методы — корутины: блокирующие бэкенды уходят в пул потоков
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def metrics(self) -> Dict[str, float]:
+        # счётчики бэкенда для /metrics
+        return {}
+
+    @abc.abstractmethod
+    async def get_user(self, uid: int) -> Dict[str, Any]:
+        # {"balance_minor", "username"}; создаёт пользователя с нулевым балансом, если его ещё нет
+        ...
+
+    @abc.abstractmethod
+    async def set_username(self, uid: int, username: Optional[str]):
+        ...
+
+    @abc.abstractmethod
+    async def adjust_balance(self, uid: int, delta: int, update_id: Optional[int] = None) -> int:
+        # delta в минорных единицах, проводка против external:owner; возвращает новый баланс.
+        # С update_id — не более одной проводки на апдейт: повтор после рестарта её не дублирует
+        ...
+
+    @abc.abstractmethod
+    async def create_deal(self, deal: Dict[str, Any], update_id: Optional[int] = None) -> Dict[str, Any]:
+        # возвращает записанную сделку; с update_id повтор апдейта вернёт уже созданную
+        ...
+
+    @abc.abstractmethod
+    async def find_deal(self, deal_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abc.abstractmethod
+    async def update_deal(self, deal_id: str, **fields) -> Optional[Dict[str, Any]]:
+        ...
+
+    # ----- атомарные переходы: проверка и запись в одной транзакции -----
+    @abc.abstractmethod
+    async def join_deal(self, deal_id: str, buyer_id: int, buyer_username: Optional[str]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        # open -> in_process: проверка баланса, списание и резерв в эскроу разом
+        ...
+
+    @abc.abstractmethod
+    async def transition_deal(self, deal_id: str, from_status: str, to_status: str, **fields) -> Optional[Dict[str, Any]]:
+        # compare-and-set по статусу; None, если сделка уже в другом статусе
+        ...
+
+    @abc.abstractmethod
+    async def complete_deal(self, deal_id: str, buyer_id: int) -> Optional[int]:
+        # transferred -> completed с зачислением эскроу продавцу; возвращает сумму
+        ...
+
+    @abc.abstractmethod
+    async def cancel_deal(self, deal_id: str, from_status: str) -> Optional[int]:
+        # from_status -> cancelled с возвратом эскроу покупателю; возвращает сумму возврата,
+        # None — сделка уже в другом статусе
+        ...
+
+    @abc.abstractmethod
+    async def reconcile_ledger(self, repair: bool = False, checkpoint: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # сверка журнала проводок с кешированными остатками (ledger.reconcile);
+        # checkpoint из прошлого отчёта — досчитать только новые проводки;
+        # repair=True переписывает остатки по журналу
+        ...
+
+    @abc.abstractmethod
+    async def find_party_deals(self, role: str, uid: int, status: str) -> List[Dict[str, Any]]:
+        # role: "seller" | "buyer"; сделки в порядке создания
+        ...
+
+    async def check_indexes(self) -> List[str]:
+        return []
+
+    @abc.abstractmethod
+    async def deal_ids_with_status(self, statuses: Tuple[str, ...]) -> List[str]:
+        ...
+
+    @abc.abstractmethod
+    async def deal_counts(self) -> Dict[str, int]:
+        # статус -> число сделок в хранилище (без архива)
+        ...
+
+    async def compact(self) -> bool:
+        # плановое обслуживание файлов хранилища; False — делать было нечего
+        return False
+
+    @abc.abstractmethod
+    async def search_open_deals(self, kind: str, prefix: str, offset: int, limit: int) -> List[Dict[str, Any]]:
+        # kind: "id" — префикс номера ("#A12"), "name" — префикс слова названия (casefold)
+        ...
+
+    # ----- архив (см. archive.py) -----
+    @abc.abstractmethod
+    async def terminal_deals(self, limit: int) -> List[Dict[str, Any]]:
+        # сделки в TERMINAL_STATUSES, ещё лежащие в хранилище
+        ...
+
+    @abc.abstractmethod
+    async def evict_deals(self, deal_ids: List[str]) -> int:
+        # удаляет уже заархивированные сделки (только в терминальных статусах); возвращает число удалённых
+        ...
+
+    # запись чата: {"last_message_id", необязательные "kind", "hash", "sent_at"} — см. message_state.py
+    @abc.abstractmethod
+    async def set_chat_message(self, chat_id: int, record: Dict[str, Any]):
+        ...
+
+    @abc.abstractmethod
+    async def get_chat_message(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        ...
+
+    async def set_chat_messages(self, items: Dict[int, Dict[str, Any]]):
+        # пакетная запись накопленного UI-состояния (см. coalesce.py)
+        for chat_id, record in items.items():
+            await self.set_chat_message(chat_id, record)
+
+    async def set_last_message(self, chat_id: int, message_id: int):
+        await self.set_chat_message(chat_id, {"last_message_id": message_id})
+
+    async def get_last_message_id(self, chat_id: int) -> Optional[int]:
+        record = await self.get_chat_message(chat_id)
+        return record.get("last_message_id") if record else None
+
+    @abc.abstractmethod
+    async def reserve_sequence(self, name: str, count: int) -> int:
+        # атомарно сдвигает счётчик name на count и возвращает начало блока
+        ...
+
+    # ----- очередь исходящих уведомлений (см. outbox.py) -----
+    @abc.abstractmethod
+    async def save_outbox(self, item: Dict[str, Any]):
+        ...
+
+    @abc.abstractmethod
+    async def delete_outbox(self, item_id: str):
+        ...
+
+    @abc.abstractmethod
+    async def load_outbox(self) -> List[Dict[str, Any]]:
+        ...
+
+    # ----- отложенные задачи (см. scheduler.py) -----
+    @abc.abstractmethod
+    async def save_job(self, job: Dict[str, Any]):
+        ...
+
+    @abc.abstractmethod
+    async def delete_job(self, job_id: str):
+        ...
+
+    @abc.abstractmethod
+    async def load_jobs(self) -> List[Dict[str, Any]]:
+        ...
+
+    # ----- состояние процесса между рестартами (см. lifecycle.py) -----
+    @abc.abstractmethod
+    async def load_runtime(self, name: str) -> Optional[Any]:
+        ...
+
+    @abc.abstractmethod
+    async def save_runtime(self, name: str, value: Any):
+        # значение — JSON; к возврату записано на диск
+        ...
+
+
+class JsonStore(Store):
+    def __init__(self, path: Path, fsync_interval: float = 0.05, compact_threshold: int = 20000, archive=None):
+        self.archive = archive
+        self.journal = Journal(path, fsync_interval=fsync_interval, compact_threshold=compact_threshold)
+        self.data = self.journal.load()
+        self.index = DealIndex()
+        self.search = OpenDealSearchIndex()
+        deals = self.data["deals"]
+        if isinstance(deals, LazySection):
+            # тела сделок декодируются при первом обращении, индексам хватает сводки снапшота
+            self.index.rebuild_rows(deals.rows(("seller_id", "buyer_id", "status")))
+            self.search.rebuild_rows(deals.rows(("status", "name")))
+        else:
+            self.index.rebuild(deals)
+            self.search.rebuild(deals)
+        self._migrate_ledger()
+
+    def _migrate_ledger(self):
+        # данные до ledger.py: float-балансы и эскроу живых сделок становятся входящими проводками
+        if self.data["meta"].get("ledger_version"):
+            return
+        for uid_s, user in self.data["users"].items():
+            legacy = user.pop("balance", None)
+            user.setdefault("balance_minor", 0)
+            self.journal.record("users", uid_s)
+            opening = signed_entry(KIND_OPENING, user_account(int(uid_s)), OPENING_ACCOUNT, to_minor(legacy))
+            if opening is not None:
+                self._post(opening)
+        deals = self.data["deals"]
+        for deal_id in list(self.index.with_status(LIVE_ESCROW_STATUSES)):
+            deal = deals[deal_id]
+            escrow = deal_escrow(deal)
+            fields = {"price_minor": deal_price(deal), "escrow_minor": escrow}
+            deal.pop("price", None)
+            deal.pop("escrow_amount", None)
+            self._update(deal, fields)
+            opening = signed_entry(KIND_OPENING, escrow_account(deal_id), OPENING_ACCOUNT, escrow, deal_id)
+            if opening is not None:
+                self._post(opening)
+        self.data["meta"]["ledger_version"] = 1
+        self.journal.record("meta", "ledger_version")
+
+    async def start(self):
+        self.journal.start()
+
+    async def close(self):
+        await self.journal.close()
+
+    def metrics(self) -> Dict[str, float]:
+        out = {"journal_" + k: v for k, v in self.journal.stats.items()}
+        deals = self.data["deals"]
+        out["deals_loaded"] = len(deals)
+        out["deals_decoded"] = deals.decoded if isinstance(deals, LazySection) else len(deals)
+        out["ledger_entries"] = len(self.data["ledger"])
+        return out
+
+    def _user(self, uid: int) -> Dict[str, Any]:
+        uid_s = str(uid)
+        user = self.data["users"].get(uid_s)
+        if user is None:
+            user = self.data["users"][uid_s] = {"balance_minor": 0, "username": None}
+            self.journal.record("users", uid_s)
+        return user
+
+    async def get_user(self, uid: int) -> Dict[str, Any]:
+        return dict(self._user(uid))
+
+    async def set_username(self, uid: int, username: Optional[str]):
+        user = self._user(uid)
+        if user.get("username") != username:
+            user["username"] = username
+            self.journal.record("users", str(uid))
+
+    def _post(self, posting: Dict[str, Any]) -> int:
+        # проводка и кешированные балансы пользователей меняются без await между ними; возвращает id
+        meta = self.data["meta"]
+        entry_id = meta["ledger_seq"] = meta.get("ledger_seq", 0) + 1
+        self.journal.record("meta", "ledger_seq")
+        key = f"{entry_id:012d}"
+        self.data["ledger"][key] = dict(posting, id=entry_id, ts=time.time())
+        self.journal.record("ledger", key)
+        for uid, delta in user_deltas(posting):
+            self._user(uid)["balance_minor"] += delta
+            self.journal.record("users", str(uid))
+        return entry_id
+
+    def _applied(self, update_id: Optional[int]) -> Optional[Dict[str, Any]]:
+        return self.data["applied"].get(str(update_id)) if update_id is not None else None
+
+    def _mark_applied(self, update_id: Optional[int], result: Dict[str, Any]):
+        # отметка пишется в журнал вместе с изменением, без await между ними
+        if update_id is not None:
+            self.data["applied"][str(update_id)] = result
+            self.journal.record("applied", str(update_id))
+
+    async def adjust_balance(self, uid: int, delta: int, update_id: Optional[int] = None) -> int:
+        user = self._user(uid)
+        posting = signed_entry(KIND_ADJUSTMENT, user_account(uid), OWNER_ACCOUNT, delta)
+        if posting is not None and self._applied(update_id) is None:
+            self._mark_applied(update_id, {"ledger_id": self._post(posting)})
+            await self.journal.sync()
+        return user["balance_minor"]
+
+    async def create_deal(self, deal: Dict[str, Any], update_id: Optional[int] = None) -> Dict[str, Any]:
+        applied = self._applied(update_id)
+        if applied is not None and applied["deal_id"] in self.data["deals"]:
+            return dict(self.data["deals"][applied["deal_id"]])
+        if update_id is not None:
+            deal = dict(deal, update_id=update_id)
+        old = self.data["deals"].get(deal["id"])
+        if old is not None:
+            self.index.remove(old)
+            self.search.remove(old)
+        self.data["deals"][deal["id"]] = dict(deal)
+        self.index.add(deal)
+        self.search.add(deal)
+        self.journal.record("deals", deal["id"])
+        self._mark_applied(update_id, {"deal_id": deal["id"]})
+        await self.journal.sync()
+        return dict(deal)
+
+    async def find_deal(self, deal_id: str) -> Optional[Dict[str, Any]]:
+        deal = self.data["deals"].get(deal_id)
+        if deal is not None:
+            return dict(deal)
+        return await self.archive.find(deal_id) if self.archive is not None else None
+
+    def _update(self, deal: Dict[str, Any], fields: Dict[str, Any]):
+        # индексы и запись меняются без await между ними — переход атомарен для loop
+        self.index.remove(deal)
+        self.search.remove(deal)
+        deal.update(fields)
+        self.index.add(deal)
+        self.search.add(deal)
+        self.journal.record("deals", deal["id"])
+
+    async def update_deal(self, deal_id: str, **fields) -> Optional[Dict[str, Any]]:
+        deal = self.data["deals"].get(deal_id)
+        if deal is None:
+            return None
+        self._update(deal, fields)
+        await self.journal.sync()
+        return dict(deal)
+
+    async def join_deal(self, deal_id: str, buyer_id: int, buyer_username: Optional[str]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        deal = self.data["deals"].get(deal_id)
+        if deal is None:
+            return JOIN_NOT_FOUND, None
+        if deal["status"] != "open":
+            return JOIN_UNAVAILABLE, dict(deal)
+        price = deal_price(deal)
+        user = self._user(buyer_id)
+        if user["balance_minor"] < price:
+            return JOIN_INSUFFICIENT, dict(deal)
+        if price:
+            self._post(entry(KIND_HOLD, user_account(buyer_id), escrow_account(deal_id), price, deal_id))
+        self._update(deal, {"buyer_id": buyer_id, "buyer_username": buyer_username,
+                            "status": "in_process", "price_minor": price, "escrow_minor": price})
+        await self.journal.sync()
+        return JOIN_OK, dict(deal)
+
+    async def transition_deal(self, deal_id: str, from_status: str, to_status: str, **fields) -> Optional[Dict[str, Any]]:
+        deal = self.data["deals"].get(deal_id)
+        if deal is None or deal["status"] != from_status:
+            return None
+        self._update(deal, dict(fields, status=to_status))
+        await self.journal.sync()
+        return dict(deal)
+
+    async def complete_deal(self, deal_id: str, buyer_id: int) -> Optional[int]:
+        deal = self.data["deals"].get(deal_id)
+        if deal is None or deal["status"] != "transferred" or deal.get("buyer_id") != buyer_id:
+            return None
+        amount = deal_escrow(deal)
+        if amount:
+            self._post(entry(KIND_RELEASE, escrow_account(deal_id), user_account(deal["seller_id"]), amount, deal_id))
+        self._update(deal, {"status": "completed", "escrow_minor": 0})
+        await self.journal.sync()
+        return amount
+
+    async def cancel_deal(self, deal_id: str, from_status: str) -> Optional[int]:
+        deal = self.data["deals"].get(deal_id)
+        if deal is None or deal["status"] != from_status:
+            return None
+        amount = deal_escrow(deal)
+        if amount:
+            self._post(entry(KIND_REFUND, escrow_account(deal_id), user_account(deal["buyer_id"]), amount, deal_id))
+        self._update(deal, {"status": "cancelled", "escrow_minor": 0})
+        await self.journal.sync()
+        return amount
+
+    def _ledger_state(self, checkpoint: Optional[Dict[str, Any]]):
+        # согласованный срез: ключи журнала, кеш балансов и эскроу берутся без await между ними
+        fields = ("id", "debit", "credit", "amount")
+        ledger = self.data["ledger"]
+        rows = ledger.rows_after(f"{checkpoint['last_id']:012d}", fields) if checkpoint else ledger.rows(fields)
+        balances = {int(uid): user.get("balance_minor", 0) for uid, user in self.data["users"].items()}
+        deals = self.data["deals"]
+        escrows = {did: deal_escrow(deals[did]) for did in self.index.with_status(LIVE_ESCROW_STATUSES)}
+        return rows, balances, escrows, checkpoint
+
+    @staticmethod
+    def _reconcile(rows, balances: Dict[int, int], escrows: Dict[str, int],
+                   checkpoint: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        totals, summary = aggregate((row[1:] for row in rows), checkpoint)
+        return reconcile(totals, summary, balances, escrows)
+
+    async def reconcile_ledger(self, repair: bool = False, checkpoint: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        state = self._ledger_state(checkpoint)
+        if not repair:
+            # подсчёт по зафиксированному срезу — в потоке, loop тем временем дописывает журнал
+            return await asyncio.get_running_loop().run_in_executor(None, self._reconcile, *state)
+        # починка: срез и запись остатков без await — иначе между ними проскочат новые проводки
+        report = self._reconcile(*state)
+        for uid, amount in report["repair"]["users"].items():
+            self._user(uid)["balance_minor"] = amount
+            self.journal.record("users", str(uid))
+        deals = self.data["deals"]
+        for deal_id, amount in report["repair"]["deals"].items():
+            deal = deals.get(deal_id)
+            if deal is not None and deal["status"] in LIVE_ESCROW_STATUSES:
+                self._update(deal, {"escrow_minor": amount})
+        await self.journal.sync()
+        return report
+
+    async def find_party_deals(self, role: str, uid: int, status: str) -> List[Dict[str, Any]]:
+        deals = self.data["deals"]
+        return [dict(deals[did]) for did in self.index.get(role, uid, status)]
+
+    async def check_indexes(self) -> List[str]:
+        problems = self.index.check(self.data["deals"])
+        expected = OpenDealSearchIndex()
+        expected.rebuild(self.data["deals"])
+        if expected.ids != self.search.ids or expected.names != self.search.names:
+            problems.append("индекс поиска открытых сделок расходится с данными")
+        return problems
+
+    async def deal_ids_with_status(self, statuses: Tuple[str, ...]) -> List[str]:
+        return list(self.index.with_status(statuses))
+
+    async def deal_counts(self) -> Dict[str, int]:
+        return self.index.counts()
+
+    async def compact(self) -> bool:
+        # порог compact_threshold срабатывает только под нагрузкой; по расписанию
+        # в снапшот сливается и медленно растущий хвост журнала
+        if not self.journal.has_tail():
+            return False
+        return self.journal.rotate_and_compact()
+
+    async def search_open_deals(self, kind: str, prefix: str, offset: int, limit: int) -> List[Dict[str, Any]]:
+        ids = self.search.by_id(prefix, offset, limit) if kind == "id" else self.search.by_name(prefix, offset, limit)
+        deals = self.data["deals"]
+        return [dict(deals[did]) for did in ids]
+
+    async def terminal_deals(self, limit: int) -> List[Dict[str, Any]]:
+        # по индексу, без декодирования остальных сделок
+        deals = self.data["deals"]
+        return [dict(deals[did]) for did in itertools.islice(self.index.with_status(TERMINAL_STATUSES), limit)]
+
+    async def evict_deals(self, deal_ids: List[str]) -> int:
+        evicted = 0
+        for deal_id in deal_ids:
+            deal = self.data["deals"].get(deal_id)
+            if deal is None or deal["status"] not in TERMINAL_STATUSES:
+                continue
+            self.index.remove(deal)
+            self.search.remove(deal)
+            del self.data["deals"][deal_id]
+            self.journal.record("deals", deal_id)
+            # апдейт, создавший сделку, давно завершён — его отметка больше не нужна
+            if self.data["applied"].pop(str(deal.get("update_id")), None) is not None:
+                self.journal.record("applied", str(deal["update_id"]))
+            evicted += 1
+        await self.journal.sync()
+        return evicted
+
+    async def set_chat_message(self, chat_id: int, record: Dict[str, Any]):
+        self.data["chats"][str(chat_id)] = dict(record)
+        self.journal.record("chats", str(chat_id))
+
+    async def get_chat_message(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        record = self.data["chats"].get(str(chat_id))
+        return dict(record) if record is not None else None
+
+    async def reserve_sequence(self, name: str, count: int) -> int:
+        start = self.data["meta"].get(name, 0)
+        self.data["meta"][name] = start + count
+        self.journal.record("meta", name)
+        await self.journal.sync()
+        return start
+
+    async def save_outbox(self, item: Dict[str, Any]):
+        # уведомление должно быть на диске не позже перехода сделки, о котором оно сообщает
+        self.data["outbox"][item["id"]] = dict(item)
+        self.journal.record("outbox", item["id"])
+        await self.journal.sync()
+
+    async def delete_outbox(self, item_id: str):
+        if self.data["outbox"].pop(item_id, None) is not None:
+            self.journal.record("outbox", item_id)
+
+    async def load_outbox(self) -> List[Dict[str, Any]]:
+        return [dict(item) for item in self.data["outbox"].values()]
+
+    async def save_job(self, job: Dict[str, Any]):
+        self.data["jobs"][job["id"]] = dict(job)
+        self.journal.record("jobs", job["id"])
+
+    async def delete_job(self, job_id: str):
+        if self.data["jobs"].pop(job_id, None) is not None:
+            self.journal.record("jobs", job_id)
+
+    async def load_jobs(self) -> List[Dict[str, Any]]:
+        return [dict(job) for job in self.data["jobs"].values()]
+
+    async def load_runtime(self, name: str) -> Optional[Any]:
+        return self.data["runtime"].get(name)
+
+    async def save_runtime(self, name: str, value: Any):
+        self.data["runtime"][name] = value
+        self.journal.record("runtime", name)
+        await self.journal.sync()
+
+
+def open_store(backend: str, json_path: Path, sqlite_path: Path, fsync_interval: float = 0.05,
+               compact_threshold: int = 20000, sqlite_workers: int = 4, archive=None) -> Store:
+    # archive — DealArchive: в нём find_deal ищет сделки, которых уже нет в хранилище
+    if backend == "json":
+        return JsonStore(json_path, fsync_interval=fsync_interval, compact_threshold=compact_threshold,
+                         archive=archive)
+    if backend == "sqlite":
+        from sqlite_store import SqliteStore
+        return SqliteStore(sqlite_path, workers=sqlite_workers, archive=archive)
+    raise ValueError(f"неизвестный бэкенд хранилища: {backend!r}")
@@ -0,0 +1,58 @@
+# tests/test_cluster.py — подтверждения воркеров и повторная передача после падения
+#
+# Воркер — этот же файл, запущенный как скрипт: ShardWorker с поддельным
+# диспетчером. Первый запуск подтверждает первый апдейт и падает на втором, не
+# подтвердив его; перезапущенный воркер должен получить все неподтверждённые.
+#
+#   python -m pytest -q tests
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cluster import Coordinator, ShardWorker, read_stdin  # noqa: E402
+
+
+def update(update_id: int, uid: int) -> dict:
+    return {"update_id": update_id, "message": {"message_id": update_id, "date": 0, "text": "x",
+                                                "chat": {"id": uid, "type": "private"}, "from": {"id": uid}}}
+
+
+async def worker(workdir: Path):
+    crashed = workdir / "crashed"
+    log = workdir / "processed"
+
+    class Dispatcher:
+        async def feed_raw_update(self, bot, upd):
+            if not crashed.exists() and upd["update_id"] == 2:
+                crashed.touch()
+                os._exit(1)
+            with open(log, "a") as fh:
+                fh.write(f"{upd['update_id']}\n")
+
+    ack_fd = int(os.environ["WORKER_ACK_FD"])
+    await ShardWorker(Dispatcher(), bot=None, ack_fd=ack_fd).serve(await read_stdin())
+
+
+async def coordinate(workdir: Path):
+    coordinator = Coordinator([sys.executable, __file__, str(workdir)], workers=1, restart_delay=0.01)
+    await coordinator.start()
+    # все апдейты одного пользователя: 2 роняет воркер, 3–5 уже переданы ему и тоже не подтверждены
+    routes = [asyncio.ensure_future(coordinator.route(update(n, 7))) for n in range(1, 6)]
+    await asyncio.wait_for(asyncio.gather(*routes), 30)
+    await coordinator.stop(10)
+    return coordinator.stats
+
+
+def test_unacked_updates_resent_after_worker_crash(tmp_path):
+    stats = asyncio.run(coordinate(tmp_path))
+    processed = [int(line) for line in (tmp_path / "processed").read_text().split()]
+    # 1 подтверждён до падения и не повторяется; остальные — заново и по порядку
+    assert processed == [1, 2, 3, 4, 5]
+    assert stats["restarts"] == 1 and stats["acked"] == 5 and stats["resent"] == 4, stats
+
+
+if __name__ == "__main__":
+    asyncio.run(worker(Path(sys.argv[1])))
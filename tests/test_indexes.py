@@ -0,0 +1,94 @@
+# tests/test_indexes.py — согласованность индексов сделок с данными
+#
+# После каждого шага жизненного цикла сделки (создание, покупка, передача,
+# завершение, отмена) и после перезапуска хранилища check_indexes() не должен
+# находить расхождений — ни в JsonStore (индексы в памяти), ни в SqliteStore.
+#
+#   python -m pytest -q tests
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ledger import SCALE  # noqa: E402
+from storage import open_store, JOIN_OK, JOIN_UNAVAILABLE  # noqa: E402
+
+SELLER = 1
+BUYER = 1000
+
+
+def make_deal(deal_id: str, name: str, price: int = 10) -> dict:
+    return {"id": deal_id, "type": "NFT", "name": name, "description": "d", "price_minor": price * SCALE,
+            "seller_id": SELLER, "seller_username": "seller", "buyer_id": None, "status": "open"}
+
+
+def open_test_store(backend: str, tmp: Path):
+    return open_store(backend, tmp / "data.json", tmp / "data.sqlite3", fsync_interval=0.001)
+
+
+async def assert_consistent(store):
+    assert await store.check_indexes() == []
+
+
+async def lifecycle(backend: str, tmp: Path):
+    store = open_test_store(backend, tmp)
+    await store.start()
+    await store.adjust_balance(BUYER, 100 * SCALE)
+    for i, name in enumerate(("Plush Pepe", "Durov's Cap", "Plush Frog", "Lol Pop")):
+        await store.create_deal(make_deal(f"#A{i}", name))
+        await assert_consistent(store)
+    assert {d["id"] for d in await store.find_party_deals("seller", SELLER, "open")} == {"#A0", "#A1", "#A2", "#A3"}
+
+    # покупка: сделка уходит из индекса поиска открытых и из open у продавца
+    result, _ = await store.join_deal("#A0", BUYER, "buyer")
+    assert result == JOIN_OK
+    await assert_consistent(store)
+    result, _ = await store.join_deal("#A0", BUYER + 1, "late")
+    assert result == JOIN_UNAVAILABLE
+    await assert_consistent(store)
+    assert [d["id"] for d in await store.find_party_deals("buyer", BUYER, "in_process")] == ["#A0"]
+    assert [d["id"] for d in await store.search_open_deals("name", "plush", 0, 10)] == ["#A2"]
+
+    assert await store.transition_deal("#A0", "in_process", "transferred") is not None
+    await assert_consistent(store)
+    assert await store.transition_deal("#A0", "in_process", "transferred") is None
+    await assert_consistent(store)
+
+    assert await store.complete_deal("#A0", BUYER) == 10 * SCALE
+    await assert_consistent(store)
+    assert await store.find_party_deals("seller", SELLER, "transferred") == []
+
+    # отмена открытой и оплаченной сделки
+    assert await store.cancel_deal("#A1", "open") == 0
+    await assert_consistent(store)
+    result, _ = await store.join_deal("#A2", BUYER, "buyer")
+    assert result == JOIN_OK
+    await assert_consistent(store)
+    assert await store.cancel_deal("#A2", "in_process") == 10 * SCALE
+    await assert_consistent(store)
+    assert await store.cancel_deal("#A2", "in_process") is None
+    await assert_consistent(store)
+
+    assert await store.deal_counts() == {"completed": 1, "cancelled": 2, "open": 1}
+    assert (await store.get_user(BUYER))["balance_minor"] == 90 * SCALE
+    assert (await store.reconcile_ledger())["ok"]
+    await store.close()
+
+    # индексы после перезапуска строятся заново из сохранённых данных
+    store = open_test_store(backend, tmp)
+    await store.start()
+    await assert_consistent(store)
+    assert await store.deal_counts() == {"completed": 1, "cancelled": 2, "open": 1}
+    assert [d["id"] for d in await store.find_party_deals("seller", SELLER, "open")] == ["#A3"]
+    assert [d["id"] for d in await store.search_open_deals("name", "lol", 0, 10)] == ["#A3"]
+    await store.close()
+    # SqliteStore закрывает соединения всех потоков: WAL сброшен в базу и удалён
+    assert not (tmp / "data.sqlite3-wal").exists()
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_indexes_follow_deal_lifecycle(backend, tmp_path):
+    asyncio.run(lifecycle(backend, tmp_path))
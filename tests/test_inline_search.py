@@ -0,0 +1,78 @@
+# tests/test_inline_search.py — inline-поиск: порядок страниц и отмена перебитых запросов
+#
+#   python -m pytest -q tests
+import asyncio
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from inline_search import InlineSearch  # noqa: E402
+from storage import open_store  # noqa: E402
+
+# слова, совпадающие с "p", идут не в порядке номеров сделок
+NAMES = {"#A1": "Pepe Plush", "#A2": "Plush", "#A3": "Party Hat", "#A4": "Hat", "#A5": "Pop Pepe", "#B1": "Pink"}
+
+
+async def pages(backend: str, tmp: Path, page: int = 2):
+    tmp.mkdir()
+    store = open_store(backend, tmp / "data.json", tmp / f"{backend}.sqlite3", fsync_interval=0.001)
+    await store.start()
+    for deal_id, name in NAMES.items():
+        await store.create_deal({"id": deal_id, "type": "NFT", "name": name, "description": "d", "price_minor": 1,
+                                 "seller_id": 1, "seller_username": "s", "buyer_id": None, "status": "open"})
+    out = []
+    offset = 0
+    while True:
+        deals = await store.search_open_deals("name", "p", offset, page)
+        if not deals:
+            break
+        out.append([d["id"] for d in deals])
+        offset += page
+    await store.close()
+    return out
+
+
+def test_name_pages_match_across_backends(tmp_path):
+    json_pages = asyncio.run(pages("json", tmp_path / "j"))
+    sqlite_pages = asyncio.run(pages("sqlite", tmp_path / "s"))
+    # первое совпавшее слово, затем номер: party, pepe, pink, plush, pop
+    assert json_pages == sqlite_pages == [["#A3", "#A1"], ["#A5", "#B1"], ["#A2"]]
+
+
+class FakeQuery:
+    def __init__(self, uid: int, query: str, answered: list, delay: float = 0.0):
+        self.from_user = SimpleNamespace(id=uid)
+        self.query = query
+        self.offset = ""
+        self.answered = answered
+        self.delay = delay
+
+    async def answer(self, results, **kwargs):
+        await asyncio.sleep(self.delay)
+        self.answered.append(self.query)
+
+
+async def typing():
+    class Store:
+        async def search_open_deals(self, kind, prefix, offset, limit):
+            return []
+    search = InlineSearch(Store(), render=None, howto=lambda: "howto")
+    answered = []
+    # первые два запроса «висят» на ответе Telegram и перебиваются следующим символом
+    await asyncio.gather(search.answer(FakeQuery(1, "pe", answered, delay=0.05)),
+                         search.answer(FakeQuery(1, "pep", answered, delay=0.05)),
+                         search.answer(FakeQuery(1, "pepe", answered)),
+                         search.answer(FakeQuery(2, "ha", answered)))
+    return search, answered
+
+
+def test_superseded_query_cancelled_without_delay():
+    started = time.perf_counter()
+    search, answered = asyncio.run(typing())
+    # последний запрос отвечается сразу, а не после паузы
+    assert time.perf_counter() - started < 0.09
+    assert sorted(answered) == ["ha", "pepe"]
+    assert search.stats["superseded"] == 2
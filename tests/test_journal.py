@@ -0,0 +1,129 @@
+# tests/test_journal.py — журнал изменений: восстановление после падения и сжатие
+#
+#   python -m pytest -q tests
+import asyncio
+import shutil
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from journal import Journal  # noqa: E402
+
+
+def put(journal: Journal, uid: int, balance: int):
+    journal.data["users"][str(uid)] = {"balance_minor": balance}
+    journal.record("users", str(uid))
+
+
+def users(journal: Journal):
+    return {k: v["balance_minor"] for k, v in journal.data["users"].items()}
+
+
+async def write_and_close(path: Path, values):
+    journal = Journal(path)
+    journal.load()
+    for uid, balance in values:
+        put(journal, uid, balance)
+    await journal.sync()
+    await journal.close()
+    return journal
+
+
+def test_torn_tail_dropped_and_truncated(tmp_path):
+    path = tmp_path / "data.json"
+    asyncio.run(write_and_close(path, [(1, 10), (2, 20)]))
+    segment = tmp_path / "data.wal.000001"
+    intact = segment.read_bytes()
+    # падение посреди записи: последняя строка без перевода строки
+    segment.write_bytes(intact + b'{"s":"users","k":"3","v":{"bala')
+    journal = Journal(path)
+    journal.load()
+    assert users(journal) == {"1": 10, "2": 20}
+    assert segment.read_bytes() == intact
+    asyncio.run(journal.close())
+
+
+def test_replay_stops_at_corrupt_line(tmp_path):
+    path = tmp_path / "data.json"
+    asyncio.run(write_and_close(path, [(1, 10)]))
+    segment = tmp_path / "data.wal.000001"
+    segment.write_bytes(segment.read_bytes() + b"garbage\n" + b'{"s":"users","k":"2","v":{"balance_minor":5}}\n')
+    journal = Journal(path)
+    journal.load()
+    assert users(journal) == {"1": 10}
+    asyncio.run(journal.close())
+
+
+def test_segment_already_in_snapshot_ignored(tmp_path):
+    path = tmp_path / "data.json"
+
+    async def scenario():
+        journal = await write_and_close(path, [(1, 10)])
+        stale = tmp_path / "stale"
+        shutil.copy(tmp_path / "data.wal.000001", stale)
+        journal = Journal(path)
+        journal.load()
+        put(journal, 1, 99)
+        await journal.sync()
+        journal.rotate_and_compact()
+        await journal.close()
+        # падение между заменой снапшота и удалением сегмента: старый сегмент вернулся
+        shutil.copy(stale, tmp_path / "data.wal.000001")
+        stale.unlink()
+        return journal
+
+    asyncio.run(scenario())
+    journal = Journal(path)
+    journal.load()
+    # сегмент уже в снапшоте — его старое значение не перетирает новое
+    assert users(journal) == {"1": 99}
+    assert not (tmp_path / "data.wal.000001").exists()
+    asyncio.run(journal.close())
+
+
+def test_compaction_racing_writes(tmp_path):
+    path = tmp_path / "data.json"
+
+    async def scenario():
+        journal = Journal(path, fsync_interval=0.001)
+        journal.load()
+        journal.start()
+        for uid in range(500):
+            put(journal, uid, uid)
+        await journal.sync()
+        assert journal.rotate_and_compact()
+        # снапшот пишется в потоке, а loop тем временем продолжает писать журнал
+        for uid in range(250, 750):
+            put(journal, uid, uid * 10)
+            if uid % 50 == 0:
+                await journal.sync()
+        await journal.sync()
+        await journal.close()
+        assert journal.stats["snapshots"] == 1
+
+    asyncio.run(scenario())
+    expected = {str(uid): uid if uid < 250 else uid * 10 for uid in range(750)}
+    journal = Journal(path)
+    journal.load()
+    assert users(journal) == expected
+    asyncio.run(journal.close())
+    # и ещё раз — после сжатия всего хвоста
+    journal = Journal(path)
+    journal.load()
+    journal.rotate_and_compact()
+    asyncio.run(journal.close())
+    assert [p.name for p in tmp_path.glob("data.wal.*")] == [f"data.wal.{journal.seq:06d}"]
+    journal = Journal(path)
+    journal.load()
+    assert users(journal) == expected
+    asyncio.run(journal.close())
+
+
+def test_read_leaves_files_untouched(tmp_path):
+    path = tmp_path / "data.json"
+    asyncio.run(write_and_close(path, [(1, 10), (2, 20)]))
+    before = {p.name: p.read_bytes() for p in tmp_path.iterdir()}
+    data = Journal(path).read()
+    assert {k: v["balance_minor"] for k, v in data["users"].items()} == {"1": 10, "2": 20}
+    assert {p.name: p.read_bytes() for p in tmp_path.iterdir()} == before
@@ -0,0 +1,31 @@
+# tests/test_ledger.py — разбор денежных сумм
+#
+#   python -m pytest -q tests
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ledger import SCALE, parse_amount, format_amount  # noqa: E402
+
+
+@pytest.mark.parametrize("text, minor", [
+    ("10", 10 * SCALE),
+    ("10,5", 10 * SCALE + SCALE // 2),
+    ("-3", -3 * SCALE),
+    ("0.000001", 1),
+    ("1000000000", 10 ** 9 * SCALE),
+])
+def test_parse_amount(text, minor):
+    assert parse_amount(text) == minor
+    assert parse_amount(format_amount(minor)) == minor
+
+
+@pytest.mark.parametrize("text", ["", "abc", "nan", "inf", "0.0000001", "1e-30",
+                                  "1000000000.000001", "99999999999999", "-99999999999999", "1e30"])
+def test_parse_amount_rejects(text):
+    # всё, что не сумма, — ValueError: хендлеры ловят только его
+    with pytest.raises(ValueError):
+        parse_amount(text)
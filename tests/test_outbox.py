@@ -0,0 +1,67 @@
+# tests/test_outbox.py — доставка уведомлений из очереди и их жизнь в Store
+#
+#   python -m pytest -q tests
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from journal import Journal  # noqa: E402
+from outbox import Outbox  # noqa: E402
+from storage import open_store  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id: int, **params):
+        self.sent.append((chat_id, params["text"]))
+        return SimpleNamespace(message_id=len(self.sent))
+
+
+async def wait_sent(outbox: Outbox, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while outbox.depth and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def enqueue_survives_restart(tmp: Path):
+    store = open_store("json", tmp / "data.json", tmp / "data.sqlite3", fsync_interval=0.001)
+    await store.start()
+    outbox = Outbox(FakeBot(), store)
+    await outbox.send_message(1, text="hi")
+    # без close(): enqueue вернулся — запись уже на диске, а не в буфере журнала
+    on_disk = Journal(tmp / "data.json").read()
+    assert [item["params"]["text"] for item in on_disk["outbox"].values()] == ["hi"]
+    await store.close()
+
+
+async def delivered_despite_chat_state_error(tmp: Path):
+    store = open_store("json", tmp / "data.json", tmp / "data.sqlite3", fsync_interval=0.001)
+    await store.start()
+
+    async def broken(chat_id, record):
+        raise OSError("disk full")
+    store.set_chat_message = broken
+    bot = FakeBot()
+    outbox = Outbox(bot, store)
+    await outbox.start()
+    await outbox.send_message(1, text="hi", track_last_message=True)
+    await wait_sent(outbox)
+    await outbox.stop()
+    # уведомление доставлено один раз и из очереди снято: после рестарта не повторится
+    assert bot.sent == [(1, "hi")]
+    assert outbox.depth == 0
+    assert await store.load_outbox() == []
+    await store.close()
+
+
+def test_enqueue_is_durable(tmp_path):
+    asyncio.run(enqueue_survives_restart(tmp_path))
+
+
+def test_sent_item_finished_when_chat_state_fails(tmp_path):
+    asyncio.run(delivered_despite_chat_state_error(tmp_path))
@@ -0,0 +1,95 @@
+# tests/test_replay.py — повтор завершённых апдейтов из pending после рестарта
+#
+# Апдейт уже обработан, но до сохранения состояния приёма процесс упал: после
+# рестарта UpdateRunner.restore() повторяет его из runtime.updates.pending.
+# /gb не должен зачислить сумму второй раз, ввод цены — создать вторую сделку.
+# main.py читает настройки из окружения при импорте, поэтому каждый бэкенд —
+# в отдельном процессе (этот же файл, запущенный как скрипт).
+#
+#   python -m pytest -q tests
+import asyncio
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(1, str(ROOT / "bench"))
+
+BUYER = 20_000_001
+SELLER = 10_000_001
+
+
+async def scenario(backend: str, workdir: Path):
+    from fake_bot_api import FakeBotApi
+    from ledger import SCALE
+    api = FakeBotApi()
+    base = await api.start()
+    os.environ.update(BOT_TOKEN="123456:REPLAY", BOT_API_BASE=base, STORAGE_BACKEND=backend,
+                      ARCHIVE_INTERVAL="0", LEDGER_RECONCILE_INTERVAL="0")
+    os.chdir(workdir)
+    import main
+    from aiogram.fsm.storage.base import StorageKey
+    from lifecycle import STATE_KEY, UpdateRunner, dispatcher_handler
+    from load_test import Scenario
+    await main.on_startup()
+    sc = Scenario(main, api, workdir)
+
+    async def run_and_forget_completion(update):
+        # апдейт обработан, но в сохранённом состоянии приёма остался в pending
+        await main.UPDATES.submit(update["update_id"], update)
+        await main.UPDATES.drain(5)
+        await main.STORE.save_runtime(STATE_KEY, {"offset": update["update_id"] + 1, "pending": [update]})
+
+    async def replay():
+        runner = UpdateRunner(dispatcher_handler(main.dp, main.bot), store=main.STORE)
+        await runner.restore()
+        await runner.drain(5)
+        assert runner.stats["replayed"] == 1 and runner.stats["finished"] == 1, runner.stats
+        assert (await main.STORE.load_runtime(STATE_KEY))["pending"] == []
+
+    await run_and_forget_completion(sc._message(main.OWNER_ID, f"/gb {BUYER} 100"))
+    assert (await main.STORE.get_user(BUYER))["balance_minor"] == 100 * SCALE
+    await replay()
+    assert (await main.STORE.get_user(BUYER))["balance_minor"] == 100 * SCALE
+
+    # падение между create_deal и state.clear(): мастер продавца всё ещё ждёт цену
+    await sc.tap("seller", SELLER, "role_seller")
+    await sc.tap("seller", SELLER, "seller_start")
+    for text in ("NFT", "Подарок", "Коллекционный подарок"):
+        await sc.text("seller", SELLER, text)
+    context = main.FSMContext(storage=main.FSM_STORAGE,
+                              key=StorageKey(bot_id=main.bot.id, chat_id=SELLER, user_id=SELLER))
+    state, data = await context.get_state(), await context.get_data()
+    await run_and_forget_completion(sc._message(SELLER, "25"))
+    await context.set_state(state)
+    await context.set_data(data)
+    await replay()
+    deals = await main.STORE.find_party_deals("seller", SELLER, "open")
+    assert len(deals) == 1 and deals[0]["price_minor"] == 25 * SCALE, deals
+    assert await main.STORE.check_indexes() == []
+    assert (await main.STORE.reconcile_ledger())["ok"]
+
+    await main.SCHEDULER.stop()
+    await main.OUTBOX.stop()
+    await main.ARCHIVER.stop()
+    await main.RECONCILER.stop()
+    await main.STORE.close()
+    await main.ARCHIVE.close()
+    await main.FSM_STORAGE.close()
+    await main.bot.session.close()
+    await api.stop()
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_completed_updates_replayed_without_effect(backend, tmp_path):
+    result = subprocess.run([sys.executable, __file__, backend, str(tmp_path)],
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr[-3000:]
+
+
+if __name__ == "__main__":
+    asyncio.run(scenario(sys.argv[1], Path(sys.argv[2])))
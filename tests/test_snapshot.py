@@ -0,0 +1,87 @@
+# tests/test_snapshot.py — двоичный снапшот: ленивые разделы и копирование без декодирования
+#
+#   python -m pytest -q tests
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from snapshot import LAZY_SUMMARY, LazySection, read_snapshot, write_snapshot  # noqa: E402
+
+FIELDS = LAZY_SUMMARY["ledger"]
+
+
+def ledger_entry(n: int) -> dict:
+    # id и amount попадают в целочисленные колонки сводки, debit и credit — в JSON-колонки
+    return {"id": n, "ts": 1.5, "kind": "k", "debit": f"user:{n % 3}", "credit": "escrow:#A1",
+            "amount": n * 1000, "deal_id": None if n % 2 else "#A1"}
+
+
+def sample() -> dict:
+    return {
+        "users": {"1": {"balance_minor": 5}},
+        "deals": {f"#A{n}": {"id": f"#A{n}", "seller_id": n, "buyer_id": None if n % 2 else n + 1,
+                             "status": "open", "name": f"Gift {n}"} for n in range(20)},
+        "ledger": {f"{n:012d}": ledger_entry(n) for n in range(1, 31)},
+        "meta": {"ledger_version": 1},
+    }
+
+
+def plain(section) -> dict:
+    return {key: section[key] for key in section}
+
+
+def expected_rows(section: dict, fields=FIELDS):
+    return [(key,) + tuple(value.get(f) for f in fields) for key, value in section.items()]
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "data.snap"
+    data = sample()
+    write_snapshot(path, data, 7)
+    loaded, seq = read_snapshot(path)
+    assert seq == 7
+    assert loaded["users"] == data["users"] and loaded["meta"] == data["meta"]
+    assert isinstance(loaded["deals"], LazySection) and loaded["deals"].decoded == 0
+    # нетронутый раздел: строки целиком из колонок сводки
+    assert list(loaded["ledger"].rows(FIELDS)) == expected_rows(data["ledger"])
+    assert list(loaded["deals"].rows(LAZY_SUMMARY["deals"])) == expected_rows(data["deals"], LAZY_SUMMARY["deals"])
+    assert loaded["ledger"].decoded == 0
+    assert plain(loaded["deals"]) == data["deals"]
+
+
+def test_mixed_rows_and_rewrite(tmp_path):
+    path = tmp_path / "data.snap"
+    data = sample()
+    write_snapshot(path, data, 1)
+    loaded, _ = read_snapshot(path)
+    ledger = loaded["ledger"]
+    # часть записей прочитана, одна изменена, одна удалена, новые дописаны в конец
+    ledger[f"{3:012d}"]
+    ledger[f"{4:012d}"]["amount"] = 1
+    del ledger[f"{5:012d}"]
+    for n in (31, 32):
+        ledger[f"{n:012d}"] = ledger_entry(n)
+    expected = {key: value for key, value in data["ledger"].items() if key != f"{5:012d}"}
+    expected[f"{4:012d}"] = dict(expected[f"{4:012d}"], amount=1)
+    expected.update({f"{n:012d}": ledger_entry(n) for n in (31, 32)})
+
+    assert list(ledger.rows(FIELDS)) == expected_rows(expected)
+    tail = {k: v for k, v in expected.items() if k > f"{28:012d}"}
+    assert list(ledger.rows_after(f"{28:012d}", FIELDS)) == expected_rows(tail)
+    assert ledger.decoded == 2
+
+    # при перезаписи нетронутые записи копируются байт в байт, остальные кодируются заново
+    write_snapshot(tmp_path / "again.snap", loaded, 2)
+    again, seq = read_snapshot(tmp_path / "again.snap")
+    assert seq == 2
+    assert list(again["ledger"].rows(FIELDS)) == expected_rows(expected)
+    assert plain(again["ledger"]) == expected
+    assert plain(again["deals"]) == data["deals"]
+
+
+def test_empty_lazy_section(tmp_path):
+    path = tmp_path / "data.snap"
+    write_snapshot(path, {"deals": LazySection(), "users": {}}, 0)
+    loaded, _ = read_snapshot(path)
+    assert len(loaded["deals"]) == 0 and list(loaded["deals"].rows(("status",))) == []
@@ -0,0 +1,27 @@
+# tests/test_transactions.py — одновременные нажатия по сделкам: малый прогон bench/stress_transactions.py
+#
+# 20 сделок и 10 покупателей с двойными и тройными тапами через настоящие
+# хендлеры; инварианты (деньги сохраняются, балансы не уходят в минус,
+# передача и завершение — ровно один раз, индексы и журнал проводок сходятся)
+# проверяет сам скрипт. main.py — синглтон уровня модуля, поэтому каждый
+# бэкенд — в отдельном процессе.
+#
+#   python -m pytest -q tests
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SCRIPT = Path(__file__).resolve().parent.parent / "bench" / "stress_transactions.py"
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_concurrent_taps_keep_invariants(backend, tmp_path):
+    # рабочий каталог скрипта (mkdtemp) — внутри tmp_path
+    env = dict(os.environ, TMPDIR=str(tmp_path))
+    result = subprocess.run([sys.executable, str(SCRIPT), backend, "20", "10"], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr[-3000:]
+    assert "инварианты соблюдены" in result.stdout
@@ -0,0 +1,100 @@
+# throttle.py — ограничение частоты действий пользователя и подавление повторных нажатий
+#
+# Двойной тап по «Продолжить» / «Товар передан» / «Баланс» раньше прогонял
+# хендлер целиком: запись в хранилище и один-два вызова Bot API на каждое
+# нажатие. ThrottleMiddleware — inner middleware для message и callback_query
+# (хендлер уже выбран фильтрами):
+#   * нажатие с тем же callback_data, что и принятое от этого пользователя
+#     меньше dedup_window назад, считается дублем;
+#   * у каждого пользователя token bucket на группу хендлеров: группа задаётся
+#     флагом хендлера flags={"throttle": "<группа>"}, её лимит — limits[группа],
+#     хендлеры без флага делят группу "default";
+#   * подавленный callback получает только answerCallbackQuery (иначе у
+#     пользователя крутятся часики на кнопке), подавленное сообщение отбрасывается.
+# Подавления считаются в Counter с метками handler и reason (duplicate|throttled).
+# В кластере апдейты пользователя приходят в один воркер, поэтому состояния
+# процесса достаточно.
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery, TelegramObject
+
+from metrics import Counter
+from outbox import TokenBucket
+
+DEFAULT_GROUP = "default"
+GC_INTERVAL = 60.0  # сек; забываем полные корзины и устаревшие нажатия
+
+
+class Limit(NamedTuple):
+    rate: float  # действий в секунду
+    burst: float  # сколько можно сделать подряд
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    def __init__(self, limits: Dict[str, Limit], suppressed: Counter, dedup_window: float = 1.0,
+                 exempt: Iterable[int] = (), throttled_text: Optional[str] = None):
+        self.limits = limits
+        self.suppressed = suppressed
+        self.dedup_window = dedup_window
+        self.exempt = frozenset(exempt)
+        self.throttled_text = throttled_text
+        self._buckets: Dict[Tuple[int, str], TokenBucket] = {}
+        self._recent: Dict[Tuple[int, str], float] = {}  # (uid, callback_data) -> когда принято
+        self._last_gc = time.monotonic()
+        self.stats = {"passed": 0, "duplicates": 0, "throttled": 0, "buckets": 0, "recent_callbacks": 0}
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+        now = time.monotonic()
+        if now - self._last_gc > GC_INTERVAL:
+            self._gc(now)
+        reason = self._check(user.id, event, get_flag(data, "throttle", default=DEFAULT_GROUP), now)
+        if reason is None:
+            self.stats["passed"] += 1
+            return await handler(event, data)
+        self.stats["duplicates" if reason == "duplicate" else "throttled"] += 1
+        name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+        self.suppressed.inc(handler=name, reason=reason)
+        if isinstance(event, CallbackQuery):
+            try:
+                await event.answer(self.throttled_text if reason == "throttled" else None)
+            except TelegramAPIError:
+                pass  # запрос устарел — пользователю уже всё равно
+        return None
+
+    def _check(self, uid: int, event: TelegramObject, group: str, now: float) -> Optional[str]:
+        # None — пропустить; иначе причина подавления
+        key = None
+        if isinstance(event, CallbackQuery) and event.data is not None:
+            key = (uid, event.data)
+            accepted = self._recent.get(key)
+            if accepted is not None and now - accepted < self.dedup_window:
+                return "duplicate"
+        bucket = self._buckets.get((uid, group))
+        if bucket is None:
+            limit = self.limits.get(group) or self.limits[DEFAULT_GROUP]
+            bucket = self._buckets[(uid, group)] = TokenBucket(limit.rate, limit.burst)
+            self.stats["buckets"] = len(self._buckets)
+        if bucket.delay(now) > 0:
+            return "throttled"
+        bucket.take(now)
+        if key is not None:
+            self._recent[key] = now
+            self.stats["recent_callbacks"] = len(self._recent)
+        return None
+
+    def _gc(self, now: float):
+        self._last_gc = now
+        for key in [k for k, b in self._buckets.items() if b.idle(now)]:
+            del self._buckets[key]
+        for key in [k for k, t in self._recent.items() if now - t >= self.dedup_window]:
+            del self._recent[key]
+        self.stats["buckets"] = len(self._buckets)
+        self.stats["recent_callbacks"] = len(self._recent)
@@ -0,0 +1,76 @@
+# webhook.py — приём обновлений через webhook на aiohttp
+#
+# Обновления обрабатываются параллельно, но не более runner.max_concurrency за раз:
+# когда лимит исчерпан, ответ Telegram задерживается и он сам снижает темп.
+# Обработку ведёт UpdateRunner (lifecycle.py): в кластерном режиме он передаёт
+# апдейт координатору (см. cluster.py). Секрет обязателен: без проверки
+# X-Telegram-Bot-Api-Secret-Token любой, кто знает адрес, подделает апдейт от
+# имени владельца (/gb). Ответ 200 уходит только после того, как апдейт сохранён
+# в pending (UpdateRunner.checkpoint). После stop() новые апдейты получают 503 —
+# Telegram повторит их, когда процесс поднимется снова, — а принятые дорабатываются.
+import hmac
+import logging
+from typing import Optional
+
+from aiohttp import web
+
+from lifecycle import UpdateRunner
+
+log = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    def __init__(self, runner: UpdateRunner, secret: str, path: str = "/webhook"):
+        if not secret:
+            raise ValueError("webhook: нужен секрет для X-Telegram-Bot-Api-Secret-Token")
+        self.runner = runner
+        self.path = path
+        self.secret = secret
+        self.accepting = True
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get("/health", self.handle_health)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def in_flight(self) -> int:
+        return self.runner.in_flight
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        if not self.accepting:
+            return web.Response(status=503)
+        try:
+            update = await request.json()
+            update_id = update["update_id"]
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        await self.runner.submit(update_id, update)
+        try:
+            # 200 подтверждает апдейт Telegram — до этого он должен быть сохранён в pending
+            await self.runner.checkpoint()
+        except Exception:
+            log.exception("webhook: ошибка сохранения состояния приёма")
+            return web.Response(status=500)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok" if self.accepting else "stopping", "in_flight": self.in_flight,
+                                  "max_concurrency": self.runner.max_concurrency})
+
+    async def start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        log.info("webhook: слушаем %s:%d%s", host, port, self.path)
+
+    async def stop(self, timeout: float = 20.0):
+        # сервер отвечает 503, пока дорабатываются принятые апдейты
+        self.accepting = False
+        await self.runner.drain(timeout)
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None